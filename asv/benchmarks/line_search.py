@@ -0,0 +1,31 @@
+"""Benchmarks of the search for the first line of a packet."""
+
+import numpy as np
+
+from tardis.montecarlo import montecarlo
+
+
+class TimeLineSearch:
+    """
+    Binary search over the whole line list compared to the search with the
+    logarithmic frequency index, on line lists that are clustered in the UV
+    like the atomic line lists.
+    """
+    params = ([10000, 100000, 1000000], ['binary', 'index'])
+    param_names = ['no_of_lines', 'search']
+
+    def setup(self, no_of_lines, search):
+        rng = np.random.RandomState(1)
+        wavelength = rng.lognormal(np.log(3000e-8), 0.8, no_of_lines)
+        self.line_list_nu = np.sort(2.99792458e10 / wavelength)[::-1].copy()
+        self.nus = np.exp(rng.uniform(np.log(self.line_list_nu[-1]),
+                                      np.log(self.line_list_nu[0]), 1000000))
+        if search == 'index':
+            self.line_search_index = montecarlo.make_line_search_index(
+                self.line_list_nu, no_of_lines)
+        else:
+            self.line_search_index = None
+
+    def time_search_lines(self, no_of_lines, search):
+        montecarlo.search_lines(self.line_list_nu, self.nus,
+                                self.line_search_index)
@@ -0,0 +1,524 @@
+"""Benchmarks of the montecarlo transport kernel on synthetic models."""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy import units as u
+
+from tardis.montecarlo.base import MontecarloRunner
+
+from .model_setup import make_model
+
+
+class TimeThreadScaling:
+    """
+    Packet transport with an increasing number of OpenMP threads, with dense
+    and with sparse thread-private j_blue estimators.
+    """
+    params = ([1, 2, 4, 8, 16], ['dense', 'sparse'])
+    param_names = ['nthreads', 'j_blue_estimator']
+    timeout = 600
+
+    def setup(self, nthreads, j_blue_estimator):
+        memory_limit = 1 if j_blue_estimator == 'dense' else 0
+        self.model = make_model(
+            no_of_lines=100000, no_of_packets=100000,
+            thread_estimator_memory_limit=memory_limit * u.GB)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, nthreads, j_blue_estimator):
+        self.runner.run(self.model, no_of_virtual_packets=0,
+                        nthreads=nthreads)
+
+
+class TimeVirtualPackets:
+    """
+    Transport with virtual packets, with and without storing every escaping
+    virtual packet.
+    """
+    params = ([1, 4, 16], [True, False])
+    param_names = ['nthreads', 'virtual_packet_logging']
+    timeout = 600
+
+    def setup(self, nthreads, virtual_packet_logging):
+        self.model = make_model(
+            no_of_packets=20000,
+            virtual_packet_logging=virtual_packet_logging)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, nthreads, virtual_packet_logging):
+        self.runner.run(self.model, no_of_virtual_packets=10,
+                        nthreads=nthreads)
+
+
+class PeakMemChunkedTransport:
+    """
+    Peak memory of a transport run with all packets in one chunk and with
+    smaller chunks. The per packet outputs hold all packets regardless of the
+    chunks and are switched off.
+    """
+    params = [-1, 100000, 10000]
+    param_names = ['chunk_size']
+    timeout = 600
+
+    def setup(self, chunk_size):
+        self.model = make_model(no_of_packets=1000000)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def peakmem_run(self, chunk_size):
+        self.runner.run(self.model, no_of_virtual_packets=0, nthreads=1,
+                        chunk_size=chunk_size, packet_logging=False,
+                        packet_diagnostics=False)
+
+
+class TimeMacroAtomSampling:
+    """
+    Macro atom transport with many transitions per level, summing up the
+    transition probabilities for every jump compared to the binary search
+    over the cumulative probabilities.
+    """
+    params = ([20, 100], [4, 32], ['linear', 'cumulative'])
+    param_names = ['no_of_shells', 'transitions_per_level',
+                   'macro_atom_sampling']
+    timeout = 600
+
+    def setup(self, no_of_shells, transitions_per_level, macro_atom_sampling):
+        self.model = make_model(
+            no_of_shells=no_of_shells, no_of_packets=50000,
+            transitions_per_level=transitions_per_level,
+            macro_atom_sampling=macro_atom_sampling)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, no_of_shells, transitions_per_level,
+                 macro_atom_sampling):
+        self.runner.run(self.model, no_of_virtual_packets=0, nthreads=1)
+
+
+class TimeMacroAtomEmission:
+    """
+    Macro atom transport following the random walk compared to choosing the
+    emission from the solved absorbing Markov chain, for short and long
+    random walks. The time includes solving the chain.
+    """
+    params = ([4, 32], [0.6, 0.1], [False, True])
+    param_names = ['transitions_per_level', 'emission_probability',
+                   'macro_atom_emission_probabilities']
+    timeout = 600
+
+    def setup(self, transitions_per_level, emission_probability,
+              macro_atom_emission_probabilities):
+        self.model = make_model(
+            no_of_packets=200000, transitions_per_level=transitions_per_level,
+            levels_per_species=50, emission_probability=emission_probability,
+            macro_atom_emission_probabilities=(
+                macro_atom_emission_probabilities))
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, transitions_per_level, emission_probability,
+                 macro_atom_emission_probabilities):
+        self.runner.run(self.model, no_of_virtual_packets=0, nthreads=1)
+
+
+class TimeShellMajorLineLists:
+    """
+    Transport with the line-major and the shell-major layout of the
+    tau_sobolevs, transition probabilities and j_blue estimator.
+    """
+    params = ([20, 100, 1000], [False, True])
+    param_names = ['no_of_shells', 'shell_major_line_lists']
+    timeout = 600
+
+    def setup(self, no_of_shells, shell_major_line_lists):
+        self.model = make_model(
+            no_of_shells=no_of_shells, no_of_lines=20000,
+            no_of_packets=50000, macro_atom_sampling='linear',
+            shell_major_line_lists=shell_major_line_lists)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, no_of_shells, shell_major_line_lists):
+        self.runner.run(self.model, no_of_virtual_packets=0, nthreads=1)
+
+
+class TimeThreadSchedule:
+    """
+    Transport with virtual packets, whose cost varies a lot between the
+    packets, with the different OpenMP schedules of the packet loop.
+    """
+    params = (['static', 'dynamic', 'guided'], [0, 64])
+    param_names = ['thread_schedule', 'thread_schedule_chunk_size']
+    timeout = 600
+
+    def setup(self, thread_schedule, thread_schedule_chunk_size):
+        self.model = make_model(
+            no_of_packets=50000, thread_schedule=thread_schedule,
+            thread_schedule_chunk_size=thread_schedule_chunk_size)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, thread_schedule, thread_schedule_chunk_size):
+        self.runner.run(self.model, no_of_virtual_packets=10, nthreads=8)
+
+    def track_load_imbalance(self, thread_schedule,
+                             thread_schedule_chunk_size):
+        self.runner.run(self.model, no_of_virtual_packets=10, nthreads=8)
+        return self.runner.thread_load_imbalance
+
+
+class TimeConcurrentModels:
+    """
+    Several models transported at the same time from a Python thread pool,
+    with one OpenMP thread each. The transport releases the GIL, so the time
+    should stay close to that of a single model as long as there are enough
+    cores.
+    """
+    params = [1, 2, 4, 8]
+    param_names = ['no_of_models']
+    timeout = 600
+
+    def setup(self, no_of_models):
+        self.models = [make_model(no_of_packets=20000)
+                       for i in range(no_of_models)]
+        self.runners = [
+            MontecarloRunner(model.tardis_config.montecarlo.seed)
+            for model in self.models]
+        self.executor = ThreadPoolExecutor(max_workers=no_of_models)
+
+    def teardown(self, no_of_models):
+        self.executor.shutdown()
+
+    def time_run(self, no_of_models):
+        futures = [
+            self.executor.submit(runner.run, model, no_of_virtual_packets=0,
+                                 nthreads=1)
+            for model, runner in zip(self.models, self.runners)]
+        for future in futures:
+            future.result()
+
+
+class TimePacketLogging:
+    """
+    Transport with and without storing the frequency and energy of every
+    packet, the spectra are binned by the transport in both cases.
+    """
+    params = [True, False]
+    param_names = ['packet_logging']
+    timeout = 600
+
+    def setup(self, packet_logging):
+        self.model = make_model(no_of_lines=2000, no_of_packets=1000000)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, packet_logging):
+        self.runner.run(self.model, no_of_virtual_packets=0, nthreads=1,
+                        packet_logging=packet_logging)
+
+    def peakmem_run(self, packet_logging):
+        self.runner.run(self.model, no_of_virtual_packets=0, nthreads=1,
+                        packet_logging=packet_logging)
+
+
+class TimePacketDiagnostics:
+    """
+    Transport with and without tracking the last interaction of every packet.
+    """
+    params = [True, False]
+    param_names = ['packet_diagnostics']
+    timeout = 600
+
+    def setup(self, packet_diagnostics):
+        self.model = make_model(no_of_lines=2000, no_of_packets=1000000)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, packet_diagnostics):
+        self.runner.run(self.model, no_of_virtual_packets=0, nthreads=1,
+                        packet_logging=False,
+                        packet_diagnostics=packet_diagnostics)
+
+    def peakmem_run(self, packet_diagnostics):
+        self.runner.run(self.model, no_of_virtual_packets=0, nthreads=1,
+                        packet_logging=False,
+                        packet_diagnostics=packet_diagnostics)
+
+
+class TimeJBlueEstimator:
+    """
+    Transport of a model with many lines and shells with detailed radiative
+    rates, which need the j_blue estimator, and with dilute black body
+    rates, which do not.
+    """
+    params = (['detailed', 'dilute-blackbody'], [1, 4])
+    param_names = ['radiative_rates_type', 'nthreads']
+    timeout = 600
+
+    def setup(self, radiative_rates_type, nthreads):
+        self.model = make_model(no_of_shells=100, no_of_lines=200000,
+                                no_of_packets=50000,
+                                radiative_rates_type=radiative_rates_type)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, radiative_rates_type, nthreads):
+        self.runner.run(self.model, no_of_virtual_packets=0,
+                        nthreads=nthreads)
+
+    def peakmem_run(self, radiative_rates_type, nthreads):
+        self.runner.run(self.model, no_of_virtual_packets=0,
+                        nthreads=nthreads)
+
+
+class TimeActiveLines:
+    """
+    Transport through the full line list and through the lines whose
+    tau_sobolev exceeds a threshold in at least one shell.
+    """
+    params = ([-1, 10.0, 50.0], ['scatter', 'macroatom'])
+    param_names = ['active_line_tau_threshold', 'line_interaction_type']
+    timeout = 600
+
+    def setup(self, active_line_tau_threshold, line_interaction_type):
+        self.model = make_model(
+            no_of_lines=100000, no_of_packets=50000,
+            line_interaction_type=line_interaction_type,
+            active_line_tau_threshold=active_line_tau_threshold)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, active_line_tau_threshold, line_interaction_type):
+        self.runner.run(self.model, no_of_virtual_packets=0, nthreads=1)
+
+    def track_active_lines(self, active_line_tau_threshold,
+                           line_interaction_type):
+        self.runner.run(self.model, no_of_virtual_packets=0, nthreads=1)
+        return self.runner.line_list_nu.size
+
+
+class TimeShellLineLists:
+    """
+    Transport through the same line list in all shells and through per shell
+    line lists of the lines whose tau_sobolev exceeds a threshold in the
+    shell.
+    """
+    params = ([-1, 0.1, 1.0], ['scatter', 'macroatom'])
+    param_names = ['shell_line_tau_threshold', 'line_interaction_type']
+    timeout = 600
+
+    def setup(self, shell_line_tau_threshold, line_interaction_type):
+        self.model = make_model(
+            no_of_lines=100000, no_of_packets=50000,
+            line_interaction_type=line_interaction_type,
+            shell_line_tau_threshold=shell_line_tau_threshold)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, shell_line_tau_threshold, line_interaction_type):
+        self.runner.run(self.model, no_of_virtual_packets=0, nthreads=1)
+
+    def track_line_events_per_packet(self, shell_line_tau_threshold,
+                                     line_interaction_type):
+        self.runner.run(self.model, no_of_virtual_packets=0, nthreads=1)
+        return self.runner.line_events_per_packet
+
+
+class TimeVirtualPacketEngine:
+    """
+    Transport of virtual packets line by line and with the cumulative
+    tau_sobolevs of the shells.
+    """
+    params = ([1000, 100000], ['walk', 'table'])
+    param_names = ['no_of_lines', 'virtual_packet_engine']
+    timeout = 600
+
+    def setup(self, no_of_lines, virtual_packet_engine):
+        self.model = make_model(
+            no_of_lines=no_of_lines, no_of_packets=10000,
+            virtual_packet_engine=virtual_packet_engine)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, no_of_lines, virtual_packet_engine):
+        self.runner.run(self.model, no_of_virtual_packets=10, nthreads=1)
+
+    def track_virtual_luminosity(self, no_of_lines, virtual_packet_engine):
+        self.runner.run(self.model, no_of_virtual_packets=10, nthreads=1)
+        return self.model.montecarlo_virtual_luminosity.sum()
+
+
+class TimeVirtualPacketBatches:
+    """
+    Transport of virtual packets where they are spawned and in batches after
+    their real packets.
+    """
+    params = ([0, 64, 4096], [1, 8])
+    param_names = ['virtual_packet_batch_size', 'nthreads']
+    timeout = 600
+
+    def setup(self, virtual_packet_batch_size, nthreads):
+        self.model = make_model(
+            no_of_lines=100000, no_of_packets=10000,
+            virtual_packet_batch_size=virtual_packet_batch_size)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, virtual_packet_batch_size, nthreads):
+        self.runner.run(self.model, no_of_virtual_packets=10,
+                        nthreads=nthreads)
+
+
+class TimeAdaptiveVirtualPackets:
+    """
+    Transport with a fixed number of virtual packets per interaction and with
+    numbers adapted to the relative error of the virtual spectrum bins.
+    """
+    params = [0, 0.05, 0.02]
+    param_names = ['virtual_packet_relative_error']
+    timeout = 600
+
+    def setup(self, virtual_packet_relative_error):
+        self.model = make_model(
+            no_of_packets=40000,
+            virtual_packet_relative_error=virtual_packet_relative_error)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, virtual_packet_relative_error):
+        self.runner.run(self.model, no_of_virtual_packets=10, nthreads=1,
+                        chunk_size=5000)
+
+    def track_virtual_packets(self, virtual_packet_relative_error):
+        self.runner.run(self.model, no_of_virtual_packets=10, nthreads=1,
+                        chunk_size=5000)
+        return self.runner.virt_packet_nus.size
+
+
+class TimePacketSource:
+    """
+    Spread of the packet frequencies and of the emitted luminosity over
+    seeds for pseudo random and Sobol packet sources.
+    """
+    params = (['random', 'sobol'], [4096, 32768])
+    param_names = ['packet_source', 'no_of_packets']
+    timeout = 600
+    seeds = range(8)
+
+    def setup(self, packet_source, no_of_packets):
+        self.model = make_model(no_of_packets=no_of_packets,
+                                packet_source=packet_source)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, packet_source, no_of_packets):
+        self.runner.run(self.model, no_of_virtual_packets=0, nthreads=1)
+
+    def track_mean_nu_relative_error(self, packet_source, no_of_packets):
+        mean_nus = []
+        for seed in self.seeds:
+            runner = MontecarloRunner(seed)
+            runner.run(self.model, no_of_virtual_packets=0, nthreads=1)
+            mean_nus.append(runner.input_nu.mean())
+        return np.std(mean_nus) / np.mean(mean_nus)
+
+    def track_emitted_luminosity_relative_error(self, packet_source,
+                                                no_of_packets):
+        luminosities = []
+        for seed in self.seeds:
+            runner = MontecarloRunner(seed)
+            runner.run(self.model, no_of_virtual_packets=0, nthreads=1)
+            luminosities.append(runner._emitted_energy_spectrum.sum())
+        return np.std(luminosities) / np.mean(luminosities)
+
+
+class TimeStratifiedPacketSource:
+    """
+    Spread of the emitted luminosity over seeds for the pseudo random and
+    the stratified packet source, with and without oversampling the UV.
+    """
+    params = (['random', 'stratified'], ['none', 'uv'])
+    param_names = ['packet_source', 'oversampled_band']
+    timeout = 600
+    seeds = range(16)
+    bands = {'none': [],
+             'uv': [{'start': 1000 * u.angstrom, 'end': 3500 * u.angstrom,
+                     'oversampling': 4.0}]}
+
+    def setup(self, packet_source, oversampled_band):
+        self.model = make_model(
+            no_of_packets=20000, packet_source=packet_source,
+            packet_source_bands=self.bands[oversampled_band])
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, packet_source, oversampled_band):
+        self.runner.run(self.model, no_of_virtual_packets=0, nthreads=1)
+
+    def _band_luminosity_relative_error(self, start, end):
+        luminosities = []
+        for seed in self.seeds:
+            runner = MontecarloRunner(seed)
+            runner.run(self.model, no_of_virtual_packets=0, nthreads=1)
+            nus = runner.spectrum_frequency[:-1]
+            in_band = ((nus >= start.to('Hz', u.spectral()).value) &
+                       (nus < end.to('Hz', u.spectral()).value))
+            luminosities.append(runner._emitted_energy_spectrum[in_band].sum())
+        return np.std(luminosities) / np.mean(luminosities)
+
+    def track_uv_luminosity_relative_error(self, packet_source,
+                                           oversampled_band):
+        return self._band_luminosity_relative_error(3500 * u.angstrom,
+                                                    1000 * u.angstrom)
+
+    def track_optical_luminosity_relative_error(self, packet_source,
+                                                oversampled_band):
+        return self._band_luminosity_relative_error(7000 * u.angstrom,
+                                                    3500 * u.angstrom)
+
+
+class TimeKernelPacketSource:
+    """
+    Transport with packets generated in NumPy and drawn by the kernel.
+    """
+    params = (['random', 'kernel'], [1, 4])
+    param_names = ['packet_source', 'nthreads']
+    timeout = 600
+
+    def setup(self, packet_source, nthreads):
+        self.model = make_model(no_of_lines=1000, no_of_packets=1000000,
+                                line_interaction_type='scatter',
+                                packet_source=packet_source)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, packet_source, nthreads):
+        self.runner.run(self.model, no_of_virtual_packets=0,
+                        nthreads=nthreads, packet_logging=False,
+                        packet_diagnostics=False)
+
+    def peakmem_run(self, packet_source, nthreads):
+        self.runner.run(self.model, no_of_virtual_packets=0,
+                        nthreads=nthreads, packet_logging=False,
+                        packet_diagnostics=False)
+
+
+class TimeWeightWindows:
+    """
+    Spectral noise per CPU second of the transport with Russian roulette
+    and splitting at the shell boundaries. The figure of merit is the
+    squared relative spread of the emitted spectrum over seeds times the
+    CPU time of a run, lower is better.
+    """
+    params = [1, 4, 16]
+    param_names = ['weight_window_importance_ratio']
+    timeout = 600
+    seeds = range(16)
+
+    def setup(self, weight_window_importance_ratio):
+        self.model = make_model(
+            weight_window_importance_ratio=weight_window_importance_ratio)
+        self.runner = MontecarloRunner(self.model.tardis_config.montecarlo.seed)
+
+    def time_run(self, weight_window_importance_ratio):
+        self.runner.run(self.model, no_of_virtual_packets=0, nthreads=1)
+
+    def track_spectrum_figure_of_merit(self, weight_window_importance_ratio):
+        spectra = []
+        cpu_time = 0.0
+        for seed in self.seeds:
+            runner = MontecarloRunner(seed)
+            start_time = time.process_time()
+            runner.run(self.model, no_of_virtual_packets=0, nthreads=1)
+            cpu_time += time.process_time() - start_time
+            spectra.append(runner._emitted_energy_spectrum)
+        spectra = np.array(spectra)
+        relative_error = (spectra.std(axis=0).sum() /
+                          spectra.mean(axis=0).sum())
+        return relative_error ** 2 * cpu_time / len(self.seeds)
@@ -0,0 +1,36 @@
+"""Benchmarks of the packet sources of the inner boundary."""
+
+import numpy as np
+from astropy import constants as const
+
+from tardis.montecarlo.packet_source import (BlackBodySimpleSource,
+                                            TabulatedSpectrumSource)
+
+
+def make_source(source):
+    if source == 'blackbody':
+        return BlackBodySimpleSource(23111963)
+    # a 10000 K blackbody tabulated in 10000 bins
+    nu_bins = np.linspace(1e13, 5e15, 10001)
+    x = (0.5 * (nu_bins[1:] + nu_bins[:-1]) * const.h.cgs.value /
+         (const.k_B.cgs.value * 10000))
+    return TabulatedSpectrumSource(23111963, nu_bins, x**3 / np.expm1(x))
+
+
+class TimeCreatePackets:
+    """
+    Sampling of the packets of an iteration by the blackbody and the
+    tabulated spectrum source.
+    """
+    params = (['blackbody', 'tabulated'], [10**6, 10**8])
+    param_names = ['source', 'no_of_packets']
+    timeout = 600
+
+    def setup(self, source, no_of_packets):
+        self.source = make_source(source)
+
+    def time_create_packets(self, source, no_of_packets):
+        self.source.create_packets(10000, no_of_packets)
+
+    def peakmem_create_packets(self, source, no_of_packets):
+        self.source.create_packets(10000, no_of_packets)
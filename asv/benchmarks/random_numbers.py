@@ -0,0 +1,21 @@
+"""Benchmarks of the random number generators of the transport kernel."""
+
+from tardis.montecarlo import montecarlo
+
+
+class TimeRandomDoubles:
+    """
+    Throughput of the counter based Philox generator, which the transport
+    seeds for every packet, compared to the Mersenne Twister of randomkit.
+    """
+    params = (['philox', 'mt'],)
+    param_names = ['generator']
+
+    def time_random_doubles(self, generator):
+        montecarlo.random_doubles(10000000, 23111963, generator=generator)
+
+    def time_seed_per_packet(self, generator):
+        # a packet typically draws a few dozen random numbers
+        for packet_id in range(10000):
+            montecarlo.random_doubles(32, 23111963, stream=packet_id,
+                                      generator=generator)
@@ -544,6 +544,29 @@ def parse_spectrum_list2dict(spectrum_list):
 
 
 
+def parse_packet_source_bands(band_list):
+    """
+    Parse the list of [start, end, oversampling] frequency bands of the
+    packet source to a list of dictionaries with the start and end
+    wavelength and the oversampling factor of every band
+    """
+
+    bands = []
+    for band in band_list:
+        if len(band) != 3:
+            raise ValueError('Packet source bands need to be given as '
+                             '[start, end, oversampling], got {0}'.format(band))
+        start, end = parse_spectral_bin(band[0], band[1])
+        oversampling = float(band[2])
+        if oversampling <= 0:
+            raise ValueError('The oversampling of a packet source band needs '
+                             'to be positive, got {0}'.format(oversampling))
+        bands.append({'start': start, 'end': end,
+                      'oversampling': oversampling})
+
+    return bands
+
+
 def parse_convergence_section(convergence_section_dict):
     """
     Parse the convergence section dictionary
@@ -1039,6 +1062,15 @@ class Configuration(ConfigurationNameSpace):
                 parse_convergence_section(
                     montecarlo_section['convergence_strategy']))
 
+        montecarlo_section['packet_source_bands'] = parse_packet_source_bands(
+            montecarlo_section['packet_source_bands'])
+        montecarlo_section['packet_source_spectrum_file'] = (
+            montecarlo_section.get('packet_source_spectrum_file', None))
+        if (montecarlo_section['packet_source'] == 'tabulated' and
+                montecarlo_section['packet_source_spectrum_file'] is None):
+            raise ConfigurationError('The tabulated packet source needs a '
+                                     'packet_source_spectrum_file')
+
         black_body_section = montecarlo_section['black_body_sampling']
         montecarlo_section['black_body_sampling'] = {}
         montecarlo_section['black_body_sampling']['start'] = \
@@ -38,6 +38,20 @@ def test_spectrum_list2_dict():
     assert_almost_equal(spectrum_dict['bins'], 100)
 
 
+def test_packet_source_bands():
+    bands = config_reader.parse_packet_source_bands(
+        [['3500 angstrom', '1000 angstrom', 4],
+         ['6000 angstrom', '1.5e14 Hz', 2]])
+    assert_almost_equal(bands[0]['start'].to(u.angstrom).value, 1000)
+    assert_almost_equal(bands[0]['end'].to(u.angstrom).value, 3500)
+    assert_almost_equal(bands[0]['oversampling'], 4)
+    assert_almost_equal(bands[1]['end'].to(u.angstrom).value,
+                        (1.5e14 * u.Hz).to(u.angstrom, u.spectral()).value)
+    with pytest.raises(ValueError):
+        config_reader.parse_packet_source_bands(
+            [['1000 angstrom', '3500 angstrom', 0]])
+
+
 def test_convergence_section_parser():
     test_convergence_section = {'type': 'damped',
                                 'lock_t_inner_cyles': 1,
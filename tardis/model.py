@@ -187,7 +187,7 @@ class Radial1DModel(object):
         elif radiative_rates_type == 'detailed':
             logger.info('Calculating J_blues for radiate_rates_type=detailed')
 
-            self.j_blues = pd.DataFrame(self.j_blue_estimators.transpose() * self.j_blues_norm_factor.value,
+            self.j_blues = pd.DataFrame(self.j_blue_estimators * self.j_blues_norm_factor.value,
                                         index=self.atom_data.lines.index, columns=np.arange(len(self.t_rads)))
             for i in xrange(self.tardis_config.structure.no_of_shells):
                 zero_j_blues = self.j_blues[i] == 0.0
@@ -216,14 +216,8 @@ class Radial1DModel(object):
         old_t_rads = self.t_rads.copy()
         old_ws = self.ws.copy()
         old_t_inner = self.t_inner
-        luminosity_wavelength_filter = (self.montecarlo_nu > self.tardis_config.supernova.luminosity_nu_start) & \
-                            (self.montecarlo_nu < self.tardis_config.supernova.luminosity_nu_end)
-        emitted_filter = self.montecarlo_luminosity.value >= 0
-        emitted_luminosity = np.sum(self.montecarlo_luminosity.value[emitted_filter & luminosity_wavelength_filter]) \
-                             * self.montecarlo_luminosity.unit
-
-        absorbed_luminosity = -np.sum(self.montecarlo_luminosity.value[~emitted_filter & luminosity_wavelength_filter]) \
-                              * self.montecarlo_luminosity.unit
+        emitted_luminosity = self.runner.emitted_luminosity
+        absorbed_luminosity = self.runner.reabsorbed_luminosity
         updated_t_inner = self.t_inner \
                           * (emitted_luminosity / self.tardis_config.supernova.luminosity_requested).to(1).value \
                             ** convergence_section.t_inner_update_exponent
@@ -311,39 +305,30 @@ class Radial1DModel(object):
 
         self.montecarlo_virtual_luminosity = np.zeros_like(self.spectrum.frequency.value)
 
-        self.runner.run(self, no_of_virtual_packets=no_of_virtual_packets,
-                        nthreads=self.tardis_config.montecarlo.nthreads) #self = model
-
+        packet_diagnostics = self.tardis_config.montecarlo.packet_diagnostics
+        packet_diagnostics = (packet_diagnostics == 'all' or
+                              (packet_diagnostics == 'final' and
+                               self.iterations_remaining <= 1))
 
-        (montecarlo_nu, montecarlo_energies, self.j_estimators,
-         self.nubar_estimators, last_line_interaction_in_id,
-         last_line_interaction_out_id, self.last_interaction_type,
-         self.last_line_interaction_shell_id) = self.runner.legacy_return()
+        self.runner.run(self, no_of_virtual_packets=no_of_virtual_packets,
+                        nthreads=self.tardis_config.montecarlo.nthreads,
+                        chunk_size=self.tardis_config.montecarlo.chunk_size,
+                        packet_diagnostics=packet_diagnostics)
 
-        if np.sum(montecarlo_energies < 0) == len(montecarlo_energies):
-            logger.critical("No r-packet escaped through the outer boundary.")
+        self.j_estimators = self.runner.j_estimator
+        self.nubar_estimators = self.runner.nu_bar_estimator
+        self.j_blue_estimators = self.runner.j_blue_estimator
 
         self.montecarlo_nu = self.runner.output_nu
         self.montecarlo_luminosity = self.runner.packet_luminosity
 
+        if not np.any(self.runner.montecarlo_emitted_luminosity.value > 0):
+            logger.critical("No r-packet escaped through the outer boundary.")
 
-
-        montecarlo_reabsorbed_luminosity = np.histogram(
-            self.runner.reabsorbed_packet_nu,
-            weights=self.runner.reabsorbed_packet_luminosity,
-            bins=self.tardis_config.spectrum.frequency.value)[0] * u.erg / u.s
-
-
-
-        montecarlo_emitted_luminosity = np.histogram(
-            self.runner.emitted_packet_nu,
-            weights=self.runner.emitted_packet_luminosity,
-            bins=self.tardis_config.spectrum.frequency.value)[0] * u.erg / u.s
-
-
-
-        self.spectrum.update_luminosity(montecarlo_emitted_luminosity)
-        self.spectrum_reabsorbed.update_luminosity(montecarlo_reabsorbed_luminosity)
+        self.spectrum.update_luminosity(
+            self.runner.montecarlo_emitted_luminosity)
+        self.spectrum_reabsorbed.update_luminosity(
+            self.runner.montecarlo_reabsorbed_luminosity)
 
 
         if no_of_virtual_packets > 0:
@@ -353,12 +338,24 @@ class Radial1DModel(object):
 
 
 
-        self.last_line_interaction_in_id = self.atom_data.lines_index.index.values[last_line_interaction_in_id]
-        self.last_line_interaction_in_id = self.last_line_interaction_in_id[last_line_interaction_in_id != -1]
-        self.last_line_interaction_out_id = self.atom_data.lines_index.index.values[last_line_interaction_out_id]
-        self.last_line_interaction_out_id = self.last_line_interaction_out_id[last_line_interaction_out_id != -1]
-        self.last_line_interaction_angstrom = self.montecarlo_nu[last_line_interaction_in_id != -1].to('angstrom',
-                                                                                                       u.spectral())
+        if packet_diagnostics:
+            last_line_interaction_in_id = self.runner.last_line_interaction_in_id
+            last_line_interaction_out_id = self.runner.last_line_interaction_out_id
+            self.last_interaction_type = self.runner.last_interaction_type
+            self.last_line_interaction_shell_id = self.runner.last_line_interaction_shell_id
+
+            self.last_line_interaction_in_id = self.atom_data.lines_index.index.values[last_line_interaction_in_id]
+            self.last_line_interaction_in_id = self.last_line_interaction_in_id[last_line_interaction_in_id != -1]
+            self.last_line_interaction_out_id = self.atom_data.lines_index.index.values[last_line_interaction_out_id]
+            self.last_line_interaction_out_id = self.last_line_interaction_out_id[last_line_interaction_out_id != -1]
+            self.last_line_interaction_angstrom = self.montecarlo_nu[last_line_interaction_in_id != -1].to('angstrom',
+                                                                                                           u.spectral())
+        else:
+            self.last_interaction_type = None
+            self.last_line_interaction_shell_id = None
+            self.last_line_interaction_in_id = None
+            self.last_line_interaction_out_id = None
+            self.last_line_interaction_angstrom = None
 
 
         self.iterations_executed += 1
@@ -462,6 +459,11 @@ class Radial1DModel(object):
 
         for key in include_from_model_in_hdf5:
             if include_from_model_in_hdf5[key] is None:
+                if getattr(self, key) is None:
+                    # e.g. the last interactions without packet_diagnostics
+                    logger.info('Not writing %s, it was not stored',
+                                os.path.join(path, key))
+                    continue
                 _save_model_property(getattr(self, key), key, path, hdf_store)
             elif callable(include_from_model_in_hdf5[key]):
                 include_from_model_in_hdf5[key](key, path, hdf_store)
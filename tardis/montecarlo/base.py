@@ -1,12 +1,17 @@
+import logging
+
 from astropy import units as u, constants as const
 
 from scipy.special import zeta
 
 from tardis.montecarlo import montecarlo, packet_source
+from tardis.montecarlo.macro_atom import calculate_emission_probabilities
 
 
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
 class MontecarloRunner(object):
     """
     This class is designed as an interface between the Python part and the
@@ -20,38 +25,290 @@ class MontecarloRunner(object):
     t_rad_estimator_constant = ((np.pi**4 / (15 * 24 * zeta(5, 1))) *
                                 (const.h / const.k_B)).cgs.value
 
+    virtual_packet_properties = (
+        'virt_packet_nus', 'virt_packet_energies',
+        'virt_packet_last_interaction_in_nu',
+        'virt_packet_last_interaction_type',
+        'virt_packet_last_line_interaction_in_id',
+        'virt_packet_last_line_interaction_out_id')
 
-    def __init__(self, seed):
-        self.packet_source = packet_source.BlackBodySimpleSource(seed)
 
+    def __init__(self, seed, source=None):
+        self.seed = seed
+        # a source passed here, e.g. a TabulatedSpectrumSource, is used
+        # instead of the one of montecarlo.packet_source
+        self._packet_source_from_config = source is None
+        self._packet_source_spectrum_file = None
+        if source is None:
+            source = packet_source.BlackBodySimpleSource(seed)
+        self.packet_source = source
+        self.iteration = -1
+        self.thread_packet_counts = np.zeros(0, dtype=np.int64)
+        self.thread_busy_times = np.zeros(0, dtype=np.float64)
 
 
-    def _initialize_montecarlo_arrays(self, model):
+
+    def _initialize_montecarlo_arrays(self, no_of_packets):
         """
-        Initialize the output arrays of the montecarlo simulation.
+        Initialize the per packet output arrays of the montecarlo simulation.
+        The frequencies and energies of the packets are only stored if
+        `packet_logging` is set, their last interactions only if
+        `packet_diagnostics` is set.
+
+        Parameters
+        ----------
+
+        no_of_packets: ~int
+            number of packets in the run
+        """
+
+        if self.packet_logging:
+            self._output_nu = np.ones(no_of_packets, dtype=np.float64) * -99.0
+            self._output_energy = np.ones(no_of_packets,
+                                          dtype=np.float64) * -99.0
+        else:
+            self._output_nu = None
+            self._output_energy = None
+        if self.packet_diagnostics:
+            self.last_line_interaction_in_id = -1 * np.ones(no_of_packets, dtype=np.int64)
+            self.last_line_interaction_out_id = -1 * np.ones(no_of_packets, dtype=np.int64)
+            self.last_line_interaction_shell_id = -1 * np.ones(no_of_packets, dtype=np.int64)
+            self.last_interaction_type = -1 * np.ones(no_of_packets, dtype=np.int64)
+            self.last_interaction_in_nu = np.zeros(no_of_packets, dtype=np.float64)
+        else:
+            self.last_line_interaction_in_id = None
+            self.last_line_interaction_out_id = None
+            self.last_line_interaction_shell_id = None
+            self.last_interaction_type = None
+            self.last_interaction_in_nu = None
+
+    def _initialize_active_lines(self, model):
+        """
+        Select the lines the packets are transported through. If
+        `active_line_tau_threshold` is not negative, lines whose
+        tau_sobolev does not exceed it in any shell are left out. Such lines
+        can still be emitted by macro atoms.
 
         Parameters
         ----------
 
         model: ~Radial1DModel
         """
+        line_list_nu = model.atom_data.lines.nu.values
+        tau_threshold = model.tardis_config.montecarlo.active_line_tau_threshold
+        if tau_threshold < 0 or line_list_nu.size == 0:
+            self.active_line_ids = None
+            self.next_active_line_ids = None
+            self.line_list_nu = line_list_nu
+            return
+        max_tau_sobolevs = model.plasma_array.tau_sobolevs.values.max(axis=1)
+        active_lines = max_tau_sobolevs > tau_threshold
+        # the transport needs at least one line
+        active_lines[np.argmax(max_tau_sobolevs)] = True
+        self.active_line_ids = np.flatnonzero(active_lines).astype(np.int64)
+        # first active line after every line of the full line list
+        self.next_active_line_ids = np.searchsorted(
+            self.active_line_ids, np.arange(line_list_nu.size),
+            side='right').astype(np.int64)
+        self.line_list_nu = line_list_nu[self.active_line_ids]
+        logger.info('Transporting %d of %d lines with tau_sobolev above %g',
+                    self.active_line_ids.size, line_list_nu.size,
+                    tau_threshold)
+
+    def _initialize_estimator_arrays(self, model):
+        """
+        Initialize the estimators, which are accumulated over all chunks.
+        The j_blue estimator is only needed for detailed radiative rates, it
+        is None and not accumulated by the transport otherwise. The transport
+        accumulates it for the active lines only.
 
-        no_of_packets = model.current_no_of_packets
+        Parameters
+        ----------
+
+        model: ~Radial1DModel
+        """
         no_of_shells = model.tardis_config.structure.no_of_shells
-        self._output_nu = np.ones(no_of_packets, dtype=np.float64) * -99.0
-        self._output_energy = np.ones(no_of_packets, dtype=np.float64) * -99.0
-        self.last_line_interaction_in_id = -1 * np.ones(no_of_packets, dtype=np.int64)
-        self.last_line_interaction_out_id = -1 * np.ones(no_of_packets, dtype=np.int64)
-        self.last_line_interaction_shell_id = -1 * np.ones(no_of_packets, dtype=np.int64)
-        self.last_interaction_type = -1 * np.ones(no_of_packets, dtype=np.int64)
-        self.last_interaction_in_nu = np.zeros(no_of_packets, dtype=np.float64)
-
-        #Estimators
+
         self.j_estimator = np.zeros(no_of_shells, dtype=np.float64)
         self.nu_bar_estimator = np.zeros(no_of_shells, dtype=np.float64)
-        self.j_blue_estimator = np.zeros_like(
-            model.plasma_array.tau_sobolevs.values)
+        no_of_lines = self.line_list_nu.size
+        if model.tardis_config.plasma.radiative_rates_type != 'detailed':
+            self.j_blue_estimator = None
+        elif model.tardis_config.montecarlo.shell_major_line_lists:
+            # (lines x shells) view of shell contiguous memory
+            self.j_blue_estimator = np.zeros((no_of_shells, no_of_lines)).T
+        else:
+            self.j_blue_estimator = np.zeros((no_of_lines, no_of_shells))
+        self._active_j_blue_estimator = self.j_blue_estimator
+        if self.active_line_ids is not None and self.j_blue_estimator is not None:
+            self.j_blue_estimator = np.zeros(
+                model.plasma_array.tau_sobolevs.values.shape)
+
+    def _initialize_plasma_arrays(self, model):
+        """
+        Provide the inverse electron densities and the tau_sobolevs of the
+        active lines in the memory layout used by the transport, which is a
+        shell contiguous copy if `shell_major_line_lists` is set.
+
+        Parameters
+        ----------
+
+        model: ~Radial1DModel
+        """
+        self.inverse_electron_densities = (
+            1.0 / model.plasma_array.electron_densities.values)
+        self.shell_major_line_lists = (
+            model.tardis_config.montecarlo.shell_major_line_lists)
+        tau_sobolevs = model.plasma_array.tau_sobolevs.values
+        if self.active_line_ids is not None:
+            tau_sobolevs = tau_sobolevs[self.active_line_ids]
+        if self.shell_major_line_lists:
+            self.tau_sobolevs = np.ascontiguousarray(tau_sobolevs.T)
+        else:
+            self.tau_sobolevs = tau_sobolevs
+
+    def _initialize_shell_line_lists(self, model):
+        """
+        Build a compressed line list for every shell if
+        `shell_line_tau_threshold` is not negative. The lines of shell i are
+        the transported lines whose tau_sobolev in shell i exceeds the
+        threshold, their frequencies, ids in the line list of the transport
+        and tau_sobolevs are stored from `shell_line_offsets[i]` to
+        `shell_line_offsets[i + 1]`.
+
+        Parameters
+        ----------
+
+        model: ~Radial1DModel
+        """
+        tau_threshold = model.tardis_config.montecarlo.shell_line_tau_threshold
+        if tau_threshold < 0:
+            self.shell_line_offsets = None
+            self.shell_line_list_nu = None
+            self.shell_line_ids = None
+            self.shell_line_tau_sobolevs = None
+            return
+        tau_sobolevs = model.plasma_array.tau_sobolevs.values
+        if self.active_line_ids is not None:
+            tau_sobolevs = tau_sobolevs[self.active_line_ids]
+        no_of_shells = tau_sobolevs.shape[1]
+        # ordered by shell and by decreasing frequency within a shell
+        shell_ids, line_ids = np.nonzero(tau_sobolevs.T > tau_threshold)
+        self.shell_line_offsets = np.zeros(no_of_shells + 1, dtype=np.int64)
+        np.cumsum(np.bincount(shell_ids, minlength=no_of_shells),
+                  out=self.shell_line_offsets[1:])
+        self.shell_line_list_nu = self.line_list_nu[line_ids]
+        self.shell_line_ids = line_ids.astype(np.int64)
+        self.shell_line_tau_sobolevs = tau_sobolevs[line_ids, shell_ids]
+        logger.info('Transporting %.1f of %d lines per shell with tau_sobolev '
+                    'above %g', line_ids.size / float(no_of_shells),
+                    self.line_list_nu.size, tau_threshold)
+
+    def _initialize_virtual_packet_tables(self, model):
+        """
+        Sum up the tau_sobolevs of the transported lines of every shell if
+        virtual packets use the `table` engine. Row i of
+        `cumulative_tau_sobolevs` holds the sum over the lines before line j
+        of shell i in column j, so it has one column more than there are
+        lines.
+
+        Parameters
+        ----------
+
+        model: ~Radial1DModel
+        """
+        if model.tardis_config.montecarlo.virtual_packet_engine != 'table':
+            self.cumulative_tau_sobolevs = None
+            return
+        tau_sobolevs = model.plasma_array.tau_sobolevs.values
+        if self.active_line_ids is not None:
+            tau_sobolevs = tau_sobolevs[self.active_line_ids]
+        no_of_lines, no_of_shells = tau_sobolevs.shape
+        self.cumulative_tau_sobolevs = np.zeros((no_of_shells,
+                                                 no_of_lines + 1))
+        np.cumsum(tau_sobolevs.T, axis=1,
+                  out=self.cumulative_tau_sobolevs[:, 1:])
+
+    def _initialize_spectrum_arrays(self, model):
+        """
+        Initialize the emitted and reabsorbed energy spectra as well as the
+        energies in the luminosity window, which the transport accumulates
+        over all chunks.
+
+        Parameters
+        ----------
+
+        model: ~Radial1DModel
+        """
+        self.spectrum_frequency = model.tardis_config.spectrum.frequency.value
+        self.luminosity_nu_start = (
+            model.tardis_config.supernova.luminosity_nu_start.to(
+                'Hz', u.spectral()).value)
+        self.luminosity_nu_end = (
+            model.tardis_config.supernova.luminosity_nu_end.to(
+                'Hz', u.spectral()).value)
+        no_of_bins = self.spectrum_frequency.size - 1
+        self._emitted_energy_spectrum = np.zeros(no_of_bins)
+        self._reabsorbed_energy_spectrum = np.zeros(no_of_bins)
+        # emitted and reabsorbed energy in the luminosity window
+        self._luminosity_window_energies = np.zeros(2)
+
+    def _initialize_virtual_packet_counts(self, model):
+        """
+        Prepare the number of virtual packets that a packet spawns in every
+        bin of the virtual spectrum if `virtual_packet_relative_error` is
+        positive. All bins start with `no_of_virtual_packets` and are adapted
+        after every chunk by `_update_virtual_packet_counts`.
+
+        Parameters
+        ----------
 
+        model: ~Radial1DModel
+        """
+        self.virtual_packet_relative_error = (
+            model.tardis_config.montecarlo.virtual_packet_relative_error)
+        self.virtual_spectrum_relative_errors = None
+        if (self.virtual_packet_relative_error <= 0 or
+                self.no_of_virtual_packets <= 0):
+            self._virtual_spectrum_squared = None
+            self.virtual_packet_counts = None
+            return
+        no_of_bins = model.montecarlo_virtual_luminosity.size
+        # sum of the squared energies of the virtual packets in every bin
+        self._virtual_spectrum_squared = np.zeros(no_of_bins)
+        self.virtual_packet_counts = np.empty(no_of_bins, dtype=np.int64)
+        self.virtual_packet_counts.fill(self.no_of_virtual_packets)
+
+    def _update_virtual_packet_counts(self, model):
+        """
+        Estimate the relative error of every bin of the virtual spectrum from
+        the virtual packets transported so far. Packets in bins above
+        `virtual_packet_relative_error` spawn `no_of_virtual_packets` in the
+        next chunk. The variance of a bin falls with the number of its virtual
+        packets, so the other bins get fewer in proportion to the squared
+        ratio of their error to the target, but at least one.
+
+        Parameters
+        ----------
+
+        model: ~Radial1DModel
+        """
+        if self.virtual_packet_counts is None:
+            return
+        virtual_spectrum = model.montecarlo_virtual_luminosity
+        recorded = virtual_spectrum > 0
+        self.virtual_spectrum_relative_errors = np.zeros_like(
+            virtual_spectrum)
+        self.virtual_spectrum_relative_errors[recorded] = (
+            np.sqrt(self._virtual_spectrum_squared[recorded]) /
+            virtual_spectrum[recorded])
+        counts = np.ceil(self.no_of_virtual_packets *
+                         (self.virtual_spectrum_relative_errors /
+                          self.virtual_packet_relative_error) ** 2)
+        # nothing is known about bins without virtual packets
+        counts[~recorded] = self.no_of_virtual_packets
+        self.virtual_packet_counts[:] = np.clip(
+            counts, 1, self.no_of_virtual_packets)
 
     def _initialize_geometry_arrays(self, structure):
         """
@@ -66,35 +323,296 @@ class MontecarloRunner(object):
         self.r_outer_cgs = structure.r_outer.to('cm').value
         self.v_inner_cgs = structure.v_inner.to('cm/s').value
 
+    def _initialize_line_search_index(self, model):
+        """
+        Build the index that is used to find the first line of the packets.
+
+        Parameters
+        ----------
+
+        model: ~Radial1DModel
+        """
+        line_list_nu = self.line_list_nu
+        no_of_buckets = model.tardis_config.montecarlo.line_search_buckets
+        if no_of_buckets < 0:
+            no_of_buckets = line_list_nu.size
+        if no_of_buckets == 0 or line_list_nu.size == 0:
+            self.line_search_index = None
+        else:
+            self.line_search_index = montecarlo.make_line_search_index(
+                line_list_nu, no_of_buckets)
+
+    def _initialize_macro_atom_tables(self, model):
+        """
+        Prepare the transition probabilities in the memory layout used by the
+        transport, the upper macro atom level of every active line, the block
+        references and, if requested, the cumulative
+        transition probabilities and the emission probabilities that are used
+        to sample the macro atom transitions.
+
+        Parameters
+        ----------
+
+        model: ~Radial1DModel
+        """
+        self.transition_probabilities = None
+        self.line2macro_level_upper = None
+        self.macro_block_references = None
+        self.cumulative_transition_probabilities = None
+        self.emission_probabilities = None
+        if model.tardis_config.plasma.line_interaction_type == 'scatter':
+            return
+        self.line2macro_level_upper = (
+            model.atom_data.lines_upper2macro_reference_idx)
+        if self.active_line_ids is not None:
+            self.line2macro_level_upper = self.line2macro_level_upper[
+                self.active_line_ids]
+        self.macro_block_references = np.hstack((
+            model.atom_data.macro_atom_references['block_references'].values,
+            model.transition_probabilities.values.shape[0])).astype(np.int64)
+        if model.tardis_config.montecarlo.macro_atom_sampling == 'linear':
+            if self.shell_major_line_lists:
+                self.transition_probabilities = np.ascontiguousarray(
+                    model.transition_probabilities.values.T)
+            else:
+                self.transition_probabilities = (
+                    model.transition_probabilities.values)
+        else:
+            self.cumulative_transition_probabilities = (
+                montecarlo.make_cumulative_transition_probabilities(
+                    np.ascontiguousarray(model.transition_probabilities.values),
+                    self.macro_block_references))
+        montecarlo_config = model.tardis_config.montecarlo
+        if (model.tardis_config.plasma.line_interaction_type == 'macroatom' and
+                montecarlo_config.macro_atom_emission_probabilities):
+            macro_atom_data = model.atom_data.macro_atom_data
+            self.emission_probabilities = calculate_emission_probabilities(
+                model.transition_probabilities.values,
+                self.macro_block_references,
+                macro_atom_data['transition_type'].values,
+                macro_atom_data['destination_level_idx'].values,
+                macro_atom_data['lines_idx'].values,
+                montecarlo_config.macro_atom_emission_memory_limit.to(
+                    'byte').value)
+
+    def _initialize_packet_source(self, model):
+        """
+        Switch to the packet source of `montecarlo.packet_source` unless the
+        runner was created with its own source. A source is kept over the
+        runs, so that a Sobol source continues its sequence and the random
+        numbers are not reseeded in the next iteration.
+        """
+        if not self._packet_source_from_config:
+            return
+        montecarlo_config = model.tardis_config.montecarlo
+        if montecarlo_config.packet_source == 'kernel':
+            # the transport draws the packets itself
+            self.packet_source = None
+            return
+        if montecarlo_config.packet_source == 'tabulated':
+            spectrum_file = montecarlo_config.packet_source_spectrum_file
+            if (type(self.packet_source) is not
+                    packet_source.TabulatedSpectrumSource or
+                    self._packet_source_spectrum_file != spectrum_file):
+                self.packet_source = (
+                    packet_source.TabulatedSpectrumSource.from_ascii(
+                        self.seed, spectrum_file))
+                self._packet_source_spectrum_file = spectrum_file
+            return
+        if montecarlo_config.packet_source == 'sobol':
+            packet_source_class = packet_source.SobolBlackBodySource
+        elif montecarlo_config.packet_source == 'stratified':
+            packet_source_class = packet_source.StratifiedBlackBodySource
+        else:
+            packet_source_class = packet_source.BlackBodySimpleSource
+        if type(self.packet_source) is not packet_source_class:
+            self.packet_source = packet_source_class(self.seed)
+        if packet_source_class is packet_source.StratifiedBlackBodySource:
+            self.packet_source.bands = [
+                (band['end'].to('Hz', u.spectral()).value,
+                 band['start'].to('Hz', u.spectral()).value,
+                 band['oversampling'])
+                for band in montecarlo_config.packet_source_bands]
+
+    def _initialize_weight_windows(self, model):
+        """
+        Weight windows of the real packet energies for Russian roulette and
+        splitting. The window center falls geometrically from the mean packet
+        energy in the innermost shell to the mean packet energy over
+        `weight_window_importance_ratio` in the outermost shell, so that
+        packets that move out towards the photosphere, which form the
+        spectrum, are split and packets that diffuse back into the inner
+        shells are culled.
+        """
+        importance_ratio = (
+            model.tardis_config.montecarlo.weight_window_importance_ratio)
+        no_of_shells = model.tardis_config.structure.no_of_shells
+        if importance_ratio <= 1 or no_of_shells < 2:
+            self.weight_window_energies = None
+            return
+        exponents = np.arange(no_of_shells) / float(no_of_shells - 1)
+        self.weight_window_energies = (importance_ratio ** -exponents /
+                                       self.no_of_packets)
+
     def _initialize_packets(self, T, no_of_packets):
+        self.input_no_of_packets = no_of_packets
+        if self.packet_source is None:
+            # every packet is drawn from its own random number stream in the
+            # transport, so no packet arrays are needed
+            self.input_nu = self.input_mu = self.input_energy = None
+            self.input_nu_unit = (const.k_B.cgs.value * T /
+                                  const.h.cgs.value)
+            self.input_packet_energy = 1.0 / self.no_of_packets
+            return
         nus, mus, energies = self.packet_source.create_packets(T, no_of_packets)
         self.input_nu = nus
         self.input_mu = mus
-        self.input_energy = energies
-
+        # the packets of all chunks share the energy of the iteration
+        self.input_energy = energies * (float(no_of_packets) /
+                                        self.no_of_packets)
 
-    def run(self, model, no_of_virtual_packets, nthreads=1):
+    def _update_j_blue_estimator(self):
+        """
+        Copy the j_blue estimator of the active lines into the j_blue
+        estimator of the full line list.
+        """
+        if self._active_j_blue_estimator is not self.j_blue_estimator:
+            self.j_blue_estimator[self.active_line_ids] = (
+                self._active_j_blue_estimator)
+
+    def _collect_virtual_packets(self):
+        for name in self.virtual_packet_properties:
+            self._virtual_packet_chunks[name].append(getattr(self, name))
+
+    def _concatenate_virtual_packets(self):
+        for name in self.virtual_packet_properties:
+            chunks = self._virtual_packet_chunks[name]
+            if len(chunks) > 1:
+                setattr(self, name, np.concatenate(chunks))
+
+    def run(self, model, no_of_virtual_packets, nthreads=1, chunk_size=None,
+            callback=None, packet_logging=True, packet_diagnostics=True):
         """
         Running the TARDIS simulation
 
+        The packets can be generated and transported in chunks. Estimators
+        and spectra are accumulated over the chunks and the per packet output
+        arrays (e.g. `output_nu`, `last_interaction_type`) hold the packets
+        of all chunks, in the order of their ids. The memory of the packets
+        that are transported therefore scales with the chunk size, the output
+        arrays only scale with it if `packet_logging` and
+        `packet_diagnostics` are switched off. Packets of chunks that were not
+        transported keep an output frequency and energy of -99 and last
+        interactions of -1.
+
+        The emitted and reabsorbed spectra are binned by the transport, the
+        frequencies, energies and last interactions of the single packets are
+        only needed for diagnostics.
+
         Parameters
         ----------
 
         :param model:
         :param no_of_virtual_packets:
         :param nthreads:
+        :param chunk_size: number of packets per chunk, all packets are
+            transported in a single chunk if None or negative
+        :param callback: called with the runner after each chunk, the
+            transport stops if it returns False and can be continued with
+            `resume`
+        :param packet_logging: store the frequency and energy of every
+            packet in `output_nu` and `output_energy`
+        :param packet_diagnostics: store the last interaction of every packet
+            in `last_interaction_type`, `last_interaction_in_nu` and the
+            `last_line_interaction_*` arrays, which are None otherwise
         :return:
         """
         self.time_of_simulation = model.time_of_simulation
         self.volume = model.tardis_config.structure.volumes
-        self._initialize_montecarlo_arrays(model)
+        self.no_of_packets = model.current_no_of_packets
+        if chunk_size is None or chunk_size <= 0:
+            chunk_size = self.no_of_packets
+        self.chunk_size = chunk_size
+        self.iteration += 1
+        self.no_of_packets_transported = 0
+        self.no_of_chunks_transported = 0
+        self.no_of_virtual_packets = no_of_virtual_packets
+        self.nthreads = max(nthreads, 1)
+        self.packet_logging = packet_logging
+        self.packet_diagnostics = packet_diagnostics
+        # packets and wall clock seconds in the packet loop of every thread
+        self.thread_packet_counts = np.zeros(self.nthreads, dtype=np.int64)
+        self.thread_busy_times = np.zeros(self.nthreads, dtype=np.float64)
+        # lines passed by the real packets of every thread
+        self.thread_line_event_counts = np.zeros(self.nthreads,
+                                                 dtype=np.int64)
+        self._virtual_packet_chunks = dict(
+            (name, []) for name in self.virtual_packet_properties)
+        self._initialize_montecarlo_arrays(self.no_of_packets)
+        self._initialize_packet_source(model)
+        self._initialize_active_lines(model)
+        self._initialize_estimator_arrays(model)
+        self._initialize_spectrum_arrays(model)
+        self._initialize_virtual_packet_counts(model)
         self._initialize_geometry_arrays(model.tardis_config.structure)
+        self._initialize_plasma_arrays(model)
+        self._initialize_shell_line_lists(model)
+        self._initialize_virtual_packet_tables(model)
+        self._initialize_line_search_index(model)
+        self._initialize_macro_atom_tables(model)
+        self._initialize_weight_windows(model)
+
+        self.resume(model, callback=callback)
+
+    def resume(self, model, callback=None):
+        """
+        Transport the remaining chunks of a run that was stopped by its
+        callback.
+
+        Parameters
+        ----------
+
+        :param model:
+        :param callback: called with the runner after each chunk, the
+            transport stops if it returns False
+        :return:
+        """
+        while not self.finished:
+            no_of_packets = min(self.chunk_size, self.no_of_packets -
+                                self.no_of_packets_transported)
+            self._initialize_packets(model.t_inner.value, no_of_packets)
+            # the kernel draws the random numbers of every packet from its
+            # own stream, so the results do not depend on the number of
+            # threads. With the kernel packet source they do not depend on
+            # the chunk size either, the other packet sources draw every
+            # chunk on their own, so different chunk sizes only agree
+            # statistically.
+            montecarlo.montecarlo_radial1d(
+                model, self, virtual_packet_flag=self.no_of_virtual_packets,
+                nthreads=self.nthreads, seed=self.seed,
+                iteration=self.iteration,
+                first_packet_id=self.no_of_packets_transported)
+            self._collect_virtual_packets()
+            self._update_j_blue_estimator()
+            self._update_virtual_packet_counts(model)
+
+            self.no_of_packets_transported += no_of_packets
+            self.no_of_chunks_transported += 1
+            if self.chunk_size < self.no_of_packets:
+                logger.info('Transported %d of %d packets',
+                            self.no_of_packets_transported,
+                            self.no_of_packets)
+            if callback is not None and callback(self) is False:
+                logger.warning('Transport stopped after %d of %d packets',
+                               self.no_of_packets_transported,
+                               self.no_of_packets)
+                break
+
+        self._concatenate_virtual_packets()
 
-        self._initialize_packets(model.t_inner.value,
-                                 model.current_no_of_packets)
-        montecarlo.montecarlo_radial1d(
-            model, self, virtual_packet_flag=no_of_virtual_packets,
-            nthreads=nthreads)
+    @property
+    def finished(self):
+        return self.no_of_packets_transported >= self.no_of_packets
 
     def legacy_return(self):
         return (self.output_nu, self.output_energy,
@@ -108,21 +626,66 @@ class MontecarloRunner(object):
         return ['scatter', 'downbranch', 'macroatom'].index(
             line_interaction_type)
 
+    def get_thread_schedule_id(self, thread_schedule):
+        return ['static', 'dynamic', 'guided'].index(thread_schedule)
+
+    @property
+    def thread_load_imbalance(self):
+        """
+        Longest busy time of a thread divided by the mean busy time of the
+        threads that transported packets, 1 for perfectly balanced threads.
+        Without OpenMP all packets are counted for the first thread. NaN if
+        no thread transported packets yet.
+        """
+        busy_times = self.thread_busy_times[self.thread_packet_counts > 0]
+        if busy_times.size == 0 or busy_times.mean() == 0:
+            return np.nan
+        return busy_times.max() / busy_times.mean()
+
+    @property
+    def line_events_per_packet(self):
+        """
+        Mean number of lines a real packet passed through, with or without
+        an interaction, in the transported chunks of the current run.
+        """
+        return (self.thread_line_event_counts.sum() /
+                float(self.no_of_packets_transported))
+
 
     @property
     def output_nu(self):
+        """
+        Frequencies of the packets, None without `packet_logging`
+        """
+        if self._output_nu is None:
+            return None
         return u.Quantity(self._output_nu, u.Hz)
 
     @property
     def output_energy(self):
+        """
+        Energies of the packets, None without `packet_logging`
+        """
+        if self._output_energy is None:
+            return None
         return u.Quantity(self._output_energy, u.erg)
 
+    def _check_packet_logging(self):
+        if self._output_energy is None:
+            raise ValueError('The packets were not logged in this run, the '
+                             'binned spectra (e.g. '
+                             'montecarlo_emitted_luminosity) are available '
+                             'instead. Run with packet_logging=True to log '
+                             'them.')
+
     @property
     def packet_luminosity(self):
+        self._check_packet_logging()
         return self.output_energy / self.time_of_simulation
 
     @property
     def emitted_packet_mask(self):
+        self._check_packet_logging()
         return self.output_energy >=0
 
     @property
@@ -146,6 +709,34 @@ class MontecarloRunner(object):
     def reabsorbed_packet_luminosity(self):
         return -self.packet_luminosity[~self.emitted_packet_mask]
 
+    @property
+    def montecarlo_emitted_luminosity(self):
+        return u.Quantity(self._emitted_energy_spectrum,
+                          u.erg) / self.time_of_simulation
+
+    @property
+    def montecarlo_reabsorbed_luminosity(self):
+        return u.Quantity(self._reabsorbed_energy_spectrum,
+                          u.erg) / self.time_of_simulation
+
+    @property
+    def emitted_luminosity(self):
+        """
+        Luminosity of the emitted packets between luminosity_nu_start and
+        luminosity_nu_end
+        """
+        return u.Quantity(self._luminosity_window_energies[0],
+                          u.erg) / self.time_of_simulation
+
+    @property
+    def reabsorbed_luminosity(self):
+        """
+        Luminosity of the reabsorbed packets between luminosity_nu_start and
+        luminosity_nu_end
+        """
+        return u.Quantity(self._luminosity_window_energies[1],
+                          u.erg) / self.time_of_simulation
+
     def calculate_radiationfield_properties(self):
         """
         Calculate an updated radiation field from the :math:`\\bar{nu}_\\textrm{estimator}` and :math:`\\J_\\textrm{estimator}`
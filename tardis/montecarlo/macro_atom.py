@@ -0,0 +1,155 @@
+import logging
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+logger = logging.getLogger(__name__)
+
+
+def calculate_emission_probabilities(transition_probabilities,
+                                     block_references, transition_type,
+                                     destination_level_id, transition_line_id,
+                                     memory_limit):
+    """
+    Solve the absorbing Markov chain of the macro atom in every shell. For
+    every level the probabilities to finally leave the macro atom through
+    each of the emission transitions are calculated, so that the transport
+    kernel can choose the emitted line in a single step instead of following
+    the internal jumps.
+
+    The levels are split into the groups that are connected by internal
+    jumps (usually one group per ion). Groups whose tables do not fit into
+    the memory limit, starting with the largest, are left out and sampled
+    with the random walk.
+
+    Parameters
+    ----------
+    transition_probabilities : `numpy.ndarray`
+        (transitions x shells) normalized transition probabilities
+    block_references : `numpy.ndarray`
+        first transition of every level, followed by the number of
+        transitions
+    transition_type : `numpy.ndarray`
+        -1 for emission transitions, internal jumps otherwise
+    destination_level_id : `numpy.ndarray`
+    transition_line_id : `numpy.ndarray`
+    memory_limit : int
+        maximum size of the emission probability tables in bytes
+
+    Returns
+    -------
+    level_emission_offsets : `numpy.ndarray`
+        start of the table row of every level, -1 if the level uses the
+        random walk
+    level_emission_counts : `numpy.ndarray`
+        number of emission transitions in the table row of every level
+    emission_line_ids : `numpy.ndarray`
+        emitted line of every table entry
+    cumulative_emission_probabilities : `numpy.ndarray`
+        (shells x table entries) cumulative emission probabilities of the
+        table rows
+    """
+    no_of_levels = block_references.size - 1
+    no_of_shells = transition_probabilities.shape[1]
+    source_level_id = np.repeat(np.arange(no_of_levels),
+                                np.diff(block_references))
+    emission = transition_type == -1
+    jump = ~emission
+
+    jump_graph = coo_matrix(
+        (np.ones(jump.sum()),
+         (source_level_id[jump], destination_level_id[jump])),
+        shape=(no_of_levels, no_of_levels))
+    no_of_groups, level_group = connected_components(jump_graph,
+                                                     directed=False)
+    transition_group = level_group[source_level_id]
+
+    levels_per_group = np.bincount(level_group, minlength=no_of_groups)
+    emissions_per_group = np.bincount(transition_group[emission],
+                                      minlength=no_of_groups)
+    entries_per_group = levels_per_group * emissions_per_group
+    # table and line ids, the solve needs the (levels x levels) jump matrix
+    table_bytes = entries_per_group * (no_of_shells + 1) * 8
+    solve_bytes = (levels_per_group + 2 * emissions_per_group) * (
+        levels_per_group * no_of_shells * 8)
+
+    solved_groups = []
+    total_bytes = 0
+    for group in np.argsort(table_bytes, kind='mergesort'):
+        if emissions_per_group[group] == 0:
+            continue
+        if (total_bytes + table_bytes[group] > memory_limit or
+                solve_bytes[group] > memory_limit):
+            continue
+        solved_groups.append(group)
+        total_bytes += table_bytes[group]
+
+    level_emission_offsets = -np.ones(no_of_levels, dtype=np.int64)
+    level_emission_counts = np.zeros(no_of_levels, dtype=np.int64)
+    emission_line_ids = np.empty(entries_per_group[solved_groups].sum(),
+                                 dtype=np.int64)
+    cumulative_emission_probabilities = np.empty(
+        (no_of_shells, emission_line_ids.size))
+
+    group_levels = np.split(np.argsort(level_group, kind='mergesort'),
+                            np.cumsum(levels_per_group)[:-1])
+    group_transitions = np.split(
+        np.argsort(transition_group, kind='mergesort'),
+        np.cumsum(np.bincount(transition_group,
+                              minlength=no_of_groups))[:-1])
+    level_row = np.empty(no_of_levels, dtype=np.int64)
+
+    offset = 0
+    for group in solved_groups:
+        levels = group_levels[group]
+        transitions = group_transitions[group]
+        group_emissions = transitions[emission[transitions]]
+        group_jumps = transitions[jump[transitions]]
+        no_of_group_levels = levels.size
+        no_of_group_emissions = group_emissions.size
+        level_row[levels] = np.arange(no_of_group_levels)
+
+        jump_matrix = np.zeros((no_of_shells, no_of_group_levels,
+                                no_of_group_levels))
+        np.add.at(jump_matrix,
+                  (slice(None), level_row[source_level_id[group_jumps]],
+                   level_row[destination_level_id[group_jumps]]),
+                  transition_probabilities[group_jumps].T)
+        emission_matrix = np.zeros((no_of_shells, no_of_group_levels,
+                                    no_of_group_emissions))
+        emission_matrix[:, level_row[source_level_id[group_emissions]],
+                        np.arange(no_of_group_emissions)] = (
+            transition_probabilities[group_emissions].T)
+
+        try:
+            emission_probabilities = np.linalg.solve(
+                np.eye(no_of_group_levels) - jump_matrix, emission_matrix)
+        except np.linalg.LinAlgError:
+            emission_probabilities = None
+        if (emission_probabilities is None or
+                not np.all(np.isfinite(emission_probabilities))):
+            logger.warning('Macro atom levels %d - %d are not absorbed, '
+                           'using the random walk for them', levels.min(),
+                           levels.max())
+            continue
+
+        no_of_entries = no_of_group_levels * no_of_group_emissions
+        cumulative_emission_probabilities[:, offset:offset + no_of_entries] = (
+            np.cumsum(emission_probabilities, axis=2).reshape(
+                no_of_shells, no_of_entries))
+        emission_line_ids[offset:offset + no_of_entries] = np.tile(
+            transition_line_id[group_emissions], no_of_group_levels)
+        level_emission_offsets[levels] = (
+            offset + np.arange(no_of_group_levels) * no_of_group_emissions)
+        level_emission_counts[levels] = no_of_group_emissions
+        offset += no_of_entries
+
+    no_of_fallback_levels = (level_emission_offsets < 0).sum()
+    if no_of_fallback_levels > 0:
+        logger.info('%d of %d macro atom levels use the random walk',
+                    no_of_fallback_levels, no_of_levels)
+
+    return (level_emission_offsets, level_emission_counts,
+            emission_line_ids[:offset],
+            np.ascontiguousarray(cumulative_emission_probabilities[:, :offset]))
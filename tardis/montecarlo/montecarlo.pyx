@@ -23,10 +23,21 @@ cdef extern from "src/cmontecarlo.h":
         CONTINUUM_OFF = 0
         CONTINUUM_ON = 1
 
+    ctypedef enum tardis_error_t:
+        TARDIS_ERROR_OK = 0
+
+    ctypedef struct line_search_index_t:
+        int_type_t *bucket_line_ids
+        int_type_t no_of_buckets
+        double log_nu_max
+        double inverse_delta_log_nu
+
     ctypedef struct storage_model_t:
         double *packet_nus
         double *packet_mus
         double *packet_energies
+        double packet_source_nu_unit
+        double packet_source_energy
         double *output_nus
         double *output_energies
         double *last_interaction_in_nu
@@ -44,9 +55,19 @@ cdef extern from "src/cmontecarlo.h":
         double *electron_densities
         double *inverse_electron_densities
         double *line_list_nu
+        line_search_index_t line_search_index
+        double *full_line_list_nu
+        int_type_t *active_line_ids
+        int_type_t *next_active_line_ids
+        int_type_t *shell_line_offsets
+        double *shell_line_list_nu
+        int_type_t *shell_line_ids
+        double *shell_line_tau_sobolevs
+        double *cumulative_tau_sobolevs
         double *line_lists_tau_sobolevs
         double *continuum_list_nu
         int_type_t line_lists_tau_sobolevs_nd
+        int_type_t shell_major_line_lists
         double *line_lists_j_blues
         int_type_t line_lists_j_blues_nd
         int_type_t no_of_lines
@@ -54,6 +75,13 @@ cdef extern from "src/cmontecarlo.h":
         int_type_t line_interaction_id
         double *transition_probabilities
         int_type_t transition_probabilities_nd
+        double *cumulative_transition_probabilities
+        int_type_t no_of_transitions
+        int_type_t *level_emission_offsets
+        int_type_t *level_emission_counts
+        int_type_t *emission_line_ids
+        double *cumulative_emission_probabilities
+        int_type_t no_of_emission_entries
         int_type_t *line2macro_level_upper
         int_type_t *macro_block_references
         int_type_t *transition_type
@@ -67,6 +95,15 @@ cdef extern from "src/cmontecarlo.h":
         double spectrum_delta_nu
         double spectrum_end_nu
         double *spectrum_virt_nu
+        double *spectrum_virt_nu_squared
+        int_type_t *virtual_packet_counts
+        int_type_t no_of_spectrum_bins
+        double *spectrum_emitted_nu
+        double *spectrum_reabsorbed_nu
+        int_type_t no_of_real_spectrum_bins
+        double luminosity_nu_start
+        double luminosity_nu_end
+        double *luminosity_window_energies
         double sigma_thomson
         double inverse_sigma_thomson
         double inner_boundary_albedo
@@ -84,31 +121,374 @@ cdef extern from "src/cmontecarlo.h":
         int_type_t *virt_packet_last_line_interaction_out_id
         int_type_t virt_packet_count
         int_type_t virt_array_size
+        int_type_t virt_packet_logging
+        int_type_t virtual_packet_batch_size
+        int_type_t thread_estimator_memory_limit
+        double *weight_window_energies
+        int_type_t thread_schedule
+        int_type_t thread_schedule_chunk_size
+        int_type_t *thread_packet_counts
+        int_type_t *thread_line_event_counts
+        double *thread_busy_times
+
+    void montecarlo_main_loop(storage_model_t * storage, int_type_t virtual_packet_flag, int nthreads, unsigned long seed, int_type_t iteration, int_type_t first_packet_id) nogil
+    tardis_error_t line_search(double *nu, double nu_insert, int_type_t number_of_lines, int_type_t *result)
+    tardis_error_t indexed_line_search(line_search_index_t *index, double *nu, double nu_insert, int_type_t number_of_lines, int_type_t *result)
+
+
+
+
+cdef extern from "src/philox.h":
+    ctypedef struct philox_state_t:
+        pass
+
+    void philox_seed(philox_state_t *state, unsigned long long seed,
+                     unsigned long long stream, unsigned int substream)
+    double philox_double(philox_state_t *state)
+
+cdef extern from "src/randomkit/randomkit.h":
+    ctypedef struct rk_state:
+        pass
 
-    void montecarlo_main_loop(storage_model_t * storage, int_type_t virtual_packet_flag, int nthreads, unsigned long seed)
+    void rk_seed(unsigned long seed, rk_state *state)
+    double rk_double(rk_state *state)
+    unsigned long rk_ulong(rk_state *state)
 
+    ctypedef enum rk_sobol_error:
+        RK_SOBOL_OK = 0
 
+    ctypedef struct rk_sobol_state:
+        size_t dimension
+        unsigned long *direction
 
+    unsigned long rk_sobol_SLdirections[]
 
-cdef initialize_storage_model(model, runner, storage_model_t *storage):
+    rk_sobol_error rk_sobol_init(size_t dimension, rk_sobol_state *s,
+                                 rk_state *rs_dir,
+                                 const unsigned long *directions,
+                                 const unsigned long *polynomials)
+    void rk_sobol_randomshift(rk_sobol_state *s, rk_state *rs_num)
+    rk_sobol_error rk_sobol_double(rk_sobol_state *s, double *x)
+    void rk_sobol_free(rk_sobol_state *s)
+
+cdef class CArrayOwner:
     """
-    Initializing the storage struct.
+    Owner of a malloc'd C array that is used as the base of a numpy array.
+    The C array is freed when the last numpy array using it is deleted.
+    """
+    cdef void *data
+
+    def __dealloc__(self):
+        free(self.data)
+
+
+cdef np.ndarray c_array_to_numpy(void *data, int typenum, np.npy_intp size):
+    """
+    Wrap a malloc'd C array in a numpy array without copying. The numpy array
+    takes over the ownership of the memory.
+    """
+    cdef np.ndarray array = np.PyArray_SimpleNewFromData(1, &size, typenum,
+                                                         data)
+    cdef CArrayOwner owner = CArrayOwner.__new__(CArrayOwner)
+    owner.data = data
+    np.set_array_base(array, owner)
+    return array
+
+
+def make_line_search_index(line_list_nu, no_of_buckets):
+    """
+    Build the coarse index over the logarithmic line frequencies that is used
+    to find the first line of a packet without searching the whole line list.
+
+    Parameters
+    ----------
+    line_list_nu : `numpy.ndarray`
+        line frequencies sorted from the largest to the lowest
+    no_of_buckets : int
+        number of logarithmic frequency buckets
+
+    Returns
+    -------
+    bucket_line_ids : `numpy.ndarray`
+        first line redder than the blue edge of each bucket, followed by the
+        number of lines
+    log_nu_max : float
+    inverse_delta_log_nu : float
+    """
+    log_nu_max = np.log(line_list_nu[0])
+    delta_log_nu = (log_nu_max - np.log(line_list_nu[line_list_nu.size - 1])) / no_of_buckets
+    inverse_delta_log_nu = 1.0 / delta_log_nu if delta_log_nu > 0 else 0.0
+    bucket_edges = np.exp(log_nu_max - np.arange(no_of_buckets) * delta_log_nu)
+    bucket_line_ids = np.empty(no_of_buckets + 1, dtype=np.int64)
+    bucket_line_ids[:no_of_buckets] = line_list_nu.size - np.searchsorted(
+        line_list_nu[::-1], bucket_edges, side='left')
+    bucket_line_ids[no_of_buckets] = line_list_nu.size
+    return bucket_line_ids, log_nu_max, inverse_delta_log_nu
+
+
+cdef set_line_search_index(line_search_index_t *index, line_search_index):
+    cdef np.ndarray[int_type_t, ndim=1] bucket_line_ids
+    if line_search_index is None:
+        index.no_of_buckets = 0
+    else:
+        bucket_line_ids, index.log_nu_max, index.inverse_delta_log_nu = (
+            line_search_index)
+        index.bucket_line_ids = <int_type_t*> bucket_line_ids.data
+        index.no_of_buckets = bucket_line_ids.size - 1
+
+
+def search_lines(np.ndarray[double, ndim=1] line_list_nu,
+                 np.ndarray[double, ndim=1] nus, line_search_index=None):
+    """
+    Find the next line to the red for every frequency, either with a binary
+    search over the whole line list or with a line search index. Used to test
+    and benchmark the line search.
+
+    Parameters
+    ----------
+    line_list_nu : `numpy.ndarray`
+        line frequencies sorted from the largest to the lowest
+    nus : `numpy.ndarray`
+        frequencies to look up
+    line_search_index : tuple
+        index as returned by `make_line_search_index`, the binary search is
+        used if None
+
+    Returns
+    -------
+    line_ids : `numpy.ndarray`
+    """
+    cdef line_search_index_t index
+    cdef np.ndarray[int_type_t, ndim=1] line_ids = np.empty(nus.size,
+                                                            dtype=np.int64)
+    cdef int_type_t i
+    cdef int_type_t no_of_lines = line_list_nu.size
+    set_line_search_index(&index, line_search_index)
+    for i in range(nus.size):
+        if index.no_of_buckets > 0:
+            indexed_line_search(&index, &line_list_nu[0], nus[i], no_of_lines,
+                                &line_ids[i])
+        else:
+            line_search(&line_list_nu[0], nus[i], no_of_lines, &line_ids[i])
+    return line_ids
+
+
+def random_doubles(int_type_t no_of_numbers, seed, int_type_t stream=0,
+                   int_type_t iteration=0, generator='philox'):
+    """
+    Draw uniform random numbers in [0, 1) with the random number generator of
+    the transport kernel. Used to test and benchmark the generators.
 
+    Parameters
+    ----------
+    no_of_numbers : int
+    seed : int
+    stream : int
+        random number stream, the packet id in the transport
+    iteration : int
+    generator : str
+        'philox' for the counter based generator of the transport or 'mt' for
+        the Mersenne Twister of randomkit, which ignores stream and iteration
+
+    Returns
+    -------
+    random_numbers : `numpy.ndarray`
+    """
+    cdef np.ndarray[double, ndim=1] random_numbers = np.empty(no_of_numbers)
+    cdef philox_state_t philox_state
+    cdef rk_state mt_state
+    cdef int_type_t i
+    if generator == 'philox':
+        philox_seed(&philox_state, seed, stream, iteration)
+        for i in range(no_of_numbers):
+            random_numbers[i] = philox_double(&philox_state)
+    elif generator == 'mt':
+        rk_seed(seed, &mt_state)
+        for i in range(no_of_numbers):
+            random_numbers[i] = rk_double(&mt_state)
+    else:
+        raise ValueError('Unknown random number generator {0}'.format(
+            generator))
+    return random_numbers
+
+
+cdef inline unsigned long bit_parity(unsigned long bits):
+    cdef unsigned long parity = 0
+    while bits:
+        parity ^= 1
+        bits &= bits - 1
+    return parity
+
+
+cdef void sobol_linear_scramble(rk_sobol_state *state, rk_state *mt_state):
     """
+    Random linear matrix scrambling (Matousek 1998) of the direction numbers
+    of a Sobol sequence. The digits of every coordinate are multiplied by a
+    random lower triangular binary matrix with unit diagonal, so digit i of a
+    scrambled point mixes the digits up to i of the original point and the
+    points keep their net properties.
+    """
+    cdef int_type_t no_of_bits = 8 * sizeof(unsigned long)
+    # row i of the matrix, digit i is the (i + 1)th most significant bit
+    cdef unsigned long rows[64]
+    cdef unsigned long digit, direction, scrambled
+    cdef size_t k
+    cdef int_type_t i, j
+    for k in range(state.dimension):
+        for i in range(no_of_bits):
+            digit = (<unsigned long> 1) << (no_of_bits - 1 - i)
+            # the more significant digits are random, the others zero
+            rows[i] = (rk_ulong(mt_state) & ~(digit | (digit - 1))) | digit
+        for j in range(no_of_bits):
+            direction = state.direction[j * state.dimension + k]
+            scrambled = 0
+            for i in range(no_of_bits):
+                if bit_parity(rows[i] & direction):
+                    scrambled |= (<unsigned long> 1) << (no_of_bits - 1 - i)
+            state.direction[j * state.dimension + k] = scrambled
+
+
+cdef class SobolSequence:
+    """
+    Scrambled Sobol sequence of randomkit. The direction numbers are
+    scrambled with random lower triangular matrices and the points XORed with
+    a random digital shift (Matousek 1998), both drawn from a Mersenne Twister
+    with the given seed, so every seed gives a different low discrepancy
+    sequence. Consecutive calls of `draw` continue the sequence.
 
-    storage.no_of_packets = runner.input_nu.size
-    storage.packet_nus = <double*> PyArray_DATA(runner.input_nu)
-    storage.packet_mus = <double*> PyArray_DATA(runner.input_mu)
-    storage.packet_energies = <double*> PyArray_DATA(runner.input_energy)
+    Parameters
+    ----------
+    dimension : int
+        number of coordinates of every point, the direction numbers of
+        Bratley & Fox (1988) cover 40 dimensions, further dimensions get
+        random direction numbers
+    seed : int
+    """
+    cdef rk_sobol_state state
+    cdef readonly int_type_t dimension
+    cdef readonly int_type_t count
+    cdef bint initialized
+
+    def __cinit__(self, int_type_t dimension, seed):
+        cdef rk_state mt_state
+        cdef rk_sobol_error error
+        rk_seed(seed, &mt_state)
+        error = rk_sobol_init(dimension, &self.state, &mt_state,
+                              rk_sobol_SLdirections, NULL)
+        if error != RK_SOBOL_OK:
+            raise ValueError('Cannot initialize a Sobol sequence with {0} '
+                             'dimensions'.format(dimension))
+        self.initialized = True
+        sobol_linear_scramble(&self.state, &mt_state)
+        rk_sobol_randomshift(&self.state, &mt_state)
+        self.dimension = dimension
+        self.count = 0
+
+    def __dealloc__(self):
+        if self.initialized:
+            rk_sobol_free(&self.state)
+
+    def draw(self, int_type_t no_of_points):
+        """
+        Draw the next points of the sequence.
+
+        Parameters
+        ----------
+        no_of_points : int
+
+        Returns
+        -------
+        points : `numpy.ndarray`
+            uniform deviates in [0, 1) of shape (dimension, no_of_points)
+        """
+        cdef np.ndarray[double, ndim=2] points = np.empty(
+            (no_of_points, self.dimension))
+        cdef int_type_t i
+        for i in range(no_of_points):
+            rk_sobol_double(&self.state, &points[i, 0])
+        self.count += no_of_points
+        return points.T
+
+
+def make_cumulative_transition_probabilities(
+        double [:, ::1] transition_probabilities,
+        int_type_t [:] block_references):
+    """
+    Accumulate the transition probabilities of every macro atom block, so
+    that the transport kernel can choose a transition with a binary search
+    over contiguous memory.
+
+    Parameters
+    ----------
+    transition_probabilities : `numpy.ndarray`
+        (transitions x shells) normalized transition probabilities
+    block_references : `numpy.ndarray`
+        first transition of every level, followed by the number of
+        transitions
+
+    Returns
+    -------
+    cumulative_transition_probabilities : `numpy.ndarray`
+        (shells x transitions) cumulative probabilities within each block
+    """
+    cdef int_type_t i, j, k
+    cdef int_type_t no_of_shells = transition_probabilities.shape[1]
+    cdef double [:, ::1] cumulative_transition_probabilities = np.empty(
+        (no_of_shells, transition_probabilities.shape[0]))
+    cdef double [:] p = np.empty(no_of_shells)
+
+    for i in range(block_references.shape[0] - 1):
+        for k in range(no_of_shells):
+            p[k] = 0.0
+        for j in range(block_references[i], block_references[i + 1]):
+            for k in range(no_of_shells):
+                p[k] += transition_probabilities[j, k]
+                cumulative_transition_probabilities[k, j] = p[k]
+    return np.asarray(cumulative_transition_probabilities)
+
+
+cdef void *pin_array_data(list pinned_arrays, np.ndarray array):
+    pinned_arrays.append(array)
+    return PyArray_DATA(array)
+
+
+cdef list initialize_storage_model(model, runner, storage_model_t *storage):
+    """
+    Initializing the storage struct.
+
+    Returns the arrays the storage points into. They have to be kept alive
+    while the storage is in use, because the transport runs without the GIL
+    and other threads may replace the attributes of the model and runner.
+    """
+    cdef list pinned_arrays = []
+
+    storage.no_of_packets = runner.input_no_of_packets
+    if runner.input_nu is None:
+        # the transport draws the packets from a blackbody
+        storage.packet_nus = NULL
+        storage.packet_mus = NULL
+        storage.packet_energies = NULL
+        storage.packet_source_nu_unit = runner.input_nu_unit
+        storage.packet_source_energy = runner.input_packet_energy
+    else:
+        storage.packet_nus = <double*> pin_array_data(
+            pinned_arrays, runner.input_nu)
+        storage.packet_mus = <double*> pin_array_data(
+            pinned_arrays, runner.input_mu)
+        storage.packet_energies = <double*> pin_array_data(
+            pinned_arrays, runner.input_energy)
 
     # Setup of structure
     structure = model.tardis_config.structure
     storage.no_of_shells = structure.no_of_shells
 
 
-    storage.r_inner = <double*> PyArray_DATA(runner.r_inner_cgs)
-    storage.r_outer = <double*> PyArray_DATA(runner.r_outer_cgs)
-    storage.v_inner = <double*> PyArray_DATA(runner.v_inner_cgs)
+    storage.r_inner = <double*> pin_array_data(
+        pinned_arrays, runner.r_inner_cgs)
+    storage.r_outer = <double*> pin_array_data(
+        pinned_arrays, runner.r_outer_cgs)
+    storage.v_inner = <double*> pin_array_data(
+        pinned_arrays, runner.v_inner_cgs)
 
     # Setup the rest
     # times
@@ -116,10 +496,10 @@ cdef initialize_storage_model(model, runner, storage_model_t *storage):
         's').value
     storage.inverse_time_explosion = 1.0 / storage.time_explosion
     #electron density
-    storage.electron_densities = <double*> PyArray_DATA(
-        model.plasma_array.electron_densities.values)
-    storage.inverse_electron_densities = <double*> PyArray_DATA(
-        1.0 / model.plasma_array.electron_densities.values)
+    storage.electron_densities = <double*> pin_array_data(
+        pinned_arrays, model.plasma_array.electron_densities.values)
+    storage.inverse_electron_densities = <double*> pin_array_data(
+        pinned_arrays, runner.inverse_electron_densities)
     # Switch for continuum processes
     storage.cont_status = CONTINUUM_OFF
     # Continuum data
@@ -130,57 +510,157 @@ cdef initialize_storage_model(model, runner, storage_model_t *storage):
 
     if storage.cont_status == CONTINUUM_ON:
         continuum_list_nu = np.array([9.0e14, 8.223e14, 6.0e14, 3.5e14, 3.0e14])  # sorted list of threshold frequencies
-        storage.continuum_list_nu = <double*> continuum_list_nu.data
+        storage.continuum_list_nu = <double*> pin_array_data(
+            pinned_arrays, continuum_list_nu)
         storage.no_of_edges = continuum_list_nu.size
         chi_bf_tmp_partial = np.zeros(continuum_list_nu.size)
-        storage.chi_bf_tmp_partial = <double*> chi_bf_tmp_partial.data
+        storage.chi_bf_tmp_partial = <double*> pin_array_data(
+            pinned_arrays, chi_bf_tmp_partial)
         l_pop = np.ones(storage.no_of_shells * continuum_list_nu.size, dtype=np.float64)
-        storage.l_pop = <double*> l_pop.data
+        storage.l_pop = <double*> pin_array_data(pinned_arrays, l_pop)
         l_pop_r = np.ones(storage.no_of_shells * continuum_list_nu.size, dtype=np.float64)
-        storage.l_pop_r = <double*> l_pop_r.data
+        storage.l_pop_r = <double*> pin_array_data(pinned_arrays, l_pop_r)
 
     # Line lists
-    storage.no_of_lines = model.atom_data.lines.nu.values.size
-    storage.line_list_nu = <double*> PyArray_DATA(model.atom_data.lines.nu.values)
-    storage.line_lists_tau_sobolevs = <double*> PyArray_DATA(
-        model.plasma_array.tau_sobolevs.values)
-    storage.line_lists_j_blues = <double*> PyArray_DATA(runner.j_blue_estimator)
+    storage.no_of_lines = runner.line_list_nu.size
+    storage.line_list_nu = <double*> pin_array_data(
+        pinned_arrays, runner.line_list_nu)
+    set_line_search_index(&storage.line_search_index,
+                          runner.line_search_index)
+    pinned_arrays.append(runner.line_search_index)
+    storage.full_line_list_nu = <double*> pin_array_data(
+        pinned_arrays, model.atom_data.lines.nu.values)
+    if runner.active_line_ids is None:
+        storage.active_line_ids = NULL
+        storage.next_active_line_ids = NULL
+    else:
+        storage.active_line_ids = <int_type_t*> pin_array_data(
+            pinned_arrays, runner.active_line_ids)
+        storage.next_active_line_ids = <int_type_t*> pin_array_data(
+            pinned_arrays, runner.next_active_line_ids)
+    if runner.shell_line_offsets is None:
+        storage.shell_line_offsets = NULL
+        storage.shell_line_list_nu = NULL
+        storage.shell_line_ids = NULL
+        storage.shell_line_tau_sobolevs = NULL
+    else:
+        storage.shell_line_offsets = <int_type_t*> pin_array_data(
+            pinned_arrays, runner.shell_line_offsets)
+        storage.shell_line_list_nu = <double*> pin_array_data(
+            pinned_arrays, runner.shell_line_list_nu)
+        storage.shell_line_ids = <int_type_t*> pin_array_data(
+            pinned_arrays, runner.shell_line_ids)
+        storage.shell_line_tau_sobolevs = <double*> pin_array_data(
+            pinned_arrays, runner.shell_line_tau_sobolevs)
+    if runner.cumulative_tau_sobolevs is None:
+        storage.cumulative_tau_sobolevs = NULL
+    else:
+        storage.cumulative_tau_sobolevs = <double*> pin_array_data(
+            pinned_arrays, runner.cumulative_tau_sobolevs)
+    storage.line_lists_tau_sobolevs = <double*> pin_array_data(
+        pinned_arrays, runner.tau_sobolevs)
+    storage.shell_major_line_lists = runner.shell_major_line_lists
+    if runner._active_j_blue_estimator is None:
+        storage.line_lists_j_blues = NULL
+    else:
+        storage.line_lists_j_blues = <double*> pin_array_data(
+            pinned_arrays, runner._active_j_blue_estimator)
+    storage.thread_estimator_memory_limit = int(
+        model.tardis_config.montecarlo.thread_estimator_memory_limit.to(
+            'byte').value)
+    if runner.weight_window_energies is None:
+        storage.weight_window_energies = NULL
+    else:
+        storage.weight_window_energies = <double*> pin_array_data(
+            pinned_arrays, runner.weight_window_energies)
+    storage.thread_schedule = runner.get_thread_schedule_id(
+        model.tardis_config.montecarlo.thread_schedule)
+    storage.thread_schedule_chunk_size = (
+        model.tardis_config.montecarlo.thread_schedule_chunk_size)
+    storage.thread_packet_counts = <int_type_t*> pin_array_data(
+        pinned_arrays, runner.thread_packet_counts)
+    storage.thread_line_event_counts = <int_type_t*> pin_array_data(
+        pinned_arrays, runner.thread_line_event_counts)
+    storage.thread_busy_times = <double*> pin_array_data(
+        pinned_arrays, runner.thread_busy_times)
 
     storage.line_interaction_id = runner.get_line_interaction_id(
         model.tardis_config.plasma.line_interaction_type)
 
     # macro atom & downbranch
     if storage.line_interaction_id >= 1:
-        storage.transition_probabilities = <double*> PyArray_DATA(model.transition_probabilities.values)
-        storage.line2macro_level_upper = <int_type_t*> PyArray_DATA(
-            model.atom_data.lines_upper2macro_reference_idx)
-        storage.macro_block_references = <int_type_t*> PyArray_DATA(
-            model.atom_data.macro_atom_references['block_references'].values)
-        storage.transition_type = <int_type_t*> PyArray_DATA(
-            model.atom_data.macro_atom_data['transition_type'].values)
+        if runner.transition_probabilities is None:
+            storage.transition_probabilities = NULL
+        else:
+            storage.transition_probabilities = <double*> pin_array_data(
+                pinned_arrays, runner.transition_probabilities)
+        storage.line2macro_level_upper = <int_type_t*> pin_array_data(
+            pinned_arrays, runner.line2macro_level_upper)
+        storage.macro_block_references = <int_type_t*> pin_array_data(
+            pinned_arrays, runner.macro_block_references)
+        storage.no_of_transitions = runner.macro_block_references[
+            runner.macro_block_references.size - 1]
+        if runner.cumulative_transition_probabilities is None:
+            storage.cumulative_transition_probabilities = NULL
+        else:
+            storage.cumulative_transition_probabilities = <double*> pin_array_data(
+                pinned_arrays, runner.cumulative_transition_probabilities)
+        if runner.emission_probabilities is None:
+            storage.level_emission_offsets = NULL
+        else:
+            (level_emission_offsets, level_emission_counts, emission_line_ids,
+             cumulative_emission_probabilities) = runner.emission_probabilities
+            storage.level_emission_offsets = <int_type_t*> pin_array_data(
+                pinned_arrays, level_emission_offsets)
+            storage.level_emission_counts = <int_type_t*> pin_array_data(
+                pinned_arrays, level_emission_counts)
+            storage.emission_line_ids = <int_type_t*> pin_array_data(
+                pinned_arrays, emission_line_ids)
+            storage.cumulative_emission_probabilities = <double*> pin_array_data(
+                pinned_arrays, cumulative_emission_probabilities)
+            storage.no_of_emission_entries = emission_line_ids.size
+        storage.transition_type = <int_type_t*> pin_array_data(
+            pinned_arrays, model.atom_data.macro_atom_data['transition_type'].values)
 
         # Destination level is not needed and/or generated for downbranch
-        storage.destination_level_id = <int_type_t*> PyArray_DATA(
-            model.atom_data.macro_atom_data['destination_level_idx'].values)
-        storage.transition_line_id = <int_type_t*> PyArray_DATA(
-            model.atom_data.macro_atom_data['lines_idx'].values)
-
-    storage.output_nus = <double*> PyArray_DATA(runner._output_nu)
-    storage.output_energies = <double*> PyArray_DATA(runner._output_energy)
-
-    storage.last_line_interaction_in_id = <int_type_t*> PyArray_DATA(
-        runner.last_line_interaction_in_id)
-    storage.last_line_interaction_out_id = <int_type_t*> PyArray_DATA(
-        runner.last_line_interaction_out_id)
-    storage.last_line_interaction_shell_id = <int_type_t*> PyArray_DATA(
-        runner.last_line_interaction_shell_id)
-    storage.last_interaction_type = <int_type_t*> PyArray_DATA(
-        runner.last_interaction_type)
-    storage.last_interaction_in_nu = <double*> PyArray_DATA(
-        runner.last_interaction_in_nu)
-
-    storage.js = <double*> PyArray_DATA(runner.j_estimator)
-    storage.nubars = <double*> PyArray_DATA(runner.nu_bar_estimator)
+        storage.destination_level_id = <int_type_t*> pin_array_data(
+            pinned_arrays, model.atom_data.macro_atom_data['destination_level_idx'].values)
+        storage.transition_line_id = <int_type_t*> pin_array_data(
+            pinned_arrays, model.atom_data.macro_atom_data['lines_idx'].values)
+
+    # the per packet output arrays hold all packets of the run, the packets
+    # of the current chunk start at the number of packets transported
+    cdef int_type_t offset = runner.no_of_packets_transported
+    if runner._output_nu is None:
+        storage.output_nus = NULL
+        storage.output_energies = NULL
+    else:
+        storage.output_nus = <double*> pin_array_data(
+            pinned_arrays, runner._output_nu[offset:])
+        storage.output_energies = <double*> pin_array_data(
+            pinned_arrays, runner._output_energy[offset:])
+
+    if runner.last_interaction_type is None:
+        storage.last_line_interaction_in_id = NULL
+        storage.last_line_interaction_out_id = NULL
+        storage.last_line_interaction_shell_id = NULL
+        storage.last_interaction_type = NULL
+        storage.last_interaction_in_nu = NULL
+    else:
+        storage.last_line_interaction_in_id = <int_type_t*> pin_array_data(
+            pinned_arrays, runner.last_line_interaction_in_id[offset:])
+        storage.last_line_interaction_out_id = <int_type_t*> pin_array_data(
+            pinned_arrays, runner.last_line_interaction_out_id[offset:])
+        storage.last_line_interaction_shell_id = <int_type_t*> pin_array_data(
+            pinned_arrays, runner.last_line_interaction_shell_id[offset:])
+        storage.last_interaction_type = <int_type_t*> pin_array_data(
+            pinned_arrays, runner.last_interaction_type[offset:])
+        storage.last_interaction_in_nu = <double*> pin_array_data(
+            pinned_arrays, runner.last_interaction_in_nu[offset:])
+
+    storage.js = <double*> pin_array_data(pinned_arrays, runner.j_estimator)
+    storage.nubars = <double*> pin_array_data(
+        pinned_arrays, runner.nu_bar_estimator)
 
     storage.spectrum_start_nu = model.tardis_config.spectrum.frequency.value.min()
     storage.spectrum_end_nu = model.tardis_config.spectrum.frequency.value.max()
@@ -188,17 +668,43 @@ cdef initialize_storage_model(model, runner, storage_model_t *storage):
     storage.spectrum_virt_end_nu = model.tardis_config.montecarlo.virtual_spectrum_range.start.to('Hz', units.spectral()).value
     storage.spectrum_delta_nu = model.tardis_config.spectrum.frequency.value[1] - model.tardis_config.spectrum.frequency.value[0]
     cdef np.ndarray[double, ndim=1] spectrum_virt_nu = model.montecarlo_virtual_luminosity
-    storage.spectrum_virt_nu = <double*> spectrum_virt_nu.data
+    storage.spectrum_virt_nu = <double*> pin_array_data(
+        pinned_arrays, spectrum_virt_nu)
+    storage.no_of_spectrum_bins = spectrum_virt_nu.size
+    if runner.virtual_packet_counts is None:
+        storage.spectrum_virt_nu_squared = NULL
+        storage.virtual_packet_counts = NULL
+    else:
+        storage.spectrum_virt_nu_squared = <double*> pin_array_data(
+            pinned_arrays, runner._virtual_spectrum_squared)
+        storage.virtual_packet_counts = <int_type_t*> pin_array_data(
+            pinned_arrays, runner.virtual_packet_counts)
+    storage.spectrum_emitted_nu = <double*> pin_array_data(
+        pinned_arrays, runner._emitted_energy_spectrum)
+    storage.spectrum_reabsorbed_nu = <double*> pin_array_data(
+        pinned_arrays, runner._reabsorbed_energy_spectrum)
+    storage.no_of_real_spectrum_bins = runner._emitted_energy_spectrum.size
+    storage.luminosity_nu_start = runner.luminosity_nu_start
+    storage.luminosity_nu_end = runner.luminosity_nu_end
+    storage.luminosity_window_energies = <double*> pin_array_data(
+        pinned_arrays, runner._luminosity_window_energies)
+    storage.virt_packet_logging = (
+        model.tardis_config.montecarlo.virtual_packet_logging)
+    storage.virtual_packet_batch_size = (
+        model.tardis_config.montecarlo.virtual_packet_batch_size)
     storage.sigma_thomson = model.tardis_config.montecarlo.sigma_thomson.to('1/cm^2').value
     storage.inverse_sigma_thomson = 1.0 / storage.sigma_thomson
     storage.reflective_inner_boundary = model.tardis_config.montecarlo.enable_reflective_inner_boundary
     storage.inner_boundary_albedo = model.tardis_config.montecarlo.inner_boundary_albedo
     # Data for continuum implementation
     cdef np.ndarray[double, ndim=1] t_electrons = model.plasma_array.t_electrons
-    storage.t_electrons = <double*> t_electrons.data
+    storage.t_electrons = <double*> pin_array_data(pinned_arrays, t_electrons)
+
+    return pinned_arrays
 
 def montecarlo_radial1d(model, runner, int_type_t virtual_packet_flag=0,
-                        int nthreads=4):
+                        int nthreads=4, seed=None, int_type_t iteration=0,
+                        int_type_t first_packet_id=0):
     """
     Parameters
     ----------
@@ -206,6 +712,14 @@ def montecarlo_radial1d(model, runner, int_type_t virtual_packet_flag=0,
         complete model
     param photon_packets : PacketSource object
         photon packets
+    seed : int
+        seed of the random number streams of the packets, defaults to the
+        montecarlo seed of the configuration
+    iteration : int
+        iteration number, every iteration uses different random numbers
+    first_packet_id : int
+        id of the first packet within the iteration, packets draw their
+        random numbers from the stream of their id
 
     Returns
     -------
@@ -228,38 +742,48 @@ def montecarlo_radial1d(model, runner, int_type_t virtual_packet_flag=0,
     """
 
     cdef storage_model_t storage
-
-    initialize_storage_model(model, runner, &storage)
-
-    montecarlo_main_loop(&storage, virtual_packet_flag, nthreads,
-                         model.tardis_config.montecarlo.seed)
-
-    cdef np.ndarray[double, ndim=1] virt_packet_nus = np.zeros(storage.virt_packet_count, dtype=np.float64)
-    cdef np.ndarray[double, ndim=1] virt_packet_energies = np.zeros(storage.virt_packet_count, dtype=np.float64)
-    cdef np.ndarray[double, ndim=1] virt_packet_last_interaction_in_nu = np.zeros(storage.virt_packet_count, dtype=np.float64)
-    cdef np.ndarray[int_type_t, ndim=1] virt_packet_last_interaction_type = np.zeros(storage.virt_packet_count, dtype=np.int64)
-    cdef np.ndarray[int_type_t, ndim=1] virt_packet_last_line_interaction_in_id = np.zeros(storage.virt_packet_count, dtype=np.int64)
-    cdef np.ndarray[int_type_t, ndim=1] virt_packet_last_line_interaction_out_id = np.zeros(storage.virt_packet_count, dtype=np.int64)
-
-    for i in range(storage.virt_packet_count):
-        virt_packet_nus[i] = storage.virt_packet_nus[i]
-        virt_packet_energies[i] = storage.virt_packet_energies[i]
-        virt_packet_last_interaction_in_nu[i] = storage.virt_packet_last_interaction_in_nu[i]
-        virt_packet_last_interaction_type[i] = storage.virt_packet_last_interaction_type[i]
-        virt_packet_last_line_interaction_in_id[i] = storage.virt_packet_last_line_interaction_in_id[i]
-        virt_packet_last_line_interaction_out_id[i] = storage.virt_packet_last_line_interaction_out_id[i]
-    free(<void *>storage.virt_packet_nus)
-    free(<void *>storage.virt_packet_energies)
-    free(<void *>storage.virt_packet_last_interaction_in_nu)
-    free(<void *>storage.virt_packet_last_interaction_type)
-    free(<void *>storage.virt_packet_last_line_interaction_in_id)
-    free(<void *>storage.virt_packet_last_line_interaction_out_id)
-    runner.virt_packet_nus = virt_packet_nus
-    runner.virt_packet_energies = virt_packet_energies
-    runner.virt_packet_last_interaction_in_nu = virt_packet_last_interaction_in_nu
-    runner.virt_packet_last_interaction_type = virt_packet_last_interaction_type
-    runner.virt_packet_last_line_interaction_in_id = virt_packet_last_line_interaction_in_id
-    runner.virt_packet_last_line_interaction_out_id = virt_packet_last_line_interaction_out_id
+    cdef unsigned long c_seed
+
+    # every thread of the transport adds to its own entry of the thread
+    # arrays of the runner
+    nthreads = max(nthreads, 1)
+    if (runner.thread_packet_counts.size < nthreads or
+            runner.thread_busy_times.size < nthreads or
+            runner.thread_line_event_counts.size < nthreads):
+        raise ValueError('The thread arrays of the runner hold {0} threads, '
+                         'the transport uses {1}'.format(
+                             runner.thread_packet_counts.size, nthreads))
+
+    pinned_arrays = initialize_storage_model(model, runner, &storage)
+
+    if seed is None:
+        seed = model.tardis_config.montecarlo.seed
+    c_seed = seed
+
+    # the transport only touches the pinned arrays, other Python threads can
+    # run meanwhile
+    with nogil:
+        montecarlo_main_loop(&storage, virtual_packet_flag, nthreads, c_seed,
+                             iteration, first_packet_id)
+    del pinned_arrays
+
+    runner.virt_packet_nus = c_array_to_numpy(
+        storage.virt_packet_nus, np.NPY_DOUBLE, storage.virt_packet_count)
+    runner.virt_packet_energies = c_array_to_numpy(
+        storage.virt_packet_energies, np.NPY_DOUBLE,
+        storage.virt_packet_count)
+    runner.virt_packet_last_interaction_in_nu = c_array_to_numpy(
+        storage.virt_packet_last_interaction_in_nu, np.NPY_DOUBLE,
+        storage.virt_packet_count)
+    runner.virt_packet_last_interaction_type = c_array_to_numpy(
+        storage.virt_packet_last_interaction_type, np.NPY_INT64,
+        storage.virt_packet_count)
+    runner.virt_packet_last_line_interaction_in_id = c_array_to_numpy(
+        storage.virt_packet_last_line_interaction_in_id, np.NPY_INT64,
+        storage.virt_packet_count)
+    runner.virt_packet_last_line_interaction_out_id = c_array_to_numpy(
+        storage.virt_packet_last_line_interaction_out_id, np.NPY_INT64,
+        storage.virt_packet_count)
     
     #return output_nus, output_energies, js, nubars, last_line_interaction_in_id, last_line_interaction_out_id, last_interaction_type, last_line_interaction_shell_id, virt_packet_nus, virt_packet_energies
 
@@ -1,8 +1,90 @@
+from abc import ABCMeta, abstractmethod
+
 import numpy as np
 import numexpr as ne
 from astropy import constants as const
 
-class BlackBodySimpleSource(object):
+from tardis.montecarlo import montecarlo
+
+
+class BasePacketSource(object):
+    """
+    Base class of the packet sources. Every source draws its random numbers
+    from its own `numpy.random.RandomState`, so it neither changes nor
+    depends on the global NumPy random state. Large numbers of packets are
+    sampled in chunks of `chunk_size` packets, which bounds the temporary
+    arrays.
+
+    Parameters
+    ----------
+    seed : int
+    chunk_size : int
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, seed, chunk_size=65536):
+        self.random_state = np.random.RandomState(seed)
+        self.chunk_size = chunk_size
+
+    def iter_chunks(self, no_of_packets):
+        """
+        Yield the start and end index of every chunk of <no_of_packets>
+        packets
+        """
+        for start in range(0, no_of_packets, self.chunk_size):
+            yield start, min(start + self.chunk_size, no_of_packets)
+
+    @abstractmethod
+    def create_packet_nus(self, T, no_of_packets):
+        """
+        Create the frequencies of <no_of_packets> packets that leave the
+        inner boundary
+
+        Parameters
+        ----------
+        T : ~float
+            temperature of the inner boundary
+        no_of_packets: ~int
+
+        Returns
+        -------
+
+            : ~numpy.ndarray
+            array of frequencies
+        """
+
+    def create_packet_mus(self, no_of_packets):
+        """
+        Create the directions of <no_of_packets> packets that leave the inner
+        boundary with the angular distribution of a blackbody surface
+
+        Parameters
+        ----------
+        no_of_packets: ~int
+
+        Returns
+        -------
+
+            : ~numpy.ndarray
+            array of cosines of the angle to the radial direction
+        """
+        mus = self.random_state.random_sample(no_of_packets)
+        return np.sqrt(mus, out=mus)
+
+    def create_packet_energies(self, no_of_packets):
+        energies = np.ones(no_of_packets)
+        energies /= no_of_packets
+        return energies
+
+    def create_packets(self, T, no_of_packets):
+        nus = self.create_packet_nus(T, no_of_packets)
+        mus = self.create_packet_mus(no_of_packets)
+        energies = self.create_packet_energies(no_of_packets)
+
+        return nus, mus, energies
+
+
+class BlackBodySimpleSource(BasePacketSource):
     """
     Simple packet source that generates packets for the Montecarlo part.
     This uses the algorithm described in  Bjorkman & Wood 2001 (page 4) which
@@ -27,8 +109,8 @@ class BlackBodySimpleSource(object):
     where :math:`x=h\\nu/kT`
 
     """
-    def __init__(self, seed, l_samples=1000):
-        np.random.seed(seed)
+    def __init__(self, seed, l_samples=1000, chunk_size=65536):
+        super(BlackBodySimpleSource, self).__init__(seed, chunk_size)
         self.l_samples = l_samples
         self.l_array = np.cumsum(np.arange(1, l_samples, dtype=np.float64)**-4)
         self.l_coef = np.pi**4 / 90.0
@@ -51,28 +133,289 @@ class BlackBodySimpleSource(object):
             array of frequencies
         """
 
-        xis = np.random.random((5, no_of_packets))
+        nus = np.empty(no_of_packets)
+        for start, end in self.iter_chunks(no_of_packets):
+            xis = self.random_state.random_sample((5, end - start))
+            self.blackbody_nus(T, xis, out=nus[start:end])
+
+        return nus
+
+    def blackbody_nus(self, T, xis, out=None):
+        """
+        Transform uniform deviates into frequencies of a blackbody of
+        temperature <T>
+
+        Parameters
+        ----------
+        T : ~float
+            temperature
+        xis : ~numpy.ndarray
+            uniform deviates of shape (5, no_of_packets)
+        out : ~numpy.ndarray
+            array for the frequencies, a new array if None
+
+        Returns
+        -------
+
+            : ~numpy.ndarray
+            array of frequencies
+        """
         l = self.l_array.searchsorted(xis[0]*self.l_coef) + 1.
-        xis_prod = np.prod(xis[1:], 0)
-        x = ne.evaluate('-log(xis_prod)/l')
+        xi1, xi2, xi3, xi4 = xis[1:]
+        nu_unit = (const.k_B.cgs.value * T) / const.h.cgs.value
 
-        return x * (const.k_B.cgs.value * T) / const.h.cgs.value
+        return ne.evaluate('-log(xi1 * xi2 * xi3 * xi4) / l * nu_unit',
+                           out=out)
 
-    def create_packet_mus(self, no_of_packets):
+
+class SobolBlackBodySource(BlackBodySimpleSource):
+    """
+    Blackbody packet source that draws the packets from a scrambled Sobol
+    sequence (random linear matrix scrambling and a random digital shift)
+    instead of pseudo random numbers. The first five coordinates of a point
+    give the frequency of a packet as in `BlackBodySimpleSource`, the sixth
+    its direction. The low discrepancy of
+    the points spreads the packets more evenly over frequency and angle, so
+    the noise of the estimators and spectra falls faster with the number of
+    packets. Consecutive calls continue the sequence, so the packets of the
+    chunks and iterations of a run are not drawn from the same points again.
+    """
+    def __init__(self, seed, l_samples=1000, chunk_size=65536):
+        super(SobolBlackBodySource, self).__init__(seed, l_samples,
+                                                   chunk_size)
+        self.sequence = montecarlo.SobolSequence(6, seed)
+
+    def create_packets(self, T, no_of_packets):
+        nus = np.empty(no_of_packets)
+        mus = np.empty(no_of_packets)
+        for start, end in self.iter_chunks(no_of_packets):
+            xis = self.sequence.draw(end - start)
+            self.blackbody_nus(T, xis[:5], out=nus[start:end])
+            np.sqrt(xis[5], out=mus[start:end])
+        energies = self.create_packet_energies(no_of_packets)
+
+        return nus, mus, energies
+
+
+class StratifiedBlackBodySource(BlackBodySimpleSource):
+    """
+    Blackbody packet source with stratified and importance sampled packets.
+
+    The frequency range up to `x_max` (in units of :math:`x=h\\nu/kT`) is
+    split into `x_samples` cells. The packets are drawn from the piecewise
+    constant density :math:`q(x)` with cell probabilities proportional to the
+    Planck function times the oversampling factor :math:`w` of the bands the
+    cell lies in, one packet from each of the <no_of_packets> strata of equal
+    probability. A packet at :math:`x` gets the energy
+
+    .. math::
+        \\frac{B(x)}{N q(x)}, \\qquad
+        B(x) = \\frac{15}{\\pi^4}\\frac{x^3}{e^x - 1},
+
+    so the packets are an unbiased sample of the blackbody and the oversampled
+    bands get more packets with less energy each. The values of
+    :math:`\\mu^2` are stratified in the same way and randomly paired with the
+    frequencies.
+
+    Parameters
+    ----------
+    seed : int
+    bands : list of (float, float, float)
+        start frequency, end frequency and oversampling factor of every band,
+        the factors of overlapping bands multiply
+    x_samples : int
+    x_max : float
+    chunk_size : int
+    """
+    def __init__(self, seed, bands=(), x_samples=10000, x_max=60.0,
+                 chunk_size=65536):
+        super(StratifiedBlackBodySource, self).__init__(
+            seed, chunk_size=chunk_size)
+        self.bands = list(bands)
+        self.x_edges = np.linspace(0, x_max, x_samples + 1)
+        self.x_centers = 0.5 * (self.x_edges[1:] + self.x_edges[:-1])
+        self.delta_x = x_max / x_samples
+
+    @staticmethod
+    def planck(x):
         """
-        Create
-        :param no_of_packets:
-        :return:
+        Planck function in units of :math:`x=h\\nu/kT`, normalized to unity
         """
-        return np.sqrt(np.random.random(no_of_packets))
+        return 15 / np.pi**4 * x**3 / np.expm1(x)
 
-    def create_packet_energies(self, no_of_packets):
-        return np.ones(no_of_packets) / no_of_packets
+    def stratified_uniforms(self, strata, no_of_packets):
+        """
+        Uniform deviates with one deviate in each of the given <strata> out
+        of <no_of_packets> intervals of equal width
+        """
+        return ((strata + self.random_state.random_sample(strata.size)) /
+                no_of_packets)
 
+    def create_packet_nus_energies(self, T, no_of_packets):
+        """
+        Create <no_of_packets> packets with the frequencies and energies of a
+        blackbody of temperature <T>, oversampled in the bands
+
+        Parameters
+        ----------
+        T : ~float
+            temperature
+        no_of_packets: ~int
+
+        Returns
+        -------
+
+            : ~numpy.ndarray
+            array of frequencies
+            : ~numpy.ndarray
+            array of energies
+        """
+        nu_to_x = const.h.cgs.value / (const.k_B.cgs.value * T)
+        oversampling = np.ones_like(self.x_centers)
+        for nu_start, nu_end, band_oversampling in self.bands:
+            oversampling[(self.x_centers >= nu_start * nu_to_x) &
+                         (self.x_centers < nu_end * nu_to_x)] *= (
+                band_oversampling)
+
+        cell_probabilities = oversampling * self.planck(self.x_centers)
+        cell_probabilities /= cell_probabilities.sum()
+        cdf = np.zeros(len(cell_probabilities) + 1)
+        np.cumsum(cell_probabilities, out=cdf[1:])
+        cdf[-1] = 1.0
+
+        nus = np.empty(no_of_packets)
+        energies = np.empty(no_of_packets)
+        # the strata in random order, every chunk samples its share of them
+        strata = self.random_state.permutation(no_of_packets)
+        for start, end in self.iter_chunks(no_of_packets):
+            xis = self.stratified_uniforms(strata[start:end], no_of_packets)
+            cells = np.clip(cdf.searchsorted(xis, side='right') - 1, 0,
+                            len(cell_probabilities) - 1)
+            x = self.x_edges[cells] + self.delta_x * (
+                (xis - cdf[cells]) / cell_probabilities[cells])
+            density = cell_probabilities[cells] / self.delta_x
+            nus[start:end] = x / nu_to_x
+            energies[start:end] = self.planck(x) / (density * no_of_packets)
+
+        return nus, energies
+
+    def create_packet_mus(self, no_of_packets):
+        mus = np.empty(no_of_packets)
+        strata = self.random_state.permutation(no_of_packets)
+        for start, end in self.iter_chunks(no_of_packets):
+            np.sqrt(self.stratified_uniforms(strata[start:end],
+                                             no_of_packets),
+                    out=mus[start:end])
+
+        return mus
 
     def create_packets(self, T, no_of_packets):
-        nus = self.create_packet_nus(T, no_of_packets)
+        nus, energies = self.create_packet_nus_energies(T, no_of_packets)
         mus = self.create_packet_mus(no_of_packets)
-        energies = self.create_packet_energies(no_of_packets)
 
-        return nus, mus, energies
\ No newline at end of file
+        return nus, mus, energies
+
+
+class TabulatedSpectrumSource(BasePacketSource):
+    """
+    Packet source for an arbitrary spectrum of the inner boundary, given as
+    luminosity densities in frequency bins. The luminosity density is
+    constant within a bin, so the cumulative distribution is piecewise
+    linear. It is tabulated once and inverted by a lookup in the table and a
+    linear interpolation within the bin.
+
+    The shape of the spectrum does not depend on the temperature passed to
+    `create_packets`. The luminosity of the inner boundary still follows from
+    its temperature.
+
+    Parameters
+    ----------
+    seed : int
+    nu_bins : ~numpy.ndarray
+        edges of the frequency bins in Hz
+    luminosity_density : ~numpy.ndarray
+        luminosity density in every bin, in arbitrary units
+    chunk_size : int
+    """
+    def __init__(self, seed, nu_bins, luminosity_density, chunk_size=65536):
+        super(TabulatedSpectrumSource, self).__init__(seed, chunk_size)
+        nu_bins = np.asarray(nu_bins, dtype=np.float64)
+        luminosity_density = np.asarray(luminosity_density, dtype=np.float64)
+        if nu_bins.size != luminosity_density.size + 1:
+            raise ValueError('Need one more frequency bin edge than '
+                             'luminosity densities')
+        if nu_bins[0] > nu_bins[-1]:
+            nu_bins = nu_bins[::-1]
+            luminosity_density = luminosity_density[::-1]
+        bin_widths = np.diff(nu_bins)
+        if np.any(bin_widths <= 0) or np.any(luminosity_density < 0):
+            raise ValueError('The frequency bins need to be monotonic and '
+                             'the luminosity densities non-negative')
+        bin_probabilities = luminosity_density * bin_widths
+        if bin_probabilities.sum() <= 0:
+            raise ValueError('The tabulated spectrum has no luminosity')
+        bin_probabilities /= bin_probabilities.sum()
+
+        self.nu_bins = nu_bins
+        self.cdf = np.zeros(nu_bins.size)
+        np.cumsum(bin_probabilities, out=self.cdf[1:])
+        self.cdf[-1] = 1.0
+        # frequency per probability in every bin, bins without luminosity
+        # are never chosen
+        self.bin_slopes = np.zeros_like(bin_widths)
+        np.divide(bin_widths, bin_probabilities, out=self.bin_slopes,
+                  where=bin_probabilities > 0)
+
+    @classmethod
+    def from_ascii(cls, seed, fname, chunk_size=65536):
+        """
+        Read the spectrum from an ASCII file with the wavelength in Angstrom
+        in the first column and the luminosity density per wavelength in the
+        second, e.g. one written by `TARDISSpectrum.to_ascii`. The bins lie
+        between the tabulated wavelengths, with the mean luminosity density
+        per frequency of their edges.
+
+        Parameters
+        ----------
+        seed : int
+        fname : str
+        chunk_size : int
+
+        Returns
+        -------
+
+            : TabulatedSpectrumSource
+        """
+        wavelength, luminosity_density_lambda = np.loadtxt(fname, unpack=True)
+        nu_bins = const.c.cgs.value / (wavelength * 1e-8)
+        # L_nu = L_lambda * lambda^2 / c, in arbitrary units
+        luminosity_density = luminosity_density_lambda * wavelength ** 2
+        return cls(seed, nu_bins,
+                   0.5 * (luminosity_density[:-1] + luminosity_density[1:]),
+                   chunk_size=chunk_size)
+
+    def create_packet_nus(self, T, no_of_packets):
+        """
+        Create <no_of_packets> packets with frequencies of the tabulated
+        spectrum
+
+        Parameters
+        ----------
+        T : ~float
+            temperature, not used
+        no_of_packets: ~int
+
+        Returns
+        -------
+
+            : ~numpy.ndarray
+            array of frequencies
+        """
+        nus = np.empty(no_of_packets)
+        for start, end in self.iter_chunks(no_of_packets):
+            xis = self.random_state.random_sample(end - start)
+            bins = self.cdf.searchsorted(xis, side='right') - 1
+            nus[start:end] = self.nu_bins[bins] + (
+                (xis - self.cdf[bins]) * self.bin_slopes[bins])
+
+        return nus
@@ -1,4 +1,5 @@
 #include <inttypes.h>
+#include <time.h>
 #ifdef WITHOPENMP
 #include <omp.h>
 #endif
@@ -77,6 +78,148 @@ line_search (const double *nu, double nu_insert, int64_t number_of_lines,
   return ret_val;
 }
 
+tardis_error_t
+indexed_line_search (const line_search_index_t *index, const double *nu,
+                     double nu_insert, int64_t number_of_lines,
+                     int64_t * result)
+{
+  int64_t imin, imax, imid, bucket;
+  if (nu_insert > nu[0])
+    {
+      *result = 0;
+    }
+  else if (nu_insert < nu[number_of_lines - 1])
+    {
+      *result = number_of_lines;
+    }
+  else
+    {
+      bucket = (int64_t) ((index->log_nu_max - log (nu_insert)) *
+                          index->inverse_delta_log_nu);
+      if (bucket < 0)
+        {
+          bucket = 0;
+        }
+      else if (bucket >= index->no_of_buckets)
+        {
+          bucket = index->no_of_buckets - 1;
+        }
+      imin = index->bucket_line_ids[bucket];
+      imax = index->bucket_line_ids[bucket + 1];
+      // Rounding in the bucket computation may pick a neighbouring bucket.
+      while (imin > 0 && nu[imin - 1] < nu_insert)
+        {
+          --imin;
+        }
+      while (imax < number_of_lines && nu[imax] >= nu_insert)
+        {
+          ++imax;
+        }
+      // First line in [imin, imax) that is redder than nu_insert.
+      while (imin < imax)
+        {
+          imid = imin + ((imax - imin) >> 1);
+          if (nu[imid] < nu_insert)
+            {
+              imax = imid;
+            }
+          else
+            {
+              imin = imid + 1;
+            }
+        }
+      *result = imin;
+    }
+  return TARDIS_ERROR_OK;
+}
+
+int64_t
+shell_line_seek (const storage_model_t * storage, int64_t shell_id,
+                 int64_t transport_line_id, int64_t hint)
+{
+  const int64_t *ids = storage->shell_line_ids;
+  int64_t start = storage->shell_line_offsets[shell_id];
+  int64_t end = storage->shell_line_offsets[shell_id + 1];
+  int64_t imin = start - 1;
+  int64_t imax = end;
+  int64_t imid, step = 1;
+  // Narrow (imin, imax] down with doubling steps away from the hint.
+  if (hint >= start && hint < end)
+    {
+      if (ids[hint] < transport_line_id)
+        {
+          imin = hint;
+          imax = hint + 1;
+          while (imax < end && ids[imax] < transport_line_id)
+            {
+              imin = imax;
+              step *= 2;
+              imax = imin + step;
+            }
+          if (imax > end)
+            {
+              imax = end;
+            }
+        }
+      else
+        {
+          imax = hint;
+          imin = hint - 1;
+          while (imin >= start && ids[imin] >= transport_line_id)
+            {
+              imax = imin;
+              step *= 2;
+              imin = imax - step;
+            }
+          if (imin < start)
+            {
+              imin = start - 1;
+            }
+        }
+    }
+  imin++;
+  while (imin < imax)
+    {
+      imid = imin + ((imax - imin) >> 1);
+      if (ids[imid] < transport_line_id)
+        {
+          imin = imid + 1;
+        }
+      else
+        {
+          imax = imid;
+        }
+    }
+  return imin;
+}
+
+/** Line frequencies that the next line ids of the packets refer to.
+ *
+ * @param storage storage model data
+ *
+ * @return the per shell line frequencies or the line list of the transport
+ */
+static inline const double *
+transport_line_list_nu (const storage_model_t * storage)
+{
+  return storage->shell_line_offsets == NULL ? storage->line_list_nu :
+    storage->shell_line_list_nu;
+}
+
+/** Id in the line list of the transport of the line a next line id refers to.
+ *
+ * @param storage storage model data
+ * @param next_line_id next line id of a packet
+ *
+ * @return id in the line list of the transport
+ */
+static inline int64_t
+transport_line_id (const storage_model_t * storage, int64_t next_line_id)
+{
+  return storage->shell_line_offsets == NULL ? next_line_id :
+    storage->shell_line_ids[next_line_id];
+}
+
 double
 rpacket_doppler_factor (const rpacket_t *packet, const storage_model_t *storage)
 {
@@ -194,28 +337,29 @@ compute_distance2line (const rpacket_t * packet, const storage_model_t * storage
       double comov_nu = nu * doppler_factor;
       if (comov_nu < nu_line)
 	{
-	  if (rpacket_get_next_line_id (packet) == storage->no_of_lines - 1)
+	  if (rpacket_get_next_line_id (packet) ==
+	      transport_line_list_end (storage, cur_zone_id) - 1)
 	    {
 	      fprintf (stderr, "last_line = %f\n",
-		       storage->
-		       line_list_nu[rpacket_get_next_line_id (packet) - 1]);
+		       transport_line_list_nu (storage)
+		       [rpacket_get_next_line_id (packet) - 1]);
 	      fprintf (stderr, "Last line in line list reached!");
 	    }
 	  else if (rpacket_get_next_line_id (packet) == 0)
 	    {
 	      fprintf (stderr, "First line in line list!");
 	      fprintf (stderr, "next_line = %f\n",
-		       storage->
-		       line_list_nu[rpacket_get_next_line_id (packet) + 1]);
+		       transport_line_list_nu (storage)
+		       [rpacket_get_next_line_id (packet) + 1]);
 	    }
 	  else
 	    {
 	      fprintf (stderr, "last_line = %f\n",
-		       storage->
-		       line_list_nu[rpacket_get_next_line_id (packet) - 1]);
+		       transport_line_list_nu (storage)
+		       [rpacket_get_next_line_id (packet) - 1]);
 	      fprintf (stderr, "next_line = %f\n",
-		       storage->
-		       line_list_nu[rpacket_get_next_line_id (packet) + 1]);
+		       transport_line_list_nu (storage)
+		       [rpacket_get_next_line_id (packet) + 1]);
 	    }
 	  fprintf (stderr, "ERROR: Comoving nu less than nu_line!\n");
 	  fprintf (stderr, "comov_nu = %f\n", comov_nu);
@@ -288,31 +432,180 @@ compute_distance2continuum(rpacket_t * packet, storage_model_t * storage)
 	}
 }
 
+/** Find the transition of a macro atom block that is chosen by a random number.
+ *
+ * @param cumulative_probabilities cumulative transition probabilities of the shell
+ * @param imin first transition of the block
+ * @param imax end of the block
+ * @param event_random uniform random number
+ *
+ * @return first transition with a cumulative probability above event_random
+ */
+static inline int64_t
+macro_atom_sample_transition (const double *cumulative_probabilities,
+                              int64_t imin, int64_t imax, double event_random)
+{
+  int64_t imid;
+  // The last transition is taken if the block sums up to less than event_random.
+  --imax;
+  while (imin < imax)
+    {
+      imid = imin + ((imax - imin) >> 1);
+      if (cumulative_probabilities[imid] > event_random)
+        {
+          imax = imid;
+        }
+      else
+        {
+          imin = imid + 1;
+        }
+    }
+  return imin;
+}
+
 int64_t
-macro_atom (const rpacket_t * packet, const storage_model_t * storage, rk_state *mt_state)
+macro_atom (const rpacket_t * packet, const storage_model_t * storage, philox_state_t *rng_state)
 {
-  int emit = 0, i = 0, probability_idx = -1;
-  int activate_level =
-    storage->line2macro_level_upper[rpacket_get_next_line_id (packet) - 1];
+  int64_t emit = 0, i = 0, probability_idx = -1;
+  int64_t activate_level =
+    storage->line2macro_level_upper[transport_line_id
+				    (storage,
+				     rpacket_get_next_line_id (packet) - 1)];
+  int64_t shell_id = rpacket_get_current_shell_id (packet);
+  if (storage->level_emission_offsets != NULL &&
+      storage->level_emission_offsets[activate_level] >= 0)
+    {
+      // Sample the emission of the whole random walk at once.
+      int64_t offset = storage->level_emission_offsets[activate_level];
+      i = macro_atom_sample_transition (
+            storage->cumulative_emission_probabilities +
+            shell_id * storage->no_of_emission_entries, offset,
+            offset + storage->level_emission_counts[activate_level],
+            philox_double (rng_state));
+      return storage->emission_line_ids[i];
+    }
+  const double *cumulative_probabilities = NULL;
+  if (storage->cumulative_transition_probabilities != NULL)
+    {
+      cumulative_probabilities = storage->cumulative_transition_probabilities +
+        shell_id * storage->no_of_transitions;
+    }
   while (emit != -1)
     {
-      double event_random = rk_double (mt_state);
-      i = storage->macro_block_references[activate_level] - 1;
-      double p = 0.0;
-      do
-	{
-
-	  probability_idx = ((++i) * storage->no_of_shells +
-	  rpacket_get_current_shell_id (packet));
-	  p += storage->transition_probabilities[probability_idx];
-	}
-      while (p <= event_random);
+      double event_random = philox_double (rng_state);
+      if (cumulative_probabilities != NULL)
+        {
+          i = macro_atom_sample_transition (cumulative_probabilities,
+                storage->macro_block_references[activate_level],
+                storage->macro_block_references[activate_level + 1],
+                event_random);
+        }
+      else
+        {
+          i = storage->macro_block_references[activate_level] - 1;
+          double p = 0.0;
+          do
+            {
+              ++i;
+              probability_idx = storage->shell_major_line_lists ?
+                shell_id * storage->no_of_transitions + i :
+                i * storage->no_of_shells + shell_id;
+              p += storage->transition_probabilities[probability_idx];
+            }
+          while (p <= event_random);
+        }
       emit = storage->transition_type[i];
       activate_level = storage->destination_level_id[i];
     }
   return storage->transition_line_id[i];
 }
 
+#define SPARSE_ESTIMATOR_INITIAL_CAPACITY 4096
+// Bytes per slot of a sparse estimator, an index and a value
+#define SPARSE_ESTIMATOR_SLOT_SIZE (sizeof (int64_t) + sizeof (double))
+
+static inline int64_t
+sparse_estimator_slot (int64_t index, int64_t capacity)
+{
+  uint64_t hash = (uint64_t) index * 0x9E3779B97F4A7C15ULL;
+  return (int64_t) ((hash ^ (hash >> 32)) & (uint64_t) (capacity - 1));
+}
+
+void
+sparse_estimator_init (sparse_estimator_t * estimator, int64_t capacity)
+{
+  estimator->size = 0;
+  estimator->capacity = capacity;
+  estimator->max_capacity = capacity;
+  estimator->overflow_values = NULL;
+  estimator->indices = (int64_t *) malloc (sizeof (int64_t) * capacity);
+  estimator->values = (double *) calloc (capacity, sizeof (double));
+  for (int64_t i = 0; i < capacity; i++)
+    {
+      estimator->indices[i] = -1;
+    }
+}
+
+void
+sparse_estimator_free (sparse_estimator_t * estimator)
+{
+  free (estimator->indices);
+  free (estimator->values);
+  estimator->indices = NULL;
+  estimator->values = NULL;
+  estimator->size = 0;
+  estimator->capacity = 0;
+}
+
+static void
+sparse_estimator_grow (sparse_estimator_t * estimator)
+{
+  sparse_estimator_t grown;
+  sparse_estimator_init (&grown, 2 * estimator->capacity);
+  grown.max_capacity = estimator->max_capacity;
+  grown.overflow_values = estimator->overflow_values;
+  for (int64_t i = 0; i < estimator->capacity; i++)
+    {
+      if (estimator->indices[i] != -1)
+	{
+	  sparse_estimator_add (&grown, estimator->indices[i],
+				estimator->values[i]);
+	}
+    }
+  sparse_estimator_free (estimator);
+  *estimator = grown;
+}
+
+void
+sparse_estimator_add (sparse_estimator_t * estimator, int64_t index,
+		      double value)
+{
+  bool full = 2 * (estimator->size + 1) > estimator->capacity;
+  if (full && 2 * estimator->capacity <= estimator->max_capacity)
+    {
+      sparse_estimator_grow (estimator);
+      full = false;
+    }
+  int64_t slot = sparse_estimator_slot (index, estimator->capacity);
+  while (estimator->indices[slot] != index && estimator->indices[slot] != -1)
+    {
+      slot = (slot + 1) & (estimator->capacity - 1);
+    }
+  if (estimator->indices[slot] == -1)
+    {
+      if (full)
+	{
+	  // The shared array is updated by all threads of a full map.
+#pragma omp atomic
+	  estimator->overflow_values[index] += value;
+	  return;
+	}
+      estimator->indices[slot] = index;
+      estimator->size++;
+    }
+  estimator->values[slot] += value;
+}
+
 double
 move_packet (rpacket_t * packet, storage_model_t * storage, double distance)
 {
@@ -330,14 +623,9 @@ move_packet (rpacket_t * packet, storage_model_t * storage, double distance)
 	{
 	  double comov_energy = rpacket_get_energy (packet) * doppler_factor;
 	  double comov_nu = rpacket_get_nu (packet) * doppler_factor;
-#ifdef WITHOPENMP
-#pragma omp atomic
-#endif
+	  // The estimators of a thread storage are private, no atomics needed.
 	  storage->js[rpacket_get_current_shell_id (packet)] +=
 	    comov_energy * distance;
-#ifdef WITHOPENMP
-#pragma omp atomic
-#endif
 	  storage->nubars[rpacket_get_current_shell_id (packet)] +=
 	    comov_energy * distance * comov_nu;
 	}
@@ -349,6 +637,12 @@ void
 increment_j_blue_estimator (const rpacket_t * packet, storage_model_t * storage,
 			    double d_line, int64_t j_blue_idx)
 {
+  if (storage->line_lists_j_blues == NULL &&
+      storage->line_lists_j_blues_sparse == NULL)
+    {
+      // The j_blue estimator is only needed for detailed radiative rates.
+      return;
+    }
   double r = rpacket_get_r (packet);
   double r_interaction =
     sqrt (r * r + d_line * d_line +
@@ -357,58 +651,309 @@ increment_j_blue_estimator (const rpacket_t * packet, storage_model_t * storage,
   double doppler_factor = 1.0 - mu_interaction * r_interaction *
     storage->inverse_time_explosion * INVERSE_C;
   double comov_energy = rpacket_get_energy (packet) * doppler_factor;
-#ifdef WITHOPENMP
-#pragma omp atomic
-#endif
-  storage->line_lists_j_blues[j_blue_idx] +=
-    comov_energy / rpacket_get_nu (packet);
+  if (storage->line_lists_j_blues_sparse != NULL)
+    {
+      sparse_estimator_add (storage->line_lists_j_blues_sparse, j_blue_idx,
+			    comov_energy / rpacket_get_nu (packet));
+    }
+  else
+    {
+      storage->line_lists_j_blues[j_blue_idx] +=
+	comov_energy / rpacket_get_nu (packet);
+    }
+}
+
+/** Allocate the virtual packet arrays of a storage.
+ *
+ * Nothing is allocated if virtual packet logging is switched off.
+ *
+ * @param storage storage model data
+ * @param size initial number of virtual packets that fit in the arrays
+ */
+static void
+montecarlo_virtual_packets_init (storage_model_t * storage, int64_t size)
+{
+  storage->virt_packet_count = 0;
+  if (!storage->virt_packet_logging)
+    {
+      size = 0;
+    }
+  storage->virt_array_size = size;
+  storage->virt_packet_nus = (double *) malloc (sizeof (double) * size);
+  storage->virt_packet_energies = (double *) malloc (sizeof (double) * size);
+  storage->virt_packet_last_interaction_in_nu =
+    (double *) malloc (sizeof (double) * size);
+  storage->virt_packet_last_interaction_type =
+    (int64_t *) malloc (sizeof (int64_t) * size);
+  storage->virt_packet_last_line_interaction_in_id =
+    (int64_t *) malloc (sizeof (int64_t) * size);
+  storage->virt_packet_last_line_interaction_out_id =
+    (int64_t *) malloc (sizeof (int64_t) * size);
+}
+
+/** Shrink the virtual packet arrays of a storage to the number of stored
+ * virtual packets.
+ *
+ * @param storage storage model data
+ */
+static void
+montecarlo_virtual_packets_shrink (storage_model_t * storage)
+{
+  // Keep at least one element, realloc to size zero may free the array.
+  int64_t size = storage->virt_packet_count > 0 ? storage->virt_packet_count : 1;
+  if (size >= storage->virt_array_size)
+    {
+      return;
+    }
+  storage->virt_array_size = size;
+  storage->virt_packet_nus = realloc(storage->virt_packet_nus, sizeof(double) * size);
+  storage->virt_packet_energies = realloc(storage->virt_packet_energies, sizeof(double) * size);
+  storage->virt_packet_last_interaction_in_nu = realloc(storage->virt_packet_last_interaction_in_nu, sizeof(double) * size);
+  storage->virt_packet_last_interaction_type = realloc(storage->virt_packet_last_interaction_type, sizeof(int64_t) * size);
+  storage->virt_packet_last_line_interaction_in_id = realloc(storage->virt_packet_last_line_interaction_in_id, sizeof(int64_t) * size);
+  storage->virt_packet_last_line_interaction_out_id = realloc(storage->virt_packet_last_line_interaction_out_id, sizeof(int64_t) * size);
+}
+
+/** Whether the last interactions of a packet are stored. Split packets have
+ * the id -1, they have no entry in the packet arrays and must not overwrite
+ * the last interactions of the packet they were split off.
+ *
+ * @param storage storage model data
+ * @param packet rpacket structure with packet information
+ *
+ * @return true if the last interactions of the packet are stored
+ */
+static inline bool
+last_interactions_tracked (const storage_model_t * storage,
+			   const rpacket_t * packet)
+{
+  return storage->last_interaction_type != NULL &&
+    rpacket_get_id (packet) >= 0;
+}
+
+/** Take the state of a spawned virtual packet and the last interaction of
+ * its real packet, which may have changed by the time the virtual packet is
+ * transported.
+ *
+ * @param virtual_packet virtual packet to initialize
+ * @param storage storage model data
+ * @param packet spawned virtual rpacket
+ * @param weight weight of the virtual packet in the virtual spectrum
+ */
+static void
+virtual_packet_init (virtual_packet_t * virtual_packet,
+		     const storage_model_t * storage, const rpacket_t * packet,
+		     double weight)
+{
+  virtual_packet->nu = rpacket_get_nu (packet);
+  virtual_packet->mu = rpacket_get_mu (packet);
+  virtual_packet->energy = rpacket_get_energy (packet);
+  virtual_packet->r = rpacket_get_r (packet);
+  virtual_packet->weight = weight;
+  virtual_packet->current_shell_id = rpacket_get_current_shell_id (packet);
+  virtual_packet->next_line_id = rpacket_get_next_line_id (packet);
+  virtual_packet->next_transport_line_id =
+    rpacket_get_next_transport_line_id (packet);
+  virtual_packet->last_line = rpacket_get_last_line (packet);
+  virtual_packet->close_line = rpacket_get_close_line (packet);
+  virtual_packet->recently_crossed_boundary =
+    rpacket_get_recently_crossed_boundary (packet);
+  virtual_packet->current_continuum_id =
+    rpacket_get_current_continuum_id (packet);
+  if (last_interactions_tracked (storage, packet))
+    {
+      int64_t id = rpacket_get_id (packet);
+      virtual_packet->last_interaction_in_nu =
+	storage->last_interaction_in_nu[id];
+      virtual_packet->last_interaction_type =
+	storage->last_interaction_type[id];
+      virtual_packet->last_line_interaction_in_id =
+	storage->last_line_interaction_in_id[id];
+      virtual_packet->last_line_interaction_out_id =
+	storage->last_line_interaction_out_id[id];
+    }
+  else
+    {
+      // The last interactions of the real packet are not tracked.
+      virtual_packet->last_interaction_in_nu = 0.0;
+      virtual_packet->last_interaction_type = -1;
+      virtual_packet->last_line_interaction_in_id = -1;
+      virtual_packet->last_line_interaction_out_id = -1;
+    }
+}
+
+/** Append a virtual packet to a queue.
+ *
+ * @param queue queue of a thread
+ * @param virtual_packet virtual packet to append
+ */
+static void
+virtual_packet_queue_push (virtual_packet_queue_t * queue,
+			   const virtual_packet_t * virtual_packet)
+{
+  if (queue->size >= queue->capacity)
+    {
+      queue->capacity = 2 * queue->capacity + 1;
+      queue->packets = realloc (queue->packets,
+				sizeof (virtual_packet_t) * queue->capacity);
+    }
+  queue->packets[queue->size] = *virtual_packet;
+  queue->size += 1;
+}
+
+/** Bin an escaped virtual packet into the virtual spectrum and, if virtual
+ * packet logging is switched on, append it to the virtual packet arrays.
+ * Virtual packets outside of the spectrum are not recorded.
+ *
+ * Only the arrays of the given storage are modified. Each OpenMP thread
+ * records into its own thread storage, so no locking is required.
+ *
+ * @param storage storage model data
+ * @param virtual_packet virtual packet as it was spawned
+ * @param packet escaped virtual rpacket
+ */
+static void
+montecarlo_record_virtual_packet (storage_model_t * storage,
+				  const virtual_packet_t * virtual_packet,
+				  const rpacket_t * packet)
+{
+  double nu = rpacket_get_nu (packet);
+  if (nu >= storage->spectrum_end_nu || nu <= storage->spectrum_start_nu)
+    {
+      return;
+    }
+  double energy = rpacket_get_energy (packet) * virtual_packet->weight;
+  int64_t virt_id_nu =
+    floor ((nu - storage->spectrum_start_nu) / storage->spectrum_delta_nu);
+  storage->spectrum_virt_nu[virt_id_nu] += energy;
+  if (storage->spectrum_virt_nu_squared != NULL)
+    {
+      storage->spectrum_virt_nu_squared[virt_id_nu] += energy * energy;
+    }
+  if (!storage->virt_packet_logging)
+    {
+      return;
+    }
+  if (storage->virt_packet_count >= storage->virt_array_size)
+    {
+      storage->virt_array_size = 2 * storage->virt_array_size + 1;
+      storage->virt_packet_nus = realloc(storage->virt_packet_nus, sizeof(double) * storage->virt_array_size);
+      storage->virt_packet_energies = realloc(storage->virt_packet_energies, sizeof(double) * storage->virt_array_size);
+      storage->virt_packet_last_interaction_in_nu = realloc(storage->virt_packet_last_interaction_in_nu, sizeof(double) * storage->virt_array_size);
+      storage->virt_packet_last_interaction_type = realloc(storage->virt_packet_last_interaction_type, sizeof(int64_t) * storage->virt_array_size);
+      storage->virt_packet_last_line_interaction_in_id = realloc(storage->virt_packet_last_line_interaction_in_id, sizeof(int64_t) * storage->virt_array_size);
+      storage->virt_packet_last_line_interaction_out_id = realloc(storage->virt_packet_last_line_interaction_out_id, sizeof(int64_t) * storage->virt_array_size);
+    }
+  int64_t idx = storage->virt_packet_count;
+  storage->virt_packet_nus[idx] = nu;
+  storage->virt_packet_energies[idx] = energy;
+  storage->virt_packet_last_interaction_in_nu[idx] =
+    virtual_packet->last_interaction_in_nu;
+  storage->virt_packet_last_interaction_type[idx] =
+    virtual_packet->last_interaction_type;
+  storage->virt_packet_last_line_interaction_in_id[idx] =
+    virtual_packet->last_line_interaction_in_id;
+  storage->virt_packet_last_line_interaction_out_id[idx] =
+    virtual_packet->last_line_interaction_out_id;
+  storage->virt_packet_count += 1;
+}
+
+/** Number of virtual packets to spawn from a packet. If the counts are
+ * adapted to the noise of the virtual spectrum, it is the largest count of
+ * the bins the virtual packets can be recorded in: their lab frame
+ * frequencies follow from the comoving frequency of the packet and their
+ * directions between mu_min and 1.
+ *
+ * @param storage storage model data
+ * @param packet rpacket structure with packet information
+ * @param mu_min smallest direction cosine of the virtual packets
+ *
+ * @return number of virtual packets
+ */
+static inline int64_t
+virtual_packet_count (const storage_model_t * storage,
+		      const rpacket_t * packet, double mu_min)
+{
+  if (storage->virtual_packet_counts == NULL)
+    {
+      return rpacket_get_virtual_packet_flag (packet);
+    }
+  double beta = rpacket_get_r (packet) * storage->inverse_time_explosion *
+    INVERSE_C;
+  double comov_nu = rpacket_get_nu (packet) *
+    rpacket_doppler_factor (packet, storage);
+  double nu_start = comov_nu / (1.0 - mu_min * beta);
+  double nu_end = comov_nu / (1.0 - beta);
+  if (nu_end <= storage->spectrum_start_nu ||
+      nu_start >= storage->spectrum_end_nu)
+    {
+      return rpacket_get_virtual_packet_flag (packet);
+    }
+  int64_t first_bin = nu_start <= storage->spectrum_start_nu ? 0 :
+    (int64_t) floor ((nu_start - storage->spectrum_start_nu) /
+		     storage->spectrum_delta_nu);
+  int64_t last_bin = nu_end >= storage->spectrum_end_nu ?
+    storage->no_of_spectrum_bins - 1 :
+    (int64_t) floor ((nu_end - storage->spectrum_start_nu) /
+		     storage->spectrum_delta_nu);
+  int64_t count = 0;
+  for (int64_t i = first_bin; i <= last_bin; ++i)
+    {
+      if (storage->virtual_packet_counts[i] > count)
+	{
+	  count = storage->virtual_packet_counts[i];
+	}
+    }
+  return count;
 }
 
 int64_t
 montecarlo_one_packet (storage_model_t * storage, rpacket_t * packet,
-		       int64_t virtual_mode, rk_state *mt_state)
+		       int64_t virtual_mode, philox_state_t *rng_state)
 {
   int64_t reabsorbed=-1;
   if (virtual_mode == 0)
     {
-      reabsorbed = montecarlo_one_packet_loop (storage, packet, 0, mt_state);
+      reabsorbed = montecarlo_one_packet_loop (storage, packet, 0, rng_state);
     }
   else
     {
       if ((rpacket_get_nu (packet) > storage->spectrum_virt_start_nu) && (rpacket_get_nu(packet) < storage->spectrum_virt_end_nu))
 	{
-	  for (int64_t i = 0; i < rpacket_get_virtual_packet_flag (packet); i++)
+	  double mu_min;
+	  if (rpacket_get_r(packet) > storage->r_inner[0])
+	    {
+	      mu_min =
+		-1.0 * sqrt (1.0 -
+			     (storage->r_inner[0] / rpacket_get_r(packet)) *
+			     (storage->r_inner[0] / rpacket_get_r(packet)));
+	    }
+	  else
+	    {
+	      mu_min = 0.0;
+	    }
+	  int64_t no_of_virtual_packets =
+	    virtual_packet_count (storage, packet, mu_min);
+	  for (int64_t i = 0; i < no_of_virtual_packets; i++)
 	    {
               double weight;
               rpacket_t virt_packet = *packet;
-              double mu_min;
-	      if (rpacket_get_r(&virt_packet) > storage->r_inner[0])
-		{
-		  mu_min =
-		    -1.0 * sqrt (1.0 -
-				 (storage->r_inner[0] / rpacket_get_r(&virt_packet)) *
-				 (storage->r_inner[0] / rpacket_get_r(&virt_packet)));
-		}
-	      else
-		{
-		  mu_min = 0.0;
-		}
-	      double mu_bin = (1.0 - mu_min) / rpacket_get_virtual_packet_flag (packet);
-	      rpacket_set_mu(&virt_packet,mu_min + (i + rk_double (mt_state)) * mu_bin);
+	      double mu_bin = (1.0 - mu_min) / no_of_virtual_packets;
+	      rpacket_set_mu(&virt_packet,mu_min + (i + philox_double (rng_state)) * mu_bin);
 	      switch (virtual_mode)
 		{
 		case -2:
-		  weight = 1.0 / rpacket_get_virtual_packet_flag (packet);
+		  weight = 1.0 / no_of_virtual_packets;
 		  break;
 		case -1:
 		  weight =
 		    2.0 * rpacket_get_mu(&virt_packet) /
-		    rpacket_get_virtual_packet_flag (packet);
+		    no_of_virtual_packets;
 		  break;
 		case 1:
 		  weight =
 		    (1.0 -
-		     mu_min) / 2.0 / rpacket_get_virtual_packet_flag (packet);
+		     mu_min) / 2.0 / no_of_virtual_packets;
 		  break;
 		default:
 		  fprintf (stderr, "Something has gone horribly wrong!\n");
@@ -422,41 +967,18 @@ montecarlo_one_packet (storage_model_t * storage, rpacket_t * packet,
 	      rpacket_set_energy(&virt_packet,
 		rpacket_get_energy (packet) * doppler_factor_ratio);
 	      rpacket_set_nu(&virt_packet,rpacket_get_nu (packet) * doppler_factor_ratio);
-	      reabsorbed = montecarlo_one_packet_loop (storage, &virt_packet, 1, mt_state);
-	      if ((rpacket_get_nu(&virt_packet) < storage->spectrum_end_nu) &&
-		  (rpacket_get_nu(&virt_packet) > storage->spectrum_start_nu))
+	      virtual_packet_t virtual_packet;
+	      virtual_packet_init (&virtual_packet, storage, &virt_packet,
+				   weight);
+	      if (storage->virtual_packet_queue != NULL)
 		{
-#ifdef WITHOPENMP
-#pragma omp critical
-		  {
-#endif
-		    if (storage->virt_packet_count >= storage->virt_array_size)
-		      {
-			storage->virt_array_size *= 2;
-			storage->virt_packet_nus = realloc(storage->virt_packet_nus, sizeof(double) * storage->virt_array_size);
-			storage->virt_packet_energies = realloc(storage->virt_packet_energies, sizeof(double) * storage->virt_array_size);
-			storage->virt_packet_last_interaction_in_nu = realloc(storage->virt_packet_last_interaction_in_nu, sizeof(double) * storage->virt_array_size);
-      storage->virt_packet_last_interaction_type = realloc(storage->virt_packet_last_interaction_type, sizeof(int64_t) * storage->virt_array_size);
-      storage->virt_packet_last_line_interaction_in_id = realloc(storage->virt_packet_last_line_interaction_in_id, sizeof(int64_t) * storage->virt_array_size);
-      storage->virt_packet_last_line_interaction_out_id = realloc(storage->virt_packet_last_line_interaction_out_id, sizeof(int64_t) * storage->virt_array_size);
-		      }
-		    storage->virt_packet_nus[storage->virt_packet_count] = rpacket_get_nu(&virt_packet);
-		    storage->virt_packet_energies[storage->virt_packet_count] = rpacket_get_energy(&virt_packet) * weight;
-        storage->virt_packet_last_interaction_in_nu[storage->virt_packet_count] = storage->last_interaction_in_nu[rpacket_get_id (packet)];
-        storage->virt_packet_last_interaction_type[storage->virt_packet_count] = storage->last_interaction_type[rpacket_get_id (packet)];
-        storage->virt_packet_last_line_interaction_in_id[storage->virt_packet_count] = storage->last_line_interaction_in_id[rpacket_get_id (packet)];
-        storage->virt_packet_last_line_interaction_out_id[storage->virt_packet_count] = storage->last_line_interaction_out_id[rpacket_get_id (packet)];
-		    storage->virt_packet_count += 1;
-		    int64_t virt_id_nu =
-		      floor ((rpacket_get_nu(&virt_packet) -
-			      storage->spectrum_start_nu) /
-			     storage->spectrum_delta_nu);
-		    storage->spectrum_virt_nu[virt_id_nu] +=
-		      rpacket_get_energy(&virt_packet) * weight;
-#ifdef WITHOPENMP
-		  }
-#endif
+		  virtual_packet_queue_push (storage->virtual_packet_queue,
+					     &virtual_packet);
+		  continue;
 		}
+	      reabsorbed = montecarlo_one_packet_loop (storage, &virt_packet, 1, rng_state);
+	      montecarlo_record_virtual_packet (storage, &virtual_packet,
+						&virt_packet);
 	    }
 	}
       else
@@ -467,11 +989,172 @@ montecarlo_one_packet (storage_model_t * storage, rpacket_t * packet,
   return reabsorbed;
 }
 
+/** Find the first line of the transport below a comoving frequency.
+ *
+ * @param storage storage model data
+ * @param comov_nu comoving frequency
+ *
+ * @return id in the line list of the transport
+ */
+static inline int64_t
+transport_line_search (const storage_model_t * storage, double comov_nu)
+{
+  int64_t transport_line_id;
+  if (storage->line_search_index.no_of_buckets > 0)
+    {
+      indexed_line_search (&storage->line_search_index, storage->line_list_nu,
+			   comov_nu, storage->no_of_lines, &transport_line_id);
+    }
+  else
+    {
+      line_search (storage->line_list_nu, comov_nu, storage->no_of_lines,
+		   &transport_line_id);
+    }
+  return transport_line_id;
+}
+
+/** Pass the lines of the transport that a packet reached on its way to its
+ * current position.
+ *
+ * With a single line list the packets pass these lines one by one, with per
+ * shell line lists only the lines of the shells are passed. Keeping track of
+ * the others gives both the same packet histories.
+ *
+ * @param packet rpacket structure with packet information
+ * @param storage storage model data with per shell line lists
+ */
+static void
+rpacket_pass_transport_lines (rpacket_t * packet,
+			      const storage_model_t * storage)
+{
+  double comov_nu =
+    rpacket_get_nu (packet) * rpacket_doppler_factor (packet, storage);
+  int64_t transport_line_id = transport_line_search (storage, comov_nu);
+  if (transport_line_id > rpacket_get_next_transport_line_id (packet))
+    {
+      rpacket_set_next_transport_line_id (packet, transport_line_id);
+    }
+}
+
+/** Point a packet that entered a shell to the next line of the line list of
+ * that shell.
+ *
+ * @param packet rpacket structure with packet information
+ * @param storage storage model data with per shell line lists
+ */
+static void
+rpacket_seek_shell_line (rpacket_t * packet, const storage_model_t * storage)
+{
+  int64_t shell_id = rpacket_get_current_shell_id (packet);
+  int64_t next_line_id =
+    shell_line_seek (storage, shell_id,
+		     rpacket_get_next_transport_line_id (packet), -1);
+  rpacket_set_next_line_id (packet, next_line_id);
+  rpacket_set_last_line (packet, next_line_id ==
+			 transport_line_list_end (storage, shell_id));
+  rpacket_set_close_line (packet, false);
+}
+
+// Ratio of the upper and lower bound of the weight window to its center
+#define WEIGHT_WINDOW_WIDTH 2.0
+// Largest number of packets a packet is split into at once
+#define WEIGHT_WINDOW_MAX_SPLIT 16
+// Largest number of splits per packet, limited by the split streams
+#define WEIGHT_WINDOW_MAX_SPLITS_PER_PACKET 65535
+
+/** Put a copy of a packet with its own random number stream and the id -1
+ * on the split packet stack.
+ *
+ * @param stack split packet stack of a thread
+ * @param packet packet to copy
+ * @param rng_state random number state of the packet
+ */
+static void
+split_packet_stack_push (split_packet_stack_t * stack,
+			 const rpacket_t * packet,
+			 const philox_state_t * rng_state)
+{
+  if (stack->size >= stack->capacity)
+    {
+      stack->capacity = 2 * stack->capacity + 1;
+      stack->packets = realloc (stack->packets,
+				sizeof (rpacket_t) * stack->capacity);
+      stack->rng_states = realloc (stack->rng_states,
+				   sizeof (philox_state_t) * stack->capacity);
+    }
+  stack->packets[stack->size] = *packet;
+  // the copy has no entry in the packet arrays
+  rpacket_set_id (stack->packets + stack->size, -1);
+  stack->no_of_splits += 1;
+  philox_split (rng_state, stack->rng_states + stack->size,
+		stack->no_of_splits);
+  stack->size += 1;
+}
+
+/** Play Russian roulette with a real packet whose energy is below the weight
+ * window of its shell and split a packet whose energy is above it.
+ *
+ * A packet below the window survives with the probability of its energy
+ * over the window center and then carries the center energy, otherwise it
+ * is absorbed with zero energy. A packet above the window is split into
+ * packets of equal energy close to the center. The expected energy is
+ * conserved in both cases, so the estimators stay unbiased.
+ *
+ * @param packet rpacket structure with packet information
+ * @param storage storage model data with the weight windows
+ * @param rng_state random number state of the packet
+ */
+static void
+montecarlo_apply_weight_window (rpacket_t * packet,
+				storage_model_t * storage,
+				philox_state_t * rng_state)
+{
+  double center =
+    storage->weight_window_energies[rpacket_get_current_shell_id (packet)];
+  double energy = rpacket_get_energy (packet);
+  if (energy < center / WEIGHT_WINDOW_WIDTH)
+    {
+      if (philox_double (rng_state) * center < energy)
+	{
+	  rpacket_set_energy (packet, center);
+	}
+      else
+	{
+	  rpacket_set_energy (packet, 0.0);
+	  rpacket_set_status (packet, TARDIS_PACKET_STATUS_REABSORBED);
+	}
+    }
+  else if (energy > center * WEIGHT_WINDOW_WIDTH &&
+	   storage->split_packet_stack != NULL)
+    {
+      split_packet_stack_t *stack = storage->split_packet_stack;
+      int64_t no_of_packets = (int64_t) (energy / center);
+      if (no_of_packets > WEIGHT_WINDOW_MAX_SPLIT)
+	{
+	  no_of_packets = WEIGHT_WINDOW_MAX_SPLIT;
+	}
+      if (stack->no_of_splits + no_of_packets >
+	  WEIGHT_WINDOW_MAX_SPLITS_PER_PACKET)
+	{
+	  return;
+	}
+      rpacket_set_energy (packet, energy / no_of_packets);
+      for (int64_t i = 1; i < no_of_packets; ++i)
+	{
+	  split_packet_stack_push (stack, packet, rng_state);
+	}
+    }
+}
+
 void
 move_packet_across_shell_boundary (rpacket_t * packet,
-				   storage_model_t * storage, double distance, rk_state *mt_state)
+				   storage_model_t * storage, double distance, philox_state_t *rng_state)
 {
   move_packet (packet, storage, distance);
+  if (storage->shell_line_offsets != NULL)
+    {
+      rpacket_pass_transport_lines (packet, storage);
+    }
   if (rpacket_get_virtual_packet (packet) > 0)
     {
       double delta_tau_event = rpacket_get_chi_continuum(packet) * distance;
@@ -481,7 +1164,7 @@ move_packet_across_shell_boundary (rpacket_t * packet,
     }
   else
     {
-      rpacket_reset_tau_event (packet, mt_state);
+      rpacket_reset_tau_event (packet, rng_state);
     }
   if ((rpacket_get_current_shell_id (packet) < storage->no_of_shells - 1
        && rpacket_get_next_shell_id (packet) == 1)
@@ -494,13 +1177,22 @@ move_packet_across_shell_boundary (rpacket_t * packet,
       rpacket_set_recently_crossed_boundary (packet,
 					     rpacket_get_next_shell_id
 					     (packet));
+      if (storage->shell_line_offsets != NULL)
+	{
+	  rpacket_seek_shell_line (packet, storage);
+	}
+      if (storage->weight_window_energies != NULL &&
+	  rpacket_get_virtual_packet (packet) == 0)
+	{
+	  montecarlo_apply_weight_window (packet, storage, rng_state);
+	}
     }
   else if (rpacket_get_next_shell_id (packet) == 1)
     {
       rpacket_set_status (packet, TARDIS_PACKET_STATUS_EMITTED);
     }
   else if ((storage->reflective_inner_boundary == 0) ||
-	   (rk_double (mt_state) > storage->inner_boundary_albedo))
+	   (philox_double (rng_state) > storage->inner_boundary_albedo))
     {
       rpacket_set_status (packet, TARDIS_PACKET_STATUS_REABSORBED);
     }
@@ -509,40 +1201,47 @@ move_packet_across_shell_boundary (rpacket_t * packet,
       double doppler_factor = rpacket_doppler_factor (packet, storage);
       double comov_nu = rpacket_get_nu (packet) * doppler_factor;
       double comov_energy = rpacket_get_energy (packet) * doppler_factor;
-      rpacket_set_mu (packet, rk_double (mt_state));
+      rpacket_set_mu (packet, philox_double (rng_state));
       double inverse_doppler_factor = 1.0 / rpacket_doppler_factor (packet, storage);
       rpacket_set_nu (packet, comov_nu * inverse_doppler_factor);
       rpacket_set_energy (packet, comov_energy * inverse_doppler_factor);
       rpacket_set_recently_crossed_boundary (packet, 1);
       if (rpacket_get_virtual_packet_flag (packet) > 0)
 	{
-	  montecarlo_one_packet (storage, packet, -2, mt_state);
+	  montecarlo_one_packet (storage, packet, -2, rng_state);
 	}
     }
 }
 
 void
 montecarlo_thomson_scatter (rpacket_t * packet, storage_model_t * storage,
-			    double distance, rk_state *mt_state)
+			    double distance, philox_state_t *rng_state)
 {
   double doppler_factor = move_packet (packet, storage, distance);
+  if (storage->shell_line_offsets != NULL)
+    {
+      rpacket_pass_transport_lines (packet, storage);
+    }
   double comov_nu = rpacket_get_nu (packet) * doppler_factor;
   double comov_energy = rpacket_get_energy (packet) * doppler_factor;
-  rpacket_set_mu (packet, 2.0 * rk_double (mt_state) - 1.0);
+  rpacket_set_mu (packet, 2.0 * philox_double (rng_state) - 1.0);
   double inverse_doppler_factor = 1.0 / rpacket_doppler_factor (packet, storage);
   rpacket_set_nu (packet, comov_nu * inverse_doppler_factor);
   rpacket_set_energy (packet, comov_energy * inverse_doppler_factor);
-  rpacket_reset_tau_event (packet, mt_state);
+  rpacket_reset_tau_event (packet, rng_state);
   rpacket_set_recently_crossed_boundary (packet, 0);
-  storage->last_interaction_type[rpacket_get_id (packet)] = 1;
+  if (last_interactions_tracked (storage, packet))
+    {
+      storage->last_interaction_type[rpacket_get_id (packet)] = 1;
+    }
   if (rpacket_get_virtual_packet_flag (packet) > 0)
     {
-      montecarlo_one_packet (storage, packet, 1, mt_state);
+      montecarlo_one_packet (storage, packet, 1, rng_state);
     }
 }
 
 void
-montecarlo_bound_free_scatter (rpacket_t * packet, storage_model_t * storage, double distance, rk_state *mt_state)
+montecarlo_bound_free_scatter (rpacket_t * packet, storage_model_t * storage, double distance, philox_state_t *rng_state)
 {
   /* current position in list of continuum edges -> indicates which bound-free processes are possible */
   int64_t current_continuum_id = rpacket_get_current_continuum_id(packet);
@@ -551,7 +1250,7 @@ montecarlo_bound_free_scatter (rpacket_t * packet, storage_model_t * storage, do
   double nu = rpacket_get_nu(packet);
   double chi_bf = rpacket_get_chi_boundfree(packet);
   // get new zrand
-  double zrand = rk_double(mt_state);
+  double zrand = philox_double (rng_state);
   double zrand_x_chibf = zrand * chi_bf;
 
   int64_t ccontinuum = current_continuum_id; /* continuum_id of the continuum in which bf-absorption occurs */
@@ -568,7 +1267,7 @@ montecarlo_bound_free_scatter (rpacket_t * packet, storage_model_t * storage, do
 //      ccontinuum = current_continuum_id;
 //   }
 
-  zrand = rk_double(mt_state);
+  zrand = philox_double (rng_state);
   if (zrand < storage->continuum_list_nu[ccontinuum] / nu)
   {
 	// go to ionization energy
@@ -583,29 +1282,64 @@ montecarlo_bound_free_scatter (rpacket_t * packet, storage_model_t * storage, do
 }
 
 void
-montecarlo_free_free_scatter(rpacket_t * packet, storage_model_t * storage, double distance, rk_state *mt_state)
+montecarlo_free_free_scatter(rpacket_t * packet, storage_model_t * storage, double distance, philox_state_t *rng_state)
 {
   rpacket_set_status (packet, TARDIS_PACKET_STATUS_REABSORBED);
 }
 
 
+/** Id in the full line list of a line in the line list of the transport.
+ *
+ * @param storage storage model data
+ * @param line_id id in the line list of the transport
+ *
+ * @return id in the full line list
+ */
+static inline int64_t
+full_line_id (const storage_model_t * storage, int64_t line_id)
+{
+  return storage->active_line_ids == NULL ? line_id :
+    storage->active_line_ids[line_id];
+}
+
+/** Next line of the transport that a packet emitted in a line meets.
+ *
+ * @param storage storage model data
+ * @param full_line_id id of the emitted line in the full line list
+ *
+ * @return id in the line list of the transport
+ */
+static inline int64_t
+next_active_line_id (const storage_model_t * storage, int64_t full_line_id)
+{
+  return storage->active_line_ids == NULL ? full_line_id + 1 :
+    storage->next_active_line_ids[full_line_id];
+}
+
 void
 montecarlo_line_scatter (rpacket_t * packet, storage_model_t * storage,
-			 double distance, rk_state *mt_state)
+			 double distance, philox_state_t *rng_state)
 {
-  int64_t line2d_idx = rpacket_get_next_line_id (packet)
-  * storage->no_of_shells + rpacket_get_current_shell_id (packet);
+  int64_t shell_id = rpacket_get_current_shell_id (packet);
+  int64_t next_line_id = rpacket_get_next_line_id (packet);
+  int64_t line_id = transport_line_id (storage, next_line_id);
+  int64_t line2d_idx = storage->shell_major_line_lists ?
+    shell_id * storage->no_of_lines + line_id :
+    line_id * storage->no_of_shells + shell_id;
   if (rpacket_get_virtual_packet (packet) == 0)
     {
+      ++storage->line_event_count;
       increment_j_blue_estimator (packet, storage, distance, line2d_idx);
     }
-  double tau_line =
-    storage->line_lists_tau_sobolevs[line2d_idx];
+  double tau_line = storage->shell_line_offsets == NULL ?
+    storage->line_lists_tau_sobolevs[line2d_idx] :
+    storage->shell_line_tau_sobolevs[next_line_id];
   double tau_continuum = rpacket_get_chi_continuum(packet) * distance;
   double tau_combined = tau_line + tau_continuum;
-  rpacket_set_next_line_id (packet, rpacket_get_next_line_id (packet) + 1);
+  rpacket_set_next_line_id (packet, next_line_id + 1);
+  rpacket_set_next_transport_line_id (packet, line_id + 1);
 
-  if (rpacket_get_next_line_id (packet) == storage->no_of_lines)
+  if (next_line_id + 1 == transport_line_list_end (storage, shell_id))
     {
       rpacket_set_last_line (packet, true);
     }
@@ -617,40 +1351,57 @@ montecarlo_line_scatter (rpacket_t * packet, storage_model_t * storage,
   else if (rpacket_get_tau_event (packet) < tau_combined)
     {
       double old_doppler_factor = move_packet (packet, storage, distance);
-      rpacket_set_mu (packet, 2.0 * rk_double (mt_state) - 1.0);
+      rpacket_set_mu (packet, 2.0 * philox_double (rng_state) - 1.0);
       double inverse_doppler_factor = 1.0 / rpacket_doppler_factor (packet, storage);
       double comov_energy = rpacket_get_energy (packet) * old_doppler_factor;
       rpacket_set_energy (packet, comov_energy * inverse_doppler_factor);
-      storage->last_interaction_in_nu[rpacket_get_id (packet)] =
-  rpacket_get_nu (packet);
-      storage->last_line_interaction_in_id[rpacket_get_id (packet)] =
-	rpacket_get_next_line_id (packet) - 1;
-      storage->last_line_interaction_shell_id[rpacket_get_id (packet)] =
-	rpacket_get_current_shell_id (packet);
-      storage->last_interaction_type[rpacket_get_id (packet)] = 2;
+      // Ids of the emitted line are those of the full line list.
       int64_t emission_line_id = 0;
       if (storage->line_interaction_id == 0)
 	{
-	  emission_line_id = rpacket_get_next_line_id (packet) - 1;
+	  emission_line_id = full_line_id (storage, line_id);
 	}
       else if (storage->line_interaction_id >= 1)
 	{
-	  emission_line_id = macro_atom (packet, storage, mt_state);
+	  emission_line_id = macro_atom (packet, storage, rng_state);
+	}
+      if (last_interactions_tracked (storage, packet))
+	{
+	  storage->last_interaction_in_nu[rpacket_get_id (packet)] =
+	    rpacket_get_nu (packet);
+	  storage->last_line_interaction_in_id[rpacket_get_id (packet)] =
+	    full_line_id (storage, line_id);
+	  storage->last_line_interaction_shell_id[rpacket_get_id (packet)] =
+	    rpacket_get_current_shell_id (packet);
+	  storage->last_interaction_type[rpacket_get_id (packet)] = 2;
+	  storage->last_line_interaction_out_id[rpacket_get_id (packet)] =
+	    emission_line_id;
 	}
-      storage->last_line_interaction_out_id[rpacket_get_id (packet)] =
-	emission_line_id;
       rpacket_set_nu (packet,
-		      storage->line_list_nu[emission_line_id] *
+		      storage->full_line_list_nu[emission_line_id] *
 		      inverse_doppler_factor);
-      rpacket_set_nu_line (packet, storage->line_list_nu[emission_line_id]);
-      rpacket_set_next_line_id (packet, emission_line_id + 1);
-      rpacket_reset_tau_event (packet, mt_state);
+      rpacket_set_nu_line (packet, storage->full_line_list_nu[emission_line_id]);
+      int64_t emission_next_line_id =
+	next_active_line_id (storage, emission_line_id);
+      rpacket_set_next_transport_line_id (packet, emission_next_line_id);
+      if (storage->shell_line_offsets != NULL)
+	{
+	  // Emitted lines are often close to the absorbed one.
+	  emission_next_line_id =
+	    shell_line_seek (storage, shell_id, emission_next_line_id,
+			     next_line_id);
+	}
+      rpacket_set_next_line_id (packet, emission_next_line_id);
+      rpacket_set_last_line (packet, emission_next_line_id ==
+			     transport_line_list_end (storage, shell_id));
+      rpacket_reset_tau_event (packet, rng_state);
       rpacket_set_recently_crossed_boundary (packet, 0);
       if (rpacket_get_virtual_packet_flag (packet) > 0)
 	{
 	  bool virtual_close_line = false;
 	  if (!rpacket_get_last_line (packet) &&
-	      fabs (storage->line_list_nu[rpacket_get_next_line_id (packet)] -
+	      fabs (transport_line_list_nu (storage)
+		    [rpacket_get_next_line_id (packet)] -
 		    rpacket_get_nu_line (packet)) <
 	      (rpacket_get_nu_line (packet)* 1e-7))
 	    {
@@ -659,7 +1410,7 @@ montecarlo_line_scatter (rpacket_t * packet, storage_model_t * storage,
 	  // QUESTIONABLE!!!
 	  bool old_close_line = rpacket_get_close_line (packet);
 	  rpacket_set_close_line (packet, virtual_close_line);
-	  montecarlo_one_packet (storage, packet, 1, mt_state);
+	  montecarlo_one_packet (storage, packet, 1, rng_state);
 	  rpacket_set_close_line (packet, old_close_line);
 	  virtual_close_line = false;
 	}
@@ -670,7 +1421,8 @@ montecarlo_line_scatter (rpacket_t * packet, storage_model_t * storage,
 			     rpacket_get_tau_event (packet) - tau_line);
     }
   if (!rpacket_get_last_line (packet) &&
-      fabs (storage->line_list_nu[rpacket_get_next_line_id (packet)] -
+      fabs (transport_line_list_nu (storage)
+	    [rpacket_get_next_line_id (packet)] -
 	    rpacket_get_nu_line (packet)) < (rpacket_get_nu_line (packet)*
       1e-7))
     {
@@ -703,7 +1455,7 @@ montecarlo_compute_distances (rpacket_t * packet, storage_model_t * storage)
 
 static montecarlo_event_handler_t
 get_event_handler (rpacket_t * packet, storage_model_t * storage,
-		   double *distance, rk_state *mt_state)
+		   double *distance, philox_state_t *rng_state)
 {
   montecarlo_compute_distances (packet, storage);
   double d_boundary = rpacket_get_d_boundary (packet);
@@ -723,13 +1475,13 @@ get_event_handler (rpacket_t * packet, storage_model_t * storage,
   else
     {
       *distance = d_continuum;
-      handler = montecarlo_continuum_event_handler(packet, storage, mt_state);
+      handler = montecarlo_continuum_event_handler(packet, storage, rng_state);
     }
   return handler;
 }
 
 montecarlo_event_handler_t
-montecarlo_continuum_event_handler(rpacket_t * packet, storage_model_t * storage, rk_state *mt_state)
+montecarlo_continuum_event_handler(rpacket_t * packet, storage_model_t * storage, philox_state_t *rng_state)
 {
   if (storage->cont_status == CONTINUUM_OFF)
     {
@@ -737,7 +1489,7 @@ montecarlo_continuum_event_handler(rpacket_t * packet, storage_model_t * storage
     }
   else
     {
-  double zrand = (rk_double(mt_state));
+  double zrand = (philox_double (rng_state));
   double normaliz_cont_th = rpacket_get_chi_electron(packet)/rpacket_get_chi_continuum(packet);
   double normaliz_cont_bf = rpacket_get_chi_boundfree(packet)/rpacket_get_chi_continuum(packet);
 
@@ -759,9 +1511,63 @@ montecarlo_continuum_event_handler(rpacket_t * packet, storage_model_t * storage
     }
 }
 
+/** Transport a virtual packet out of the ejecta with the cumulative
+ * tau_sobolevs of the shells instead of line by line.
+ *
+ * The optical depth of the lines that a packet passes in a shell is the
+ * difference of the cumulative tau_sobolevs at the lines next to its comoving
+ * frequencies when entering and when leaving the shell. Every shell then costs
+ * one line search, and the packet ends up with the same optical depth as if it
+ * had walked the lines.
+ *
+ * @param packet virtual rpacket structure with packet information
+ * @param storage storage model data with cumulative tau_sobolevs
+ * @param rng_state random number state, used at a reflective inner boundary
+ */
+static void
+montecarlo_virtual_packet_escape (rpacket_t * packet,
+				  storage_model_t * storage,
+				  philox_state_t *rng_state)
+{
+  int64_t line_id = storage->shell_line_offsets == NULL ?
+    rpacket_get_next_line_id (packet) :
+    rpacket_get_next_transport_line_id (packet);
+  while (rpacket_get_status (packet) == TARDIS_PACKET_STATUS_IN_PROCESS)
+    {
+      double d_boundary = compute_distance2boundary (packet, storage);
+      compute_distance2continuum (packet, storage);
+      double boundary_comov_nu = rpacket_get_nu (packet) *
+	(rpacket_doppler_factor (packet, storage) -
+	 d_boundary * storage->inverse_time_explosion * INVERSE_C);
+      int64_t boundary_line_id =
+	transport_line_search (storage, boundary_comov_nu);
+      if (boundary_line_id > line_id)
+	{
+	  const double *cumulative_tau_sobolevs =
+	    storage->cumulative_tau_sobolevs +
+	    rpacket_get_current_shell_id (packet) * (storage->no_of_lines + 1);
+	  rpacket_set_tau_event (packet, rpacket_get_tau_event (packet) +
+				 cumulative_tau_sobolevs[boundary_line_id] -
+				 cumulative_tau_sobolevs[line_id]);
+	  line_id = boundary_line_id;
+	}
+      // The walk stops before the boundary once the lines exceed tau = 10.
+      if (rpacket_get_tau_event (packet) <= 10.0)
+	{
+	  move_packet_across_shell_boundary (packet, storage, d_boundary,
+					     rng_state);
+	}
+      if (rpacket_get_tau_event (packet) > 10.0)
+	{
+	  rpacket_set_tau_event (packet, 100.0);
+	  rpacket_set_status (packet, TARDIS_PACKET_STATUS_EMITTED);
+	}
+    }
+}
+
 int64_t
 montecarlo_one_packet_loop (storage_model_t * storage, rpacket_t * packet,
-			    int64_t virtual_packet, rk_state *mt_state)
+			    int64_t virtual_packet, philox_state_t *rng_state)
 {
   rpacket_set_tau_event (packet, 0.0);
   rpacket_set_nu_line (packet, 0.0);
@@ -770,7 +1576,15 @@ montecarlo_one_packet_loop (storage_model_t * storage, rpacket_t * packet,
   // Initializing tau_event if it's a real packet.
   if (virtual_packet == 0)
     {
-      rpacket_reset_tau_event (packet,mt_state);
+      rpacket_reset_tau_event (packet,rng_state);
+      if (storage->weight_window_energies != NULL)
+	{
+	  montecarlo_apply_weight_window (packet, storage, rng_state);
+	}
+    }
+  else if (storage->cumulative_tau_sobolevs != NULL)
+    {
+      montecarlo_virtual_packet_escape (packet, storage, rng_state);
     }
   // For a virtual packet tau_event is the sum of all the tau's that the packet passes.
   while (rpacket_get_status (packet) == TARDIS_PACKET_STATUS_IN_PROCESS)
@@ -779,13 +1593,12 @@ montecarlo_one_packet_loop (storage_model_t * storage, rpacket_t * packet,
       if (!rpacket_get_last_line (packet))
 	{
 	  rpacket_set_nu_line (packet,
-			       storage->
-			       line_list_nu[rpacket_get_next_line_id
-					    (packet)]);
+			       transport_line_list_nu (storage)
+			       [rpacket_get_next_line_id (packet)]);
 	}
       double distance;
-      get_event_handler (packet, storage, &distance, mt_state) (packet, storage,
-						      distance, mt_state);
+      get_event_handler (packet, storage, &distance, rng_state) (packet, storage,
+						      distance, rng_state);
       if (virtual_packet > 0 && rpacket_get_tau_event (packet) > 10.0)
 	{
 	  rpacket_set_tau_event (packet, 100.0);
@@ -803,54 +1616,546 @@ montecarlo_one_packet_loop (storage_model_t * storage, rpacket_t * packet,
     TARDIS_PACKET_STATUS_REABSORBED ? 1 : 0;
 }
 
-void
-montecarlo_main_loop(storage_model_t * storage, int64_t virtual_packet_flag, int nthreads, unsigned long seed)
-{
-  storage->virt_packet_nus = (double *)malloc(sizeof(double) * storage->no_of_packets);
-  storage->virt_packet_energies = (double *)malloc(sizeof(double) * storage->no_of_packets);
-  storage->virt_packet_last_interaction_in_nu = (double *)malloc(sizeof(double) * storage->no_of_packets);
-  storage->virt_packet_last_interaction_type = (int64_t *)malloc(sizeof(int64_t) * storage->no_of_packets);
-  storage->virt_packet_last_line_interaction_in_id = (int64_t *)malloc(sizeof(int64_t) * storage->no_of_packets);
-  storage->virt_packet_last_line_interaction_out_id = (int64_t *)malloc(sizeof(int64_t) * storage->no_of_packets);
-  storage->virt_packet_count = 0;
-  storage->virt_array_size = storage->no_of_packets;
-#ifdef WITHOPENMP
-  fprintf(stderr, "Running with OpenMP - %d threads\n", nthreads);
-  omp_set_dynamic(0);
-  omp_set_num_threads(nthreads);
-#pragma omp parallel
-  {
-    rk_state mt_state;
-    rk_seed (seed + omp_get_thread_num(), &mt_state);
-
-#pragma omp for
-#else
-  fprintf(stderr, "Running without OpenMP\n");
-  rk_state mt_state;
-  rk_seed (seed, &mt_state);
-#endif
-  for (int64_t packet_index = 0; packet_index < storage->no_of_packets; packet_index++)
+/** Add a real packet that left the ejecta to the emitted or reabsorbed
+ * spectrum and to the energy in the luminosity window.
+ *
+ * The bins are those of numpy.histogram on the spectrum frequency grid, the
+ * last bin includes its upper edge.
+ *
+ * @param storage storage model data
+ * @param nu frequency of the packet
+ * @param energy energy of the packet
+ * @param reabsorbed 1 if the packet was reabsorbed by the inner boundary
+ */
+static void
+montecarlo_record_real_packet (storage_model_t * storage, double nu,
+			       double energy, int reabsorbed)
+{
+  if (nu >= storage->spectrum_start_nu && nu <= storage->spectrum_end_nu)
     {
-      int reabsorbed = 0;
-      rpacket_t packet;
-      rpacket_set_id(&packet, packet_index);
-      rpacket_init(&packet, storage, packet_index, virtual_packet_flag);
-      if (virtual_packet_flag > 0)
+      int64_t bin =
+	floor ((nu - storage->spectrum_start_nu) / storage->spectrum_delta_nu);
+      if (bin >= storage->no_of_real_spectrum_bins)
 	{
-	  reabsorbed = montecarlo_one_packet(storage, &packet, -1, &mt_state);
+	  bin = storage->no_of_real_spectrum_bins - 1;
 	}
-      reabsorbed = montecarlo_one_packet(storage, &packet, 0, &mt_state);
-      storage->output_nus[packet_index] = rpacket_get_nu(&packet);
       if (reabsorbed == 1)
 	{
-	  storage->output_energies[packet_index] = -rpacket_get_energy(&packet);
+	  storage->spectrum_reabsorbed_nu[bin] += energy;
 	}
       else
 	{
-	  storage->output_energies[packet_index] = rpacket_get_energy(&packet);
+	  storage->spectrum_emitted_nu[bin] += energy;
+	}
+    }
+  if (nu > storage->luminosity_nu_start && nu < storage->luminosity_nu_end)
+    {
+      storage->luminosity_window_energies[reabsorbed] += energy;
+    }
+}
+
+/** Transport the queued virtual packets of a storage in the order they were
+ * spawned and empty the queue.
+ *
+ * The virtual packets are only queued without a reflective inner boundary,
+ * so they need no random numbers.
+ *
+ * @param storage storage model data with a virtual packet queue
+ */
+static void
+montecarlo_transport_virtual_packets (storage_model_t * storage)
+{
+  virtual_packet_queue_t *queue = storage->virtual_packet_queue;
+  for (int64_t i = 0; i < queue->size; i++)
+    {
+      const virtual_packet_t *virtual_packet = queue->packets + i;
+      rpacket_t packet;
+      rpacket_set_nu (&packet, virtual_packet->nu);
+      rpacket_set_mu (&packet, virtual_packet->mu);
+      rpacket_set_energy (&packet, virtual_packet->energy);
+      rpacket_set_r (&packet, virtual_packet->r);
+      rpacket_set_current_shell_id (&packet,
+				    virtual_packet->current_shell_id);
+      rpacket_set_next_line_id (&packet, virtual_packet->next_line_id);
+      rpacket_set_next_transport_line_id (&packet,
+					  virtual_packet->next_transport_line_id);
+      rpacket_set_last_line (&packet, virtual_packet->last_line);
+      rpacket_set_close_line (&packet, virtual_packet->close_line);
+      rpacket_set_recently_crossed_boundary (&packet,
+					     virtual_packet->recently_crossed_boundary);
+      rpacket_set_current_continuum_id (&packet,
+					virtual_packet->current_continuum_id);
+      rpacket_set_virtual_packet_flag (&packet, 0);
+      rpacket_set_id (&packet, -1);
+      montecarlo_one_packet_loop (storage, &packet, 1, NULL);
+      montecarlo_record_virtual_packet (storage, virtual_packet, &packet);
+    }
+  queue->size = 0;
+}
+
+// Number of terms of the sum that chooses the order of the blackbody sample
+#define BLACKBODY_L_SAMPLES 1000
+// Sum of l^-4 over all l, pi^4 / 90
+#define ZETA_4 1.0823232337111382
+
+/** Draw the comoving frequency and direction of a packet at the inner
+ * boundary with the blackbody sampling of BlackBodySimpleSource (Bjorkman &
+ * Wood 2001).
+ *
+ * @param storage storage model data
+ * @param rng_state random number stream of the packet
+ * @param nu frequency of the packet
+ * @param mu direction of the packet
+ */
+static void
+montecarlo_sample_blackbody_packet (const storage_model_t * storage,
+				    philox_state_t * rng_state, double *nu,
+				    double *mu)
+{
+  double l_target = philox_double (rng_state) * ZETA_4;
+  int64_t l = 1;
+  double l_sum = 1.0;
+  while (l_sum < l_target && l < BLACKBODY_L_SAMPLES)
+    {
+      ++l;
+      l_sum += pow (l, -4);
+    }
+  double xis_prod = 1.0;
+  for (int i = 0; i < 4; ++i)
+    {
+      xis_prod *= philox_double (rng_state);
+    }
+  *nu = -log (xis_prod) / l * storage->packet_source_nu_unit;
+  *mu = sqrt (philox_double (rng_state));
+}
+
+/** Transport the packets that were split off by the weight window.
+ *
+ * The split packets only enter the spectra and estimators, the packet
+ * arrays of the storage hold the packet they were split off and its last
+ * interactions.
+ *
+ * @param storage storage model data with a split packet stack
+ */
+static void
+montecarlo_transport_split_packets (storage_model_t * storage)
+{
+  split_packet_stack_t *stack = storage->split_packet_stack;
+  while (stack->size > 0)
+    {
+      stack->size -= 1;
+      rpacket_t packet = stack->packets[stack->size];
+      philox_state_t rng_state = stack->rng_states[stack->size];
+      int reabsorbed = montecarlo_one_packet (storage, &packet, 0, &rng_state);
+      montecarlo_record_real_packet (storage, rpacket_get_nu (&packet),
+				     rpacket_get_energy (&packet), reabsorbed);
+    }
+}
+
+static void
+montecarlo_transport_packet (storage_model_t * storage, int64_t packet_index,
+			     int64_t virtual_packet_flag, philox_state_t *rng_state)
+{
+  int reabsorbed = 0;
+  rpacket_t packet;
+  if (storage->split_packet_stack != NULL)
+    {
+      storage->split_packet_stack->no_of_splits = 0;
+    }
+  rpacket_set_id(&packet, packet_index);
+  // without packet arrays the packets are drawn from a blackbody
+  if (storage->packet_nus == NULL)
+    {
+      double nu, mu;
+      montecarlo_sample_blackbody_packet (storage, rng_state, &nu, &mu);
+      rpacket_init_at_inner_boundary (&packet, storage, nu, mu,
+				      storage->packet_source_energy,
+				      virtual_packet_flag);
+    }
+  else
+    {
+      rpacket_init(&packet, storage, packet_index, virtual_packet_flag);
+    }
+  if (virtual_packet_flag > 0)
+    {
+      reabsorbed = montecarlo_one_packet(storage, &packet, -1, rng_state);
+    }
+  reabsorbed = montecarlo_one_packet(storage, &packet, 0, rng_state);
+  montecarlo_record_real_packet (storage, rpacket_get_nu (&packet),
+				 rpacket_get_energy (&packet), reabsorbed);
+  if (storage->virtual_packet_queue != NULL &&
+      storage->virtual_packet_queue->size >=
+      storage->virtual_packet_batch_size)
+    {
+      montecarlo_transport_virtual_packets (storage);
+    }
+  if (storage->split_packet_stack != NULL)
+    {
+      montecarlo_transport_split_packets (storage);
+    }
+  if (storage->output_nus == NULL)
+    {
+      return;
+    }
+  storage->output_nus[packet_index] = rpacket_get_nu(&packet);
+  if (reabsorbed == 1)
+    {
+      storage->output_energies[packet_index] = -rpacket_get_energy(&packet);
+    }
+  else
+    {
+      storage->output_energies[packet_index] = rpacket_get_energy(&packet);
+    }
+}
+
+#ifdef WITHOPENMP
+/** Set up the storage a single thread transports its packets with.
+ *
+ * The thread storage is a shallow copy of the shared storage with its own
+ * virtual packet arrays. Thread 0 keeps accumulating into the shared (Python)
+ * estimator and spectrum arrays, all other threads get private
+ * buffers which are reduced after the packet loop. The j_blue estimator is
+ * not allocated at all if the shared storage has none. If sparse_j_blues is
+ * set, every thread including thread 0 gets a sparse j_blue estimator whose
+ * size is limited by thread_estimator_memory_limit and which adds to the
+ * shared array once it is full.
+ *
+ * @param thread_storage storage to initialize
+ * @param storage storage shared by all threads
+ * @param thread_id OpenMP thread number
+ * @param thread_count number of threads in the parallel region
+ * @param sparse_j_blues use a sparse j_blue estimator
+ */
+static void
+montecarlo_thread_storage_init (storage_model_t * thread_storage,
+				storage_model_t * storage, int thread_id,
+				int thread_count, bool sparse_j_blues)
+{
+  *thread_storage = *storage;
+  thread_storage->line_lists_j_blues_sparse = NULL;
+  thread_storage->line_event_count = 0;
+  montecarlo_virtual_packets_init (thread_storage,
+				   storage->no_of_packets / thread_count + 1);
+  if (sparse_j_blues)
+    {
+      // Threads only write to the shared array once their map is full, so
+      // thread 0 needs a map as well.
+      thread_storage->line_lists_j_blues = NULL;
+      thread_storage->line_lists_j_blues_sparse =
+	(sparse_estimator_t *) malloc (sizeof (sparse_estimator_t));
+      sparse_estimator_t *sparse = thread_storage->line_lists_j_blues_sparse;
+      sparse_estimator_init (sparse, SPARSE_ESTIMATOR_INITIAL_CAPACITY);
+      while (2 * sparse->max_capacity * SPARSE_ESTIMATOR_SLOT_SIZE *
+	     thread_count <= (uint64_t) storage->thread_estimator_memory_limit)
+	{
+	  sparse->max_capacity *= 2;
 	}
+      sparse->overflow_values = storage->line_lists_j_blues;
+    }
+  if (thread_id == 0)
+    {
+      return;
+    }
+  thread_storage->js =
+    (double *) calloc (storage->no_of_shells, sizeof (double));
+  thread_storage->nubars =
+    (double *) calloc (storage->no_of_shells, sizeof (double));
+  thread_storage->spectrum_virt_nu =
+    (double *) calloc (storage->no_of_spectrum_bins, sizeof (double));
+  if (storage->spectrum_virt_nu_squared != NULL)
+    {
+      thread_storage->spectrum_virt_nu_squared =
+	(double *) calloc (storage->no_of_spectrum_bins, sizeof (double));
+    }
+  thread_storage->spectrum_emitted_nu =
+    (double *) calloc (storage->no_of_real_spectrum_bins, sizeof (double));
+  thread_storage->spectrum_reabsorbed_nu =
+    (double *) calloc (storage->no_of_real_spectrum_bins, sizeof (double));
+  thread_storage->luminosity_window_energies =
+    (double *) calloc (2, sizeof (double));
+  if (storage->line_lists_j_blues != NULL && !sparse_j_blues)
+    {
+      thread_storage->line_lists_j_blues =
+	(double *) calloc (storage->no_of_lines * storage->no_of_shells,
+			   sizeof (double));
+    }
+}
+
+static void
+montecarlo_thread_storage_free (storage_model_t * thread_storage,
+				int thread_id)
+{
+  if (thread_storage->line_lists_j_blues_sparse != NULL)
+    {
+      sparse_estimator_free (thread_storage->line_lists_j_blues_sparse);
+      free (thread_storage->line_lists_j_blues_sparse);
+    }
+  if (thread_id == 0)
+    {
+      return;
+    }
+  free (thread_storage->js);
+  free (thread_storage->nubars);
+  free (thread_storage->spectrum_virt_nu);
+  free (thread_storage->spectrum_virt_nu_squared);
+  free (thread_storage->spectrum_emitted_nu);
+  free (thread_storage->spectrum_reabsorbed_nu);
+  free (thread_storage->luminosity_window_energies);
+  free (thread_storage->line_lists_j_blues);
+}
+
+/** Copy the virtual packets of a thread into the shared storage and free the
+ * thread's virtual packet arrays.
+ *
+ * @param storage storage shared by all threads, arrays have to be allocated
+ * @param thread_storage storage of the thread
+ * @param offset index of the first virtual packet of the thread in storage
+ */
+static void
+montecarlo_merge_virtual_packets (storage_model_t * storage,
+				  storage_model_t * thread_storage,
+				  int64_t offset)
+{
+  int64_t count = thread_storage->virt_packet_count;
+  memcpy (storage->virt_packet_nus + offset, thread_storage->virt_packet_nus, sizeof (double) * count);
+  memcpy (storage->virt_packet_energies + offset, thread_storage->virt_packet_energies, sizeof (double) * count);
+  memcpy (storage->virt_packet_last_interaction_in_nu + offset, thread_storage->virt_packet_last_interaction_in_nu, sizeof (double) * count);
+  memcpy (storage->virt_packet_last_interaction_type + offset, thread_storage->virt_packet_last_interaction_type, sizeof (int64_t) * count);
+  memcpy (storage->virt_packet_last_line_interaction_in_id + offset, thread_storage->virt_packet_last_line_interaction_in_id, sizeof (int64_t) * count);
+  memcpy (storage->virt_packet_last_line_interaction_out_id + offset, thread_storage->virt_packet_last_line_interaction_out_id, sizeof (int64_t) * count);
+  free (thread_storage->virt_packet_nus);
+  free (thread_storage->virt_packet_energies);
+  free (thread_storage->virt_packet_last_interaction_in_nu);
+  free (thread_storage->virt_packet_last_interaction_type);
+  free (thread_storage->virt_packet_last_line_interaction_in_id);
+  free (thread_storage->virt_packet_last_line_interaction_out_id);
+}
+
+/** Sum the estimator buffers of all threads into buffers[0].
+ *
+ * The buffers are added pairwise in log2(thread_count) rounds, the elements of
+ * each round are distributed over the threads. Has to be called by every
+ * thread of the enclosing parallel region.
+ *
+ * @param buffers estimator buffer of each thread
+ * @param size number of elements in each buffer
+ * @param thread_count number of threads in the parallel region
+ */
+static void
+reduce_thread_estimators (double **buffers, int64_t size, int thread_count)
+{
+  for (int stride = 1; stride < thread_count; stride *= 2)
+    {
+#pragma omp for
+      for (int64_t i = 0; i < size; i++)
+	{
+	  for (int t = 0; t + stride < thread_count; t += 2 * stride)
+	    {
+	      buffers[t][i] += buffers[t + stride][i];
+	    }
+	}
+    }
+}
+#endif
+
+void
+montecarlo_main_loop(storage_model_t * storage, int64_t virtual_packet_flag,
+		     int nthreads, unsigned long seed, int64_t iteration,
+		     int64_t first_packet_id)
+{
+  storage->line_lists_j_blues_sparse = NULL;
+  storage->virtual_packet_queue = NULL;
+  storage->split_packet_stack = NULL;
+  // Virtual packets draw random numbers at a reflective inner boundary and
+  // have to be transported together with their real packets.
+  bool queue_virtual_packets = virtual_packet_flag > 0 &&
+    storage->virtual_packet_batch_size > 0 &&
+    !storage->reflective_inner_boundary;
+  if (virtual_packet_flag > 0 && storage->virtual_packet_batch_size > 0 &&
+      storage->reflective_inner_boundary)
+    {
+      fprintf(stderr, "Not queuing virtual packets with a reflective inner boundary\n");
     }
 #ifdef WITHOPENMP
+  fprintf(stderr, "Running with OpenMP - %d threads\n", nthreads);
+  omp_set_dynamic(0);
+  omp_set_num_threads(nthreads);
+  const omp_sched_t schedule_kinds[] =
+    { omp_sched_static, omp_sched_dynamic, omp_sched_guided };
+  omp_set_schedule (schedule_kinds[storage->thread_schedule],
+		    (int) storage->thread_schedule_chunk_size);
+  int64_t no_of_j_blues = storage->no_of_lines * storage->no_of_shells;
+  // Thread 0 accumulates into the shared arrays, only the others need memory.
+  bool sparse_j_blues = storage->line_lists_j_blues != NULL &&
+    (double) (nthreads - 1) * no_of_j_blues * sizeof (double) >
+    storage->thread_estimator_memory_limit;
+  if (sparse_j_blues)
+    {
+      fprintf(stderr, "Using sparse thread j_blue estimators\n");
+    }
+  double **js_buffers = (double **) malloc (sizeof (double *) * nthreads);
+  double **nubars_buffers = (double **) malloc (sizeof (double *) * nthreads);
+  double **j_blues_buffers = (double **) malloc (sizeof (double *) * nthreads);
+  double **spectrum_virt_nu_buffers =
+    (double **) malloc (sizeof (double *) * nthreads);
+  double **spectrum_virt_nu_squared_buffers =
+    (double **) malloc (sizeof (double *) * nthreads);
+  double **spectrum_emitted_nu_buffers =
+    (double **) malloc (sizeof (double *) * nthreads);
+  double **spectrum_reabsorbed_nu_buffers =
+    (double **) malloc (sizeof (double *) * nthreads);
+  double **luminosity_window_energies_buffers =
+    (double **) malloc (sizeof (double *) * nthreads);
+  int64_t *virt_packet_offsets =
+    (int64_t *) malloc (sizeof (int64_t) * (nthreads + 1));
+#pragma omp parallel
+  {
+    int thread_id = omp_get_thread_num();
+    int thread_count = omp_get_num_threads();
+    storage_model_t thread_storage;
+    montecarlo_thread_storage_init (&thread_storage, storage, thread_id,
+				    thread_count, sparse_j_blues);
+    js_buffers[thread_id] = thread_storage.js;
+    nubars_buffers[thread_id] = thread_storage.nubars;
+    j_blues_buffers[thread_id] = thread_storage.line_lists_j_blues;
+    spectrum_virt_nu_buffers[thread_id] = thread_storage.spectrum_virt_nu;
+    spectrum_virt_nu_squared_buffers[thread_id] =
+      thread_storage.spectrum_virt_nu_squared;
+    spectrum_emitted_nu_buffers[thread_id] = thread_storage.spectrum_emitted_nu;
+    spectrum_reabsorbed_nu_buffers[thread_id] =
+      thread_storage.spectrum_reabsorbed_nu;
+    luminosity_window_energies_buffers[thread_id] =
+      thread_storage.luminosity_window_energies;
+    virtual_packet_queue_t virtual_packet_queue = { NULL, 0, 0 };
+    if (queue_virtual_packets)
+      {
+	thread_storage.virtual_packet_queue = &virtual_packet_queue;
+      }
+    split_packet_stack_t split_packet_stack = { NULL, NULL, 0, 0, 0 };
+    if (storage->weight_window_energies != NULL)
+      {
+	thread_storage.split_packet_stack = &split_packet_stack;
+      }
+    int64_t thread_packet_count = 0;
+    double start_time = omp_get_wtime ();
+#pragma omp for schedule(runtime) nowait
+    for (int64_t packet_index = 0; packet_index < storage->no_of_packets; packet_index++)
+      {
+	philox_state_t rng_state;
+	philox_seed (&rng_state, seed, first_packet_id + packet_index,
+		     iteration);
+	montecarlo_transport_packet(&thread_storage, packet_index,
+				    virtual_packet_flag, &rng_state);
+	++thread_packet_count;
+      }
+    if (queue_virtual_packets)
+      {
+	montecarlo_transport_virtual_packets (&thread_storage);
+	free (virtual_packet_queue.packets);
+	thread_storage.virtual_packet_queue = NULL;
+      }
+    free (split_packet_stack.packets);
+    free (split_packet_stack.rng_states);
+    thread_storage.split_packet_stack = NULL;
+    storage->thread_packet_counts[thread_id] += thread_packet_count;
+    storage->thread_line_event_counts[thread_id] +=
+      thread_storage.line_event_count;
+    storage->thread_busy_times[thread_id] += omp_get_wtime () - start_time;
+#pragma omp barrier
+    virt_packet_offsets[thread_id + 1] = thread_storage.virt_packet_count;
+    reduce_thread_estimators (js_buffers, storage->no_of_shells, thread_count);
+    reduce_thread_estimators (nubars_buffers, storage->no_of_shells,
+			      thread_count);
+    reduce_thread_estimators (spectrum_virt_nu_buffers,
+			      storage->no_of_spectrum_bins, thread_count);
+    if (storage->spectrum_virt_nu_squared != NULL)
+      {
+	reduce_thread_estimators (spectrum_virt_nu_squared_buffers,
+				  storage->no_of_spectrum_bins, thread_count);
+      }
+    reduce_thread_estimators (spectrum_emitted_nu_buffers,
+			      storage->no_of_real_spectrum_bins, thread_count);
+    reduce_thread_estimators (spectrum_reabsorbed_nu_buffers,
+			      storage->no_of_real_spectrum_bins, thread_count);
+    reduce_thread_estimators (luminosity_window_energies_buffers, 2,
+			      thread_count);
+    if (storage->line_lists_j_blues != NULL && !sparse_j_blues)
+      {
+	reduce_thread_estimators (j_blues_buffers, no_of_j_blues, thread_count);
+      }
+    else if (thread_storage.line_lists_j_blues_sparse != NULL)
+      {
+	sparse_estimator_t *sparse = thread_storage.line_lists_j_blues_sparse;
+	for (int64_t i = 0; i < sparse->capacity; i++)
+	  {
+	    if (sparse->indices[i] != -1)
+	      {
+#pragma omp atomic
+		storage->line_lists_j_blues[sparse->indices[i]] +=
+		  sparse->values[i];
+	      }
+	  }
+      }
+#pragma omp single
+    {
+      virt_packet_offsets[0] = 0;
+      for (int t = 0; t < thread_count; t++)
+	{
+	  virt_packet_offsets[t + 1] += virt_packet_offsets[t];
+	}
+      montecarlo_virtual_packets_init (storage,
+				       virt_packet_offsets[thread_count]);
+      storage->virt_packet_count = virt_packet_offsets[thread_count];
+    }
+    montecarlo_merge_virtual_packets (storage, &thread_storage,
+				      virt_packet_offsets[thread_id]);
+    montecarlo_thread_storage_free (&thread_storage, thread_id);
   }
+  free (js_buffers);
+  free (nubars_buffers);
+  free (j_blues_buffers);
+  free (spectrum_virt_nu_buffers);
+  free (spectrum_virt_nu_squared_buffers);
+  free (spectrum_emitted_nu_buffers);
+  free (spectrum_reabsorbed_nu_buffers);
+  free (luminosity_window_energies_buffers);
+  free (virt_packet_offsets);
+#else
+  fprintf(stderr, "Running without OpenMP\n");
+  montecarlo_virtual_packets_init (storage, storage->no_of_packets);
+  storage->line_event_count = 0;
+  virtual_packet_queue_t virtual_packet_queue = { NULL, 0, 0 };
+  if (queue_virtual_packets)
+    {
+      storage->virtual_packet_queue = &virtual_packet_queue;
+    }
+  split_packet_stack_t split_packet_stack = { NULL, NULL, 0, 0, 0 };
+  if (storage->weight_window_energies != NULL)
+    {
+      storage->split_packet_stack = &split_packet_stack;
+    }
+  clock_t start_time = clock ();
+  for (int64_t packet_index = 0; packet_index < storage->no_of_packets; packet_index++)
+    {
+      philox_state_t rng_state;
+      philox_seed (&rng_state, seed, first_packet_id + packet_index,
+		   iteration);
+      montecarlo_transport_packet(storage, packet_index, virtual_packet_flag,
+				  &rng_state);
+    }
+  if (queue_virtual_packets)
+    {
+      montecarlo_transport_virtual_packets (storage);
+      free (virtual_packet_queue.packets);
+      storage->virtual_packet_queue = NULL;
+    }
+  free (split_packet_stack.packets);
+  free (split_packet_stack.rng_states);
+  storage->split_packet_stack = NULL;
+  storage->thread_packet_counts[0] += storage->no_of_packets;
+  storage->thread_line_event_counts[0] += storage->line_event_count;
+  storage->thread_busy_times[0] +=
+    (double) (clock () - start_time) / CLOCKS_PER_SEC;
 #endif
+  montecarlo_virtual_packets_shrink (storage);
 }
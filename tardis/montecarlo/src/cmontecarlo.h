@@ -8,13 +8,28 @@
 #include <stdlib.h>
 #include <math.h>
 #include "randomkit/randomkit.h"
+#include "philox.h"
 #include "rpacket.h"
 #include "status.h"
 #include "cmontecarlo1.h"
 
 typedef void (*montecarlo_event_handler_t) (rpacket_t * packet,
 					    storage_model_t * storage,
-					    double distance, rk_state *mt_state);
+					    double distance, philox_state_t *rng_state);
+
+/**
+ * @brief Real packets split off by the weight window that wait for their
+ * transport, together with their random number streams.
+ */
+typedef struct SplitPacketStack
+{
+  rpacket_t *packets;
+  philox_state_t *rng_states;
+  int64_t size;
+  int64_t capacity;
+  // splits of the packet that is transported, numbers the split streams
+  uint32_t no_of_splits;
+} split_packet_stack_t;
 
 void initialize_random_kit (unsigned long seed);
 
@@ -51,7 +66,29 @@ tardis_error_t compute_distance2line (const rpacket_t * packet,
  */
 void compute_distance2continuum (rpacket_t * packet, storage_model_t * storage);
 
-int64_t macro_atom (const rpacket_t * packet, const storage_model_t * storage, rk_state *mt_state);
+int64_t macro_atom (const rpacket_t * packet, const storage_model_t * storage, philox_state_t *rng_state);
+
+/** Initialize an empty sparse estimator that does not grow and has no
+ * overflow array.
+ *
+ * @param estimator sparse estimator
+ * @param capacity initial number of slots, has to be a power of two
+ */
+void sparse_estimator_init (sparse_estimator_t * estimator, int64_t capacity);
+
+void sparse_estimator_free (sparse_estimator_t * estimator);
+
+/** Add a value to the estimator element with the given index.
+ *
+ * The map doubles its slots while it stays within max_capacity. A new index
+ * that does not fit any more is added to overflow_values instead.
+ *
+ * @param estimator sparse estimator
+ * @param index index of the element in the dense estimator array
+ * @param value value to add
+ */
+void sparse_estimator_add (sparse_estimator_t * estimator, int64_t index,
+			   double value);
 
 double move_packet (rpacket_t * packet, storage_model_t * storage,
 			   double distance);
@@ -61,24 +98,40 @@ void increment_j_blue_estimator (const rpacket_t * packet,
 					double d_line, int64_t j_blue_idx);
 
 int64_t montecarlo_one_packet (storage_model_t * storage, rpacket_t * packet,
-			       int64_t virtual_mode, rk_state *mt_state);
+			       int64_t virtual_mode, philox_state_t *rng_state);
 
 int64_t montecarlo_one_packet_loop (storage_model_t * storage,
 				    rpacket_t * packet,
-				    int64_t virtual_packet, rk_state *mt_state);
+				    int64_t virtual_packet, philox_state_t *rng_state);
 
+/** Transport all packets of the storage.
+ *
+ * Every packet draws its random numbers from its own Philox stream keyed by
+ * the seed, the iteration and its packet id, so the results do not depend on
+ * the number of threads.
+ *
+ * @param storage storage model data
+ * @param virtual_packet_flag number of virtual packets per interaction
+ * @param nthreads number of OpenMP threads
+ * @param seed seed of the random number streams
+ * @param iteration iteration number, selects the random number streams
+ * @param first_packet_id id of the first packet of the storage in the
+ * iteration, selects the random number streams of the packets
+ */
 void montecarlo_main_loop(storage_model_t * storage,
 			  int64_t virtual_packet_flag,
 			  int nthreads,
-			  unsigned long seed);
+			  unsigned long seed,
+			  int64_t iteration,
+			  int64_t first_packet_id);
 
 /* New handlers for continuum implementation */
 
-montecarlo_event_handler_t montecarlo_continuum_event_handler(rpacket_t * packet, storage_model_t * storage, rk_state *mt_state);
+montecarlo_event_handler_t montecarlo_continuum_event_handler(rpacket_t * packet, storage_model_t * storage, philox_state_t *rng_state);
 
-void montecarlo_free_free_scatter (rpacket_t * packet, storage_model_t * storage, double distance, rk_state *mt_state);
+void montecarlo_free_free_scatter (rpacket_t * packet, storage_model_t * storage, double distance, philox_state_t *rng_state);
 
-void montecarlo_bound_free_scatter (rpacket_t * packet, storage_model_t * storage, double distance, rk_state *mt_state);
+void montecarlo_bound_free_scatter (rpacket_t * packet, storage_model_t * storage, double distance, philox_state_t *rng_state);
 
 double
 bf_cross_section(const storage_model_t * storage, int64_t continuum_id, double comov_nu);
@@ -87,14 +140,14 @@ void calculate_chi_bf(rpacket_t * packet, storage_model_t * storage);
 
 void
 move_packet_across_shell_boundary (rpacket_t * packet,
-                                   storage_model_t * storage, double distance, rk_state *mt_state);
+                                   storage_model_t * storage, double distance, philox_state_t *rng_state);
 
 void
 montecarlo_thomson_scatter (rpacket_t * packet, storage_model_t * storage,
-                            double distance, rk_state *mt_state);
+                            double distance, philox_state_t *rng_state);
 
 void
 montecarlo_line_scatter (rpacket_t * packet, storage_model_t * storage,
-                         double distance, rk_state *mt_state);
+                         double distance, philox_state_t *rng_state);
 
 #endif // TARDIS_CMONTECARLO_H
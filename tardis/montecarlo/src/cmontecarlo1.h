@@ -1,6 +1,9 @@
 #ifndef TARDIS_CMONTECARLO1_H
 #define TARDIS_CMONTECARLO1_H
 
+#include "status.h"
+#include "storage.h"
+
 /** Insert a value in to an array of line frequencies
  *
  * @param nu array of line frequencies
@@ -12,4 +15,46 @@
 tardis_error_t line_search (const double *nu, double nu_insert,
        int64_t number_of_lines, int64_t * result);
 
+/** Insert a value in to an array of line frequencies using a line search index
+ *
+ * @param index coarse index over the logarithmic line frequencies
+ * @param nu array of line frequencies
+ * @param nu_insert value of nu key
+ * @param number_of_lines number of lines in the line list
+ *
+ * @return index of the next line to the red, same as line_search.
+ */
+tardis_error_t indexed_line_search (const line_search_index_t *index,
+       const double *nu, double nu_insert, int64_t number_of_lines,
+       int64_t * result);
+
+/** Find a line of the transport in the line list of a shell
+ *
+ * @param storage storage model data with per shell line lists
+ * @param shell_id id of the shell
+ * @param transport_line_id id in the line list of the transport
+ * @param hint index in the per shell arrays close to the result, the search
+ * starts there if it is a line of the shell
+ *
+ * @return index in the per shell arrays of the first line of the shell with
+ * an id that is not smaller than transport_line_id. If there is none it is
+ * the end of the line list of the shell.
+ */
+int64_t shell_line_seek (const storage_model_t * storage, int64_t shell_id,
+       int64_t transport_line_id, int64_t hint);
+
+/** End of the line list a packet in a shell is transported through.
+ *
+ * @param storage storage model data
+ * @param shell_id id of the shell
+ *
+ * @return next line id of a packet that is redder than all lines
+ */
+static inline int64_t
+transport_line_list_end (const storage_model_t * storage, int64_t shell_id)
+{
+  return storage->shell_line_offsets == NULL ? storage->no_of_lines :
+    storage->shell_line_offsets[shell_id + 1];
+}
+
 #endif
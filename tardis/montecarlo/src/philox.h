@@ -0,0 +1,129 @@
+#ifndef TARDIS_PHILOX_H
+#define TARDIS_PHILOX_H
+
+#include <stdint.h>
+
+#define PHILOX_M0 0xD2511F53U
+#define PHILOX_M1 0xCD9E8D57U
+#define PHILOX_W0 0x9E3779B9U
+#define PHILOX_W1 0xBB67AE85U
+#define PHILOX_ROUNDS 10
+
+/**
+ * @brief State of a Philox4x32-10 random number stream.
+ *
+ * Philox (Salmon et al. 2011, Parallel random numbers: as easy as 1, 2, 3)
+ * is a counter-based generator: the output is a bijection of the counter,
+ * keyed by the seed. Every packet gets its own stream by putting its id
+ * into the counter, so the random numbers of a packet neither depend on
+ * the thread that transports it nor on the other packets.
+ */
+typedef struct PhiloxState
+{
+  uint32_t key[2];
+  uint32_t counter[4];
+  uint32_t output[4];
+  int position;
+} philox_state_t;
+
+static inline void
+philox_round (uint32_t * counter, const uint32_t * key)
+{
+  uint64_t product0 = (uint64_t) PHILOX_M0 * counter[0];
+  uint64_t product1 = (uint64_t) PHILOX_M1 * counter[2];
+  uint32_t hi0 = (uint32_t) (product0 >> 32);
+  uint32_t hi1 = (uint32_t) (product1 >> 32);
+  counter[0] = hi1 ^ counter[1] ^ key[0];
+  counter[1] = (uint32_t) product1;
+  counter[2] = hi0 ^ counter[3] ^ key[1];
+  counter[3] = (uint32_t) product0;
+}
+
+/** Encrypt a counter block with the ten Philox rounds.
+ *
+ * @param counter counter block
+ * @param key key of the stream
+ * @param output the four random words of the block
+ */
+static inline void
+philox4x32 (const uint32_t * counter, const uint32_t * key, uint32_t * output)
+{
+  uint32_t round_key[2] = { key[0], key[1] };
+  output[0] = counter[0];
+  output[1] = counter[1];
+  output[2] = counter[2];
+  output[3] = counter[3];
+  for (int i = 0; i < PHILOX_ROUNDS; ++i)
+    {
+      if (i > 0)
+        {
+          round_key[0] += PHILOX_W0;
+          round_key[1] += PHILOX_W1;
+        }
+      philox_round (output, round_key);
+    }
+}
+
+/** Start a random number stream.
+ *
+ * @param state stream state
+ * @param seed key of the stream
+ * @param stream 64 bit stream id, e.g. the packet id
+ * @param substream 32 bit substream id, e.g. the iteration
+ */
+static inline void
+philox_seed (philox_state_t * state, uint64_t seed, uint64_t stream,
+             uint32_t substream)
+{
+  state->key[0] = (uint32_t) seed;
+  state->key[1] = (uint32_t) (seed >> 32);
+  state->counter[0] = 0;
+  state->counter[1] = substream;
+  state->counter[2] = (uint32_t) stream;
+  state->counter[3] = (uint32_t) (stream >> 32);
+  state->position = 4;
+}
+
+/** Draw a random 32 bit word from a stream. */
+static inline uint32_t
+philox_random (philox_state_t * state)
+{
+  if (state->position == 4)
+    {
+      philox4x32 (state->counter, state->key, state->output);
+      ++state->counter[0];
+      state->position = 0;
+    }
+  return state->output[state->position++];
+}
+
+/** Seed the stream of a packet that is split off the packet using the
+ * stream of state. The split streams use the upper 16 bits of the
+ * substream, so the streams of up to 65535 splits per packet and of 65536
+ * iterations are distinct.
+ */
+static inline void
+philox_split (const philox_state_t * state, philox_state_t * split_state,
+              uint32_t split_id)
+{
+  split_state->key[0] = state->key[0];
+  split_state->key[1] = state->key[1];
+  split_state->counter[0] = 0;
+  split_state->counter[1] = (state->counter[1] & 0xFFFFU) | (split_id << 16);
+  split_state->counter[2] = state->counter[2];
+  split_state->counter[3] = state->counter[3];
+  split_state->position = 4;
+}
+
+/** Draw a uniform random double in [0, 1) with 53 bit resolution, the same
+ * construction as rk_double.
+ */
+static inline double
+philox_double (philox_state_t * state)
+{
+  uint32_t a = philox_random (state) >> 5;
+  uint32_t b = philox_random (state) >> 6;
+  return (a * 67108864.0 + b) / 9007199254740992.0;
+}
+
+#endif // TARDIS_PHILOX_H
@@ -1,15 +1,25 @@
 #include "rpacket.h"
 #include "storage.h"
+#include "cmontecarlo1.h"
 
 tardis_error_t
 rpacket_init (rpacket_t * packet, storage_model_t * storage, int packet_index,
 	      int virtual_packet_flag)
+{
+  return rpacket_init_at_inner_boundary (packet, storage,
+					 storage->packet_nus[packet_index],
+					 storage->packet_mus[packet_index],
+					 storage->packet_energies[packet_index],
+					 virtual_packet_flag);
+}
+
+tardis_error_t
+rpacket_init_at_inner_boundary (rpacket_t * packet, storage_model_t * storage,
+				double current_nu, double current_mu,
+				double current_energy, int virtual_packet_flag)
 {
   int64_t current_line_id;
   tardis_error_t ret_val = TARDIS_ERROR_OK;
-  double current_nu = storage->packet_nus[packet_index];
-  double current_energy = storage->packet_energies[packet_index];
-  double current_mu = storage->packet_mus[packet_index];
   double comov_current_nu = current_nu;
   int current_shell_id = 0;
   double current_r = storage->r_inner[0];
@@ -21,14 +31,29 @@ rpacket_init (rpacket_t * packet, storage_model_t * storage, int packet_index,
     current_energy / (1 -
 		      (current_mu * current_r *
 		       storage->inverse_time_explosion * INVERSE_C));
-  if ((ret_val =
-       line_search (storage->line_list_nu, comov_current_nu,
-		    storage->no_of_lines,
-		    &current_line_id)) != TARDIS_ERROR_OK)
+  if (storage->line_search_index.no_of_buckets > 0)
+    {
+      ret_val = indexed_line_search (&storage->line_search_index,
+                                     storage->line_list_nu, comov_current_nu,
+                                     storage->no_of_lines, &current_line_id);
+    }
+  else
+    {
+      ret_val = line_search (storage->line_list_nu, comov_current_nu,
+                             storage->no_of_lines, &current_line_id);
+    }
+  if (ret_val != TARDIS_ERROR_OK)
     {
       return ret_val;
     }
-  bool last_line = (current_line_id == storage->no_of_lines);
+  rpacket_set_next_transport_line_id (packet, current_line_id);
+  if (storage->shell_line_offsets != NULL)
+    {
+      current_line_id = shell_line_seek (storage, current_shell_id,
+                                         current_line_id, -1);
+    }
+  bool last_line = (current_line_id ==
+                    transport_line_list_end (storage, current_shell_id));
   rpacket_set_nu (packet, current_nu);
   rpacket_set_mu (packet, current_mu);
   rpacket_set_energy (packet, current_energy);
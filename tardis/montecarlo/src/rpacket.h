@@ -8,6 +8,7 @@
 #include <stdlib.h>
 #include <math.h>
 #include "randomkit/randomkit.h"
+#include "philox.h"
 #include "status.h"
 #include "storage.h"
 #include "cmontecarlo1.h"
@@ -31,6 +32,11 @@ typedef struct RPacket
   double nu_line;
   int64_t current_shell_id; /**< ID of the current shell. */
   int64_t next_line_id;	/**< The index of the next line that the packet will encounter. */
+  /**
+   * @brief The first line in the line list of the transport the packet has not passed.
+   * Differs from next_line_id with per shell line lists.
+   */
+  int64_t next_transport_line_id;
   /**
    * @brief The packet has a nu red-ward of the last line.
    * It will not encounter any lines anymore.
@@ -151,6 +157,17 @@ static inline void rpacket_set_next_line_id (rpacket_t * packet,
   packet->next_line_id = next_line_id;
 }
 
+static inline int64_t rpacket_get_next_transport_line_id (const rpacket_t * packet)
+{
+  return packet->next_transport_line_id;
+}
+
+static inline void rpacket_set_next_transport_line_id (rpacket_t * packet,
+              int64_t next_transport_line_id)
+{
+  packet->next_transport_line_id = next_transport_line_id;
+}
+
 static inline bool rpacket_get_last_line (const rpacket_t * packet)
 {
   return packet->last_line;
@@ -264,14 +281,21 @@ static inline void rpacket_set_id (rpacket_t * packet, int id)
   packet->id = id;
 }
 
-static inline void rpacket_reset_tau_event (rpacket_t * packet, rk_state *mt_state)
+static inline void rpacket_reset_tau_event (rpacket_t * packet, philox_state_t *rng_state)
 {
-  rpacket_set_tau_event (packet, -log (rk_double (mt_state)));
+  rpacket_set_tau_event (packet, -log (philox_double (rng_state)));
 }
 
 tardis_error_t rpacket_init (rpacket_t * packet, storage_model_t * storage,
            int packet_index, int virtual_packet_flag);
 
+/** Initialize a packet at the inner boundary from its comoving frequency,
+ * direction and energy.
+ */
+tardis_error_t rpacket_init_at_inner_boundary (rpacket_t * packet,
+           storage_model_t * storage, double current_nu, double current_mu,
+           double current_energy, int virtual_packet_flag);
+
 /* New getter and setter methods for continuum implementation */
 
 static inline void rpacket_set_d_continuum (rpacket_t * packet, double d_continuum)
@@ -8,11 +8,88 @@
 #include <stdlib.h>
 #include <math.h>
 
+/**
+ * @brief Open addressing hash map from j_blue index to accumulated value.
+ *
+ * Used as a thread-private j_blue estimator when a dense per-thread copy of
+ * the lines x shells array would use too much memory. The map grows up to
+ * max_capacity slots, values of further indices are added atomically to the
+ * shared dense array overflow_values.
+ */
+typedef struct SparseEstimator
+{
+  int64_t *indices;
+  double *values;
+  int64_t size;
+  int64_t capacity;
+  int64_t max_capacity;
+  double *overflow_values;
+} sparse_estimator_t;
+
+/**
+ * @brief Coarse index over the logarithmic line frequencies.
+ *
+ * Bucket i covers log(nu) from log_nu_max - i / inverse_delta_log_nu down to
+ * log_nu_max - (i + 1) / inverse_delta_log_nu. bucket_line_ids[i] is the first
+ * line redder than the blue edge of bucket i and bucket_line_ids[no_of_buckets]
+ * is the number of lines.
+ */
+typedef struct LineSearchIndex
+{
+  int64_t *bucket_line_ids;
+  int64_t no_of_buckets;
+  double log_nu_max;
+  double inverse_delta_log_nu;
+} line_search_index_t;
+
+/**
+ * @brief A virtual packet whose transport is deferred.
+ *
+ * Holds the state of the packet when it is spawned and the last interaction
+ * of its real packet at that time.
+ */
+typedef struct VirtualPacket
+{
+  double nu;
+  double mu;
+  double energy;
+  double r;
+  double weight;
+  int64_t current_shell_id;
+  int64_t next_line_id;
+  int64_t next_transport_line_id;
+  int64_t last_line;
+  int64_t close_line;
+  int64_t recently_crossed_boundary;
+  int64_t current_continuum_id;
+  double last_interaction_in_nu;
+  int64_t last_interaction_type;
+  int64_t last_line_interaction_in_id;
+  int64_t last_line_interaction_out_id;
+} virtual_packet_t;
+
+/**
+ * @brief Virtual packets of a thread that wait for their transport.
+ */
+typedef struct VirtualPacketQueue
+{
+  virtual_packet_t *packets;
+  int64_t size;
+  int64_t capacity;
+} virtual_packet_queue_t;
+
+struct SplitPacketStack;
+
 typedef struct StorageModel
 {
   double *packet_nus;
   double *packet_mus;
   double *packet_energies;
+  // The transport draws the packets from a blackbody if packet_nus is NULL,
+  // with frequencies in units of packet_source_nu_unit = k T / h and
+  // packet_source_energy each.
+  double packet_source_nu_unit;
+  double packet_source_energy;
   double *output_nus;
   double *output_energies;
   double *last_interaction_in_nu;
@@ -30,16 +107,43 @@ typedef struct StorageModel
   double *electron_densities;
   double *inverse_electron_densities;
   double *line_list_nu;
+  line_search_index_t line_search_index;
+  // Lines can be emitted that are not in the line list of the transport.
+  double *full_line_list_nu;
+  // full line list id of every transported line, NULL if all lines are
+  // transported
+  int64_t *active_line_ids;
+  // first transported line after every line of the full line list
+  int64_t *next_active_line_ids;
+  // Lines of shell i are stored from shell_line_offsets[i] to
+  // shell_line_offsets[i + 1], NULL if all shells use line_list_nu.
+  int64_t *shell_line_offsets;
+  double *shell_line_list_nu;
+  // id in the line list of the transport of every line of the shells
+  int64_t *shell_line_ids;
+  double *shell_line_tau_sobolevs;
+  // Sum of the tau_sobolevs of the transported lines before line j in shell
+  // i at i * (no_of_lines + 1) + j, NULL if virtual packets walk the lines.
+  double *cumulative_tau_sobolevs;
   double *continuum_list_nu;
   double *line_lists_tau_sobolevs;
   int64_t line_lists_tau_sobolevs_nd;
+  int64_t shell_major_line_lists;
   double *line_lists_j_blues;
   int64_t line_lists_j_blues_nd;
+  sparse_estimator_t *line_lists_j_blues_sparse;
   int64_t no_of_lines;
   int64_t no_of_edges;
   int64_t line_interaction_id;
   double *transition_probabilities;
   int64_t transition_probabilities_nd;
+  double *cumulative_transition_probabilities;
+  int64_t no_of_transitions;
+  int64_t *level_emission_offsets;
+  int64_t *level_emission_counts;
+  int64_t *emission_line_ids;
+  double *cumulative_emission_probabilities;
+  int64_t no_of_emission_entries;
   int64_t *line2macro_level_upper;
   int64_t *macro_block_references;
   int64_t *transition_type;
@@ -53,6 +157,18 @@ typedef struct StorageModel
   double spectrum_virt_start_nu;
   double spectrum_virt_end_nu;
   double *spectrum_virt_nu;
+  // Sum of the squared energies of the virtual packets in every bin of the
+  // virtual spectrum and the number of virtual packets spawned by a packet in
+  // every bin, NULL if every packet spawns virtual_packet_flag packets.
+  double *spectrum_virt_nu_squared;
+  int64_t *virtual_packet_counts;
+  int64_t no_of_spectrum_bins;
+  double *spectrum_emitted_nu;
+  double *spectrum_reabsorbed_nu;
+  int64_t no_of_real_spectrum_bins;
+  double luminosity_nu_start;
+  double luminosity_nu_end;
+  double *luminosity_window_energies;
   double sigma_thomson;
   double inverse_sigma_thomson;
   double inner_boundary_albedo;
@@ -71,6 +187,22 @@ typedef struct StorageModel
   int64_t *virt_packet_last_line_interaction_out_id;
   int64_t virt_packet_count;
   int64_t virt_array_size;
+  int64_t virt_packet_logging;
+  // Virtual packets are queued and transported in batches of this many
+  // after their real packets, 0 transports them when they are spawned.
+  int64_t virtual_packet_batch_size;
+  virtual_packet_queue_t *virtual_packet_queue;
+  int64_t thread_estimator_memory_limit;
+  // Center of the weight window of the real packet energies in every shell,
+  // NULL without Russian roulette and splitting.
+  double *weight_window_energies;
+  struct SplitPacketStack *split_packet_stack;
+  int64_t thread_schedule;
+  int64_t thread_schedule_chunk_size;
+  int64_t *thread_packet_counts;
+  int64_t *thread_line_event_counts;
+  int64_t line_event_count;
+  double *thread_busy_times;
 } storage_model_t;
 
 #endif // TARDIS_STORAGE_H
@@ -96,6 +96,14 @@ static void init_storage_model(storage_model_t *sm){
 	sm->line_list_nu[2] = 1.23357675e+16;
 	sm->line_list_nu[3] = 1.23357675e+16;
 	sm->line_list_nu[4] = 1.16961598e+16;
+	sm->line_search_index.no_of_buckets = 0;
+	sm->full_line_list_nu = sm->line_list_nu;
+	sm->active_line_ids = NULL;
+	sm->shell_line_offsets = NULL;
+	sm->cumulative_tau_sobolevs = NULL;
+	sm->cumulative_transition_probabilities = NULL;
+	sm->level_emission_offsets = NULL;
+	sm->shell_major_line_lists = false;
 
 	/* INVERSE_ELECTRON_DENSITIES = {} */
 	sm->inverse_electron_densities = (double *) malloc(sizeof(double)*NUMBER_OF_SHELLS);
@@ -128,6 +136,7 @@ static void init_storage_model(storage_model_t *sm){
 	sm->line_interaction_id = 0;
 
 	sm->line_lists_j_blues_nd = 0;
+	sm->line_lists_j_blues_sparse = NULL;
 
 	sm->line_lists_j_blues = (double *) malloc(sizeof(double )*2);
 	sm->line_lists_j_blues[0] = 1e-10;
@@ -155,6 +164,8 @@ static void init_storage_model(storage_model_t *sm){
 
 	sm->spectrum_virt_nu = (double *) malloc(sizeof(double )*20000);
 	memset(sm->spectrum_virt_nu, 0, sizeof(double)*20000);
+	sm->no_of_spectrum_bins = 20000;
+	sm->virt_packet_logging = false;
 
 	/*
 	*  Initialising the below values to 0 untill
@@ -206,9 +217,9 @@ static void dealloc_storage_model(storage_model_t *sm){
         free(sm->chi_bf_tmp_partial);
 }
 
-static void irandom(rk_state *mt_state)
+static void irandom(philox_state_t *mt_state)
 {
-memset(mt_state,0,sizeof(rk_state));
+philox_seed(mt_state, 0, 0, 0);
 }
 
 double
@@ -297,7 +308,7 @@ test_montecarlo_line_scatter(void){
         storage_model_t sm;
         init_rpacket(&rp);
         init_storage_model(&sm);
-        rk_state mt_state;
+        philox_state_t mt_state;
         irandom(&mt_state);
 	double DISTANCE = 1e13;
 	montecarlo_line_scatter(&rp, &sm, DISTANCE, &mt_state);
@@ -311,7 +322,7 @@ test_montecarlo_thomson_scatter(void){
         storage_model_t sm;
         init_rpacket(&rp);
         init_storage_model(&sm);
-        rk_state mt_state;
+        philox_state_t mt_state;
         irandom(&mt_state);
 	double DISTANCE = 1e13;
 	montecarlo_thomson_scatter(&rp, &sm, DISTANCE, &mt_state);
@@ -325,7 +336,7 @@ test_move_packet_across_shell_boundary(void){
         storage_model_t sm;
         init_rpacket(&rp);
         init_storage_model(&sm);
-        rk_state mt_state;
+        philox_state_t mt_state;
         irandom(&mt_state);
 	double DISTANCE = 0.95e13;
 // MR: wrong: move_packet_across_shell_boundary() returns void
@@ -341,7 +352,7 @@ test_montecarlo_one_packet(void){
         storage_model_t sm;
         init_rpacket(&rp);
         init_storage_model(&sm);
-        rk_state mt_state;
+        philox_state_t mt_state;
         irandom(&mt_state);
         int64_t res = montecarlo_one_packet(&sm, &rp, 1, &mt_state);
         dealloc_storage_model(&sm);
@@ -354,7 +365,7 @@ test_montecarlo_one_packet_loop(void){
         storage_model_t sm;
         init_rpacket(&rp);
         init_storage_model(&sm);
-        rk_state mt_state;
+        philox_state_t mt_state;
         irandom(&mt_state);
 	int64_t res= montecarlo_one_packet_loop(&sm, &rp, 1, &mt_state);
         dealloc_storage_model(&sm);
@@ -373,7 +384,7 @@ test_calculate_chi_bf(void){
         storage_model_t sm;
         init_rpacket(&rp);
         init_storage_model(&sm);
-        rk_state mt_state;
+        philox_state_t mt_state;
         irandom(&mt_state);
         int64_t j_blue_idx = 0;
         double D_BOUNDARY = compute_distance2boundary(&rp, &sm);
@@ -406,7 +417,7 @@ test_montecarlo_bound_free_scatter(void){
         storage_model_t sm;
         init_rpacket(&rp);
         init_storage_model(&sm);
-        rk_state mt_state;
+        philox_state_t mt_state;
         irandom(&mt_state);
 	double DISTANCE = 1e13;
 	montecarlo_bound_free_scatter(&rp, &sm, DISTANCE, &mt_state);
@@ -430,7 +441,7 @@ test_montecarlo_free_free_scatter(void){
         storage_model_t sm;
         init_rpacket(&rp);
         init_storage_model(&sm);
-        rk_state mt_state;
+        philox_state_t mt_state;
         irandom(&mt_state);
 	double DISTANCE = 1e13;
 	montecarlo_free_free_scatter(&rp, &sm, DISTANCE,&mt_state);
@@ -0,0 +1,161 @@
+"""
+Small synthetic models for testing the montecarlo kernel without atomic data.
+
+Same models as asv/benchmarks/model_setup.py. The objects built here provide
+exactly the attributes that `MontecarloRunner.run` and `montecarlo_radial1d`
+read from a `Radial1DModel`.
+"""
+
+from types import SimpleNamespace
+
+import numpy as np
+from astropy import units as u
+
+
+class _Values(SimpleNamespace):
+    """Stand-in for a pandas object of which only ``.values`` is used."""
+
+
+def make_montecarlo_config(**kwargs):
+    """
+    Montecarlo configuration section with the defaults of
+    tardis_config_definition.yml, overridden by `kwargs`.
+    """
+    montecarlo = SimpleNamespace(
+        seed=23111963,
+        packet_source='random',
+        packet_source_bands=[],
+        packet_source_spectrum_file=None,
+        virtual_spectrum_range=SimpleNamespace(start=50 * u.angstrom,
+                                               end=250000 * u.angstrom),
+        sigma_thomson=6.652486e-25 / u.cm ** 2,
+        enable_reflective_inner_boundary=False,
+        inner_boundary_albedo=0.0,
+        thread_estimator_memory_limit=1 * u.GB,
+        virtual_packet_logging=True,
+        virtual_packet_batch_size=0,
+        virtual_packet_relative_error=0,
+        line_search_buckets=-1,
+        active_line_tau_threshold=-1,
+        shell_line_tau_threshold=-1,
+        virtual_packet_engine='walk',
+        macro_atom_sampling='cumulative',
+        macro_atom_emission_probabilities=False,
+        macro_atom_emission_memory_limit=1 * u.GB,
+        shell_major_line_lists=False,
+        weight_window_importance_ratio=1,
+        thread_schedule='static',
+        thread_schedule_chunk_size=0,
+        packet_diagnostics='all')
+    for key, value in kwargs.items():
+        setattr(montecarlo, key, value)
+    return montecarlo
+
+
+def make_model(no_of_shells=5, no_of_lines=500, no_of_packets=2000,
+               line_interaction_type='macroatom', transitions_per_level=2,
+               levels_per_species=None, emission_probability=0.6,
+               radiative_rates_type='detailed', **montecarlo_kwargs):
+    """
+    Build a small W7-like stratified model with a random line list.
+
+    Parameters
+    ----------
+    no_of_shells : int
+    no_of_lines : int
+    no_of_packets : int
+    line_interaction_type : str
+        'scatter', 'downbranch' or 'macroatom'
+    transitions_per_level : int
+        number of macro atom transitions of every level, one emission and
+        internal jumps to other levels
+    levels_per_species : int
+        internal jumps stay within consecutive groups of this many levels,
+        all levels are connected if None
+    emission_probability : float
+        probability of a macro atom level to emit its line instead of
+        jumping to another level
+    radiative_rates_type : str
+        the j_blue estimator is only accumulated for 'detailed'
+    montecarlo_kwargs :
+        overrides for the montecarlo configuration section
+
+    Returns
+    -------
+    model : SimpleNamespace
+        object usable in place of a `Radial1DModel` by `MontecarloRunner.run`
+    """
+    rng = np.random.RandomState(1963)
+    time_explosion = 13 * u.day
+    velocities = np.linspace(1.1e9, 2.0e9, no_of_shells + 1) * u.cm / u.s
+    radii = (velocities * time_explosion).to('cm')
+
+    line_nu = np.sort(rng.uniform(1e14, 3e15, no_of_lines))[::-1].copy()
+    # optically thick lines get rarer towards the outer shells
+    tau_sobolevs = np.ascontiguousarray(
+        rng.lognormal(-2, 2.5, (no_of_lines, no_of_shells)) *
+        np.linspace(3, 0.1, no_of_shells)[np.newaxis])
+
+    # every macro atom level can either emit its line or jump to other levels
+    no_of_transitions = transitions_per_level * no_of_lines
+    transition_probabilities = np.empty((no_of_transitions, no_of_shells))
+    transition_probabilities[0::transitions_per_level] = emission_probability
+    transition_type = np.zeros(no_of_transitions, dtype=np.int64)
+    transition_type[0::transitions_per_level] = -1
+    destination_level_idx = np.empty(no_of_transitions, dtype=np.int64)
+    destination_level_idx[0::transitions_per_level] = np.arange(no_of_lines)
+    levels = np.arange(no_of_lines)
+    if levels_per_species is None:
+        species_start = np.zeros_like(levels)
+        species_size = no_of_lines
+    else:
+        species_start = levels // levels_per_species * levels_per_species
+        species_size = np.minimum(levels_per_species,
+                                  no_of_lines - species_start)
+    for i in range(1, transitions_per_level):
+        transition_probabilities[i::transitions_per_level] = (
+            (1 - emission_probability) / (transitions_per_level - 1))
+        destination_level_idx[i::transitions_per_level] = species_start + (
+            levels - species_start + 7 * i) % species_size
+    lines_idx = -np.ones(no_of_transitions, dtype=np.int64)
+    lines_idx[0::transitions_per_level] = np.arange(no_of_lines)
+
+    frequency = np.linspace(1e14, 3e15, 1001) * u.Hz
+    tardis_config = SimpleNamespace(
+        structure=SimpleNamespace(
+            no_of_shells=no_of_shells, r_inner=radii[:-1],
+            r_outer=radii[1:], v_inner=velocities[:-1],
+            volumes=(4. / 3 * np.pi * (radii[1:] ** 3 - radii[:-1] ** 3))),
+        supernova=SimpleNamespace(time_explosion=time_explosion,
+                                  luminosity_nu_start=0 * u.Hz,
+                                  luminosity_nu_end=np.inf * u.Hz),
+        plasma=SimpleNamespace(line_interaction_type=line_interaction_type,
+                               radiative_rates_type=radiative_rates_type),
+        spectrum=SimpleNamespace(frequency=frequency),
+        montecarlo=make_montecarlo_config(**montecarlo_kwargs))
+
+    atom_data = SimpleNamespace(
+        lines=SimpleNamespace(nu=_Values(values=line_nu)),
+        lines_upper2macro_reference_idx=np.arange(no_of_lines,
+                                                  dtype=np.int64),
+        macro_atom_references={'block_references': _Values(
+            values=transitions_per_level * np.arange(no_of_lines,
+                                                     dtype=np.int64))},
+        macro_atom_data={
+            'transition_type': _Values(values=transition_type),
+            'destination_level_idx': _Values(values=destination_level_idx),
+            'lines_idx': _Values(values=lines_idx)})
+
+    plasma_array = SimpleNamespace(
+        electron_densities=_Values(
+            values=np.linspace(5e9, 1e8, no_of_shells)),
+        tau_sobolevs=_Values(values=tau_sobolevs),
+        t_electrons=np.ones(no_of_shells) * 1e4)
+
+    return SimpleNamespace(
+        tardis_config=tardis_config, atom_data=atom_data,
+        plasma_array=plasma_array,
+        transition_probabilities=_Values(values=transition_probabilities),
+        montecarlo_virtual_luminosity=np.zeros(frequency.size - 1),
+        current_no_of_packets=no_of_packets, t_inner=10000 * u.K,
+        time_of_simulation=1.0 * u.s)
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from tardis.montecarlo import montecarlo
+
+
+@pytest.fixture
+def line_list_nu():
+    rng = np.random.RandomState(1)
+    nu = np.sort(rng.lognormal(34, 1.0, 1000))[::-1]
+    # atomic line lists contain lines with identical frequencies
+    return np.repeat(nu, 2)
+
+
+@pytest.mark.parametrize('no_of_buckets', [1, 7, 2000, 20000])
+def test_indexed_line_search(line_list_nu, no_of_buckets):
+    rng = np.random.RandomState(2)
+    nus = np.concatenate([
+        rng.uniform(0.5 * line_list_nu.min(), 1.5 * line_list_nu.max(), 10000),
+        line_list_nu])
+    line_search_index = montecarlo.make_line_search_index(line_list_nu,
+                                                          no_of_buckets)
+    line_ids = montecarlo.search_lines(line_list_nu, nus, line_search_index)
+    # the first line that is redder than the frequency
+    expected_line_ids = line_list_nu.size - np.searchsorted(
+        line_list_nu[::-1], nus, side='left')
+    np.testing.assert_array_equal(line_ids, expected_line_ids)
@@ -0,0 +1,52 @@
+import numpy as np
+import numpy.testing as npt
+
+from tardis.montecarlo.macro_atom import calculate_emission_probabilities
+
+
+def test_calculate_emission_probabilities():
+    # level 0 emits line 0, level 1 emits line 1 or jumps to level 0,
+    # level 2 emits line 2 or jumps to level 1, level 3 is a separate ion
+    block_references = np.array([0, 1, 3, 5, 6])
+    transition_type = np.array([-1, -1, 0, -1, 0, -1])
+    destination_level_id = np.array([0, 1, 0, 2, 1, 3])
+    transition_line_id = np.array([0, 1, -1, 2, -1, 3])
+    transition_probabilities = np.array([
+        [1.0, 1.0], [0.5, 0.2], [0.5, 0.8], [0.4, 1.0], [0.6, 0.0],
+        [1.0, 1.0]])
+
+    (level_emission_offsets, level_emission_counts, emission_line_ids,
+     cumulative_emission_probabilities) = calculate_emission_probabilities(
+        transition_probabilities, block_references, transition_type,
+        destination_level_id, transition_line_id, 1e6)
+
+    expected = {
+        0: [{0: 1.0}, {0: 1.0}],
+        1: [{0: 0.5, 1: 0.5}, {0: 0.8, 1: 0.2}],
+        2: [{0: 0.3, 1: 0.3, 2: 0.4}, {2: 1.0}],
+        3: [{3: 1.0}, {3: 1.0}]}
+    for level, shells in expected.items():
+        row = slice(level_emission_offsets[level],
+                    level_emission_offsets[level] +
+                    level_emission_counts[level])
+        for shell, emission in enumerate(shells):
+            probabilities = np.diff(np.hstack((
+                0.0, cumulative_emission_probabilities[shell, row])))
+            emitted = dict(zip(emission_line_ids[row], probabilities))
+            for line_id in emitted:
+                npt.assert_allclose(emitted[line_id],
+                                    emission.get(line_id, 0.0), atol=1e-12)
+
+
+def test_calculate_emission_probabilities_memory_limit():
+    block_references = np.array([0, 2, 3])
+    transition_type = np.array([-1, 0, -1])
+    destination_level_id = np.array([0, 1, 1])
+    transition_line_id = np.array([0, -1, 1])
+    transition_probabilities = np.array([[0.5], [0.5], [1.0]])
+
+    level_emission_offsets = calculate_emission_probabilities(
+        transition_probabilities, block_references, transition_type,
+        destination_level_id, transition_line_id, 0)[0]
+
+    npt.assert_array_equal(level_emission_offsets, [-1, -1])
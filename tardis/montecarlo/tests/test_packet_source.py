@@ -2,9 +2,14 @@ import os
 
 import numpy as np
 import pytest
+from astropy import constants as const
 
 import tardis
-from tardis.montecarlo.packet_source import BlackBodySimpleSource
+from tardis.montecarlo import montecarlo
+from tardis.montecarlo.packet_source import (BlackBodySimpleSource,
+                                            SobolBlackBodySource,
+                                            StratifiedBlackBodySource,
+                                            TabulatedSpectrumSource)
 
 @pytest.fixture
 def data_path():
@@ -20,3 +25,102 @@ def test_bb_packet_source(data_path):
     assert np.all(np.isclose(packets, reference_packets))
 
 
+def test_bb_packet_source_chunks(data_path):
+    np.random.seed(1)
+    global_random_numbers = np.random.random(10)
+    np.random.seed(1)
+    bb = BlackBodySimpleSource(2508, chunk_size=30)
+    packets = bb.create_packet_nus(10000, 100)
+    # the source does not touch the global random state
+    np.testing.assert_array_equal(np.random.random(10), global_random_numbers)
+    reference_packets = np.load(os.path.join(data_path,
+                                             'mc_packets_100_t10000.npy'))
+    assert packets.shape == reference_packets.shape
+    np.testing.assert_allclose(packets.mean(), reference_packets.mean(),
+                               rtol=0.2)
+
+
+def test_sobol_packet_source():
+    sobol = SobolBlackBodySource(2508)
+    nus, mus, energies = sobol.create_packets(10000, 100)
+    more_nus, more_mus, _ = sobol.create_packets(10000, 100)
+    all_nus, all_mus, _ = SobolBlackBodySource(2508).create_packets(10000, 200)
+    np.testing.assert_array_equal(np.concatenate((nus, more_nus)), all_nus)
+    np.testing.assert_array_equal(np.concatenate((mus, more_mus)), all_mus)
+    assert np.all((mus > 0) & (mus <= 1))
+    assert np.all(nus > 0)
+    np.testing.assert_allclose(energies.sum(), 1)
+    other_nus = SobolBlackBodySource(2509).create_packets(10000, 100)[0]
+    assert not np.any(np.isclose(other_nus, nus))
+
+
+def test_sobol_sequence_scrambling():
+    points = montecarlo.SobolSequence(6, 2508).draw(1023)
+    other_points = montecarlo.SobolSequence(6, 2509).draw(1023)
+    # the scrambled points keep their net properties, the first 2^m - 1 points
+    # fall into different cells of width 2^-m
+    for coordinate in points:
+        assert np.unique(np.floor(coordinate * 1024)).size == 1023
+    cells = np.floor(points[:2] * 32).astype(int)
+    assert np.unique(cells[0] * 32 + cells[1]).size == 1023
+    # a digital shift alone would differ by the same bits for every point
+    digits = (points * 2 ** 32).astype(np.uint64)
+    other_digits = (other_points * 2 ** 32).astype(np.uint64)
+    for coordinate, other_coordinate in zip(digits, other_digits):
+        assert np.unique(coordinate ^ other_coordinate).size > 1
+
+
+def test_stratified_packet_source():
+    nu_to_x = const.h.cgs.value / (const.k_B.cgs.value * 10000)
+    uv_band = (8.56e14, 3e15, 4.0)
+    for bands in [[], [uv_band]]:
+        stratified = StratifiedBlackBodySource(2508, bands)
+        nus, mus, energies = stratified.create_packets(10000, 10000)
+        # mean x of a blackbody is 360 zeta(5) / pi^4
+        np.testing.assert_allclose((nus * energies).sum() * nu_to_x,
+                                   3.83223, rtol=1e-3)
+        np.testing.assert_allclose(energies.sum(), 1, rtol=1e-3)
+        assert np.all((mus > 0) & (mus <= 1))
+        in_band = (nus >= uv_band[0]) & (nus < uv_band[1])
+        if bands:
+            assert in_band.sum() > 1.5 * uv_packets
+        else:
+            uv_packets = in_band.sum()
+
+
+def test_chunked_packet_sources():
+    # the sources continue their random numbers over the chunks
+    for source_class in [SobolBlackBodySource, StratifiedBlackBodySource]:
+        packets = source_class(2508).create_packets(10000, 1000)
+        chunked_packets = source_class(2508, chunk_size=300).create_packets(
+            10000, 1000)
+        for values, chunked_values in zip(packets, chunked_packets):
+            np.testing.assert_array_equal(chunked_values, values)
+
+
+def test_tabulated_spectrum_source():
+    nu_bins = np.array([4e15, 3e15, 2e15, 1e15])
+    tabulated = TabulatedSpectrumSource(2508, nu_bins, [1., 0., 3.],
+                                        chunk_size=1000)
+    nus, mus, energies = tabulated.create_packets(10000, 100000)
+    assert np.all((nus >= 1e15) & (nus < 4e15))
+    assert not np.any((nus >= 2e15) & (nus < 3e15))
+    np.testing.assert_allclose((nus < 2e15).mean(), 0.75, atol=0.01)
+    np.testing.assert_allclose(nus[nus < 2e15].mean(), 1.5e15, rtol=0.01)
+    np.testing.assert_allclose(energies.sum(), 1)
+    with pytest.raises(ValueError):
+        TabulatedSpectrumSource(2508, nu_bins, [1., 1.])
+
+
+def test_tabulated_spectrum_source_from_ascii(tmpdir):
+    # flat in frequency: L_lambda = c / lambda^2
+    wavelength = np.linspace(1000, 10000, 50)
+    fname = str(tmpdir.join('spectrum.dat'))
+    np.savetxt(fname, np.transpose([wavelength, 1 / wavelength ** 2]))
+    tabulated = TabulatedSpectrumSource.from_ascii(2508, fname)
+    nus = tabulated.create_packet_nus(10000, 100000)
+    nu_min = const.c.cgs.value / 1e-4
+    nu_max = const.c.cgs.value / 1e-5
+    assert np.all((nus >= nu_min) & (nus < nu_max))
+    np.testing.assert_allclose(nus.mean(), 0.5 * (nu_min + nu_max),
+                               rtol=0.01)
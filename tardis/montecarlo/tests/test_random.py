@@ -0,0 +1,24 @@
+import numpy as np
+import numpy.testing as npt
+
+from tardis.montecarlo import montecarlo
+
+
+def test_philox_known_answer():
+    # first block of Philox4x32-10 for zero counter and key is
+    # (0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8)
+    random_numbers = montecarlo.random_doubles(2, 0)
+    npt.assert_equal(random_numbers[0],
+                     ((0x6627e8d5 >> 5) * 67108864.0 + (0xe169c58d >> 6)) /
+                     9007199254740992.0)
+
+
+def test_philox_streams():
+    random_numbers = montecarlo.random_doubles(10000, 23111963, stream=5)
+    assert np.all((random_numbers >= 0) & (random_numbers < 1))
+    npt.assert_allclose(random_numbers.mean(), 0.5, atol=0.01)
+    npt.assert_array_equal(
+        random_numbers, montecarlo.random_doubles(10000, 23111963, stream=5))
+    for stream, iteration in [(4, 0), (5, 1)]:
+        assert not np.any(random_numbers == montecarlo.random_doubles(
+            10000, 23111963, stream=stream, iteration=iteration))
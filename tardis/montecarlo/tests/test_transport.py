@@ -0,0 +1,335 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+from astropy import units as u, constants as const
+from scipy.stats import ks_2samp
+
+from tardis.montecarlo import packet_source
+from tardis.montecarlo.base import MontecarloRunner
+from tardis.montecarlo.tests.synthetic_model import make_model
+
+
+def run_transport(no_of_virtual_packets=0, nthreads=1, seed=23111963,
+                  chunk_size=None, **model_kwargs):
+    model = make_model(**model_kwargs)
+    runner = MontecarloRunner(seed)
+    runner.run(model, no_of_virtual_packets, nthreads=nthreads,
+               chunk_size=chunk_size)
+    return runner
+
+
+def test_thread_j_blue_estimators():
+    expected = run_transport().j_blue_estimator
+    # dense thread estimators, sparse ones that are full at once and ones
+    # that fill up
+    for memory_limit in [1 * u.GB, 1 * u.kB, 100 * u.kB]:
+        runner = run_transport(nthreads=3,
+                               thread_estimator_memory_limit=memory_limit)
+        npt.assert_allclose(runner.j_blue_estimator, expected, rtol=1e-12)
+
+
+def assert_same_estimators(runner, expected):
+    for name in ['j_estimator', 'nu_bar_estimator', 'j_blue_estimator',
+                 '_emitted_energy_spectrum', '_reabsorbed_energy_spectrum',
+                 '_luminosity_window_energies']:
+        npt.assert_allclose(getattr(runner, name), getattr(expected, name),
+                            rtol=1e-12, err_msg=name)
+
+
+def test_chunks():
+    # every chunk draws its packets with other seeds than a single chunk,
+    # so the chunked run only agrees with it statistically
+    expected = run_transport()
+    runner = run_transport(chunk_size=300)
+    assert runner.no_of_chunks_transported == 7
+    assert runner.output_nu.size == 2000
+    assert np.all(runner.output_nu.value != -99)
+    npt.assert_allclose(runner.emitted_luminosity.value,
+                        expected.emitted_luminosity.value, rtol=0.05)
+    npt.assert_allclose(runner.j_estimator, expected.j_estimator, rtol=0.1)
+    npt.assert_allclose(runner.nu_bar_estimator / runner.j_estimator,
+                        expected.nu_bar_estimator / expected.j_estimator,
+                        rtol=0.05)
+    assert ks_2samp(runner.output_nu.value,
+                    expected.output_nu.value).pvalue > 1e-3
+
+
+def test_kernel_packet_source_chunks():
+    # the kernel draws every packet from its own stream, so the chunks
+    # transport the same packets as a single chunk
+    expected = run_transport(packet_source='kernel')
+    runner = run_transport(chunk_size=300, packet_source='kernel')
+    assert runner.no_of_chunks_transported == 7
+    assert_same_estimators(runner, expected)
+    npt.assert_array_equal(runner.output_nu, expected.output_nu)
+    npt.assert_array_equal(runner.output_energy, expected.output_energy)
+
+
+def test_resume():
+    model = make_model()
+    runner = MontecarloRunner(23111963)
+    runner.run(model, 0, chunk_size=300, callback=lambda runner: False)
+    assert runner.no_of_packets_transported == 300
+    assert not runner.finished
+    assert runner.output_nu.size == 2000
+    assert np.all(runner.output_nu[300:].value == -99)
+    runner.resume(model)
+    assert runner.finished
+    expected = run_transport(chunk_size=300)
+    assert_same_estimators(runner, expected)
+    npt.assert_array_equal(runner.output_nu, expected.output_nu)
+
+
+def test_without_packet_diagnostics():
+    expected = run_transport()
+    runner = MontecarloRunner(23111963)
+    runner.run(make_model(), 0, packet_diagnostics=False)
+    # neither the packets nor the spectra depend on the diagnostics
+    assert_same_estimators(runner, expected)
+    npt.assert_array_equal(runner.output_nu, expected.output_nu)
+    npt.assert_array_equal(runner.output_energy, expected.output_energy)
+    for name in ['last_interaction_type', 'last_interaction_in_nu',
+                 'last_line_interaction_in_id',
+                 'last_line_interaction_out_id',
+                 'last_line_interaction_shell_id']:
+        assert getattr(runner, name) is None, name
+
+
+@pytest.mark.parametrize('shell_major_line_lists', [False, True])
+def test_macro_atom_sampling(shell_major_line_lists):
+    # the same random numbers select the same transitions
+    runners = [run_transport(macro_atom_sampling=macro_atom_sampling,
+                             transitions_per_level=8,
+                             shell_major_line_lists=shell_major_line_lists)
+               for macro_atom_sampling in ['linear', 'cumulative']]
+    assert np.any(runners[0].last_interaction_type == 2)
+    for name in ['output_nu', 'last_line_interaction_in_id',
+                 'last_line_interaction_out_id']:
+        npt.assert_array_equal(getattr(runners[1], name),
+                               getattr(runners[0], name), err_msg=name)
+
+
+def assert_same_transport(no_of_virtual_packets=0, rtol=1e-12,
+                          **model_kwargs):
+    """
+    Check that the packets take the same paths with the options in
+    `model_kwargs` as without
+    """
+    for line_interaction_type in ['scatter', 'macroatom']:
+        expected = run_transport(no_of_virtual_packets,
+                                 line_interaction_type=line_interaction_type)
+        runner = run_transport(no_of_virtual_packets,
+                               line_interaction_type=line_interaction_type,
+                               **model_kwargs)
+        assert_same_estimators(runner, expected)
+        for name in ['output_nu', 'output_energy', 'last_interaction_type',
+                     'last_line_interaction_in_id',
+                     'last_line_interaction_out_id']:
+            npt.assert_array_equal(getattr(runner, name),
+                                   getattr(expected, name), err_msg=name)
+        if no_of_virtual_packets > 0:
+            npt.assert_array_equal(runner.virt_packet_nus,
+                                   expected.virt_packet_nus)
+            npt.assert_allclose(runner.virt_packet_energies,
+                                expected.virt_packet_energies, rtol=rtol)
+
+
+def test_shell_major_line_lists():
+    assert_same_transport(no_of_virtual_packets=3,
+                          shell_major_line_lists=True)
+
+
+@pytest.mark.parametrize('thread_schedule', ['static', 'dynamic'])
+def test_thread_count(thread_schedule):
+    # every packet draws from its own random number stream
+    expected_model = make_model()
+    expected = MontecarloRunner(23111963)
+    expected.run(expected_model, 3)
+    model = make_model(thread_schedule=thread_schedule)
+    runner = MontecarloRunner(23111963)
+    runner.run(model, 3, nthreads=3)
+    assert_same_estimators(runner, expected)
+    npt.assert_allclose(model.montecarlo_virtual_luminosity,
+                        expected_model.montecarlo_virtual_luminosity,
+                        rtol=1e-12)
+    for name in ['output_nu', 'output_energy', 'last_interaction_type',
+                 'last_line_interaction_in_id',
+                 'last_line_interaction_out_id']:
+        npt.assert_array_equal(getattr(runner, name),
+                               getattr(expected, name), err_msg=name)
+    # the virtual packets of a thread are stored together
+    npt.assert_array_equal(np.sort(runner.virt_packet_nus),
+                           np.sort(expected.virt_packet_nus))
+
+
+def test_thread_load_imbalance():
+    runner = MontecarloRunner(23111963)
+    assert np.isnan(runner.thread_load_imbalance)
+    runner.run(make_model(), 0, nthreads=3)
+    assert np.all(runner.thread_packet_counts > 0)
+    assert runner.thread_load_imbalance >= 1
+
+
+def test_no_threads():
+    # the transport runs with at least one thread
+    runner = run_transport(nthreads=0)
+    assert runner.nthreads == 1
+    npt.assert_array_equal(runner.thread_packet_counts, [2000])
+
+
+def test_without_packet_logging():
+    expected = run_transport()
+    runner = MontecarloRunner(23111963)
+    runner.run(make_model(), 0, packet_logging=False)
+    # the binned spectra and estimators do not need the packets
+    assert_same_estimators(runner, expected)
+    assert runner.output_nu is None
+    assert runner.output_energy is None
+    for name in ['packet_luminosity', 'emitted_packet_nu',
+                 'reabsorbed_packet_nu']:
+        with pytest.raises(ValueError):
+            getattr(runner, name)
+
+
+def test_spectrum_binning():
+    model = make_model()
+    model.tardis_config.supernova.luminosity_nu_start = 5e14 * u.Hz
+    model.tardis_config.supernova.luminosity_nu_end = 1.5e15 * u.Hz
+    runner = MontecarloRunner(23111963)
+    runner.run(model, 0)
+    nus = runner.output_nu.value
+    energies = runner.output_energy.value
+    emitted = energies >= 0
+    assert np.any(emitted) and not np.all(emitted)
+    for spectrum, mask, sign in [
+            (runner._emitted_energy_spectrum, emitted, 1),
+            (runner._reabsorbed_energy_spectrum, ~emitted, -1)]:
+        npt.assert_allclose(spectrum, np.histogram(
+            nus[mask], bins=runner.spectrum_frequency,
+            weights=sign * energies[mask])[0], rtol=1e-12, atol=1e-300)
+    in_window = (nus > 5e14) & (nus < 1.5e15)
+    npt.assert_allclose(runner._luminosity_window_energies,
+                        [energies[in_window & emitted].sum(),
+                         -energies[in_window & ~emitted].sum()], rtol=1e-12)
+
+
+def test_shell_line_lists():
+    # a threshold of 0 keeps every line with a positive tau_sobolev
+    assert_same_transport(no_of_virtual_packets=3, shell_line_tau_threshold=0)
+
+
+def test_virtual_packet_tau_tables():
+    # the summed tau_sobolevs differ from the walk in rounding only
+    assert_same_transport(no_of_virtual_packets=3, rtol=1e-10,
+                          virtual_packet_engine='table')
+
+
+def test_virtual_packet_batches():
+    assert_same_transport(no_of_virtual_packets=3,
+                          virtual_packet_batch_size=100)
+    # every thread queues its own virtual packets
+    runner = run_transport(3, nthreads=3, virtual_packet_batch_size=100)
+    npt.assert_array_equal(np.sort(runner.virt_packet_nus),
+                           np.sort(run_transport(3).virt_packet_nus))
+
+
+def test_adaptive_virtual_packet_counts():
+    expected_model = make_model(no_of_packets=4000)
+    expected = MontecarloRunner(23111963)
+    expected.run(expected_model, 10, chunk_size=500)
+    model = make_model(no_of_packets=4000, virtual_packet_relative_error=0.2)
+    runner = MontecarloRunner(23111963)
+    runner.run(model, 10, chunk_size=500)
+    # the variance of a bin falls with the number of its virtual packets
+    errors = runner.virtual_spectrum_relative_errors
+    recorded = model.montecarlo_virtual_luminosity > 0
+    npt.assert_array_equal(
+        runner.virtual_packet_counts[recorded],
+        np.clip(np.ceil(10 * (errors[recorded] / 0.2) ** 2), 1, 10))
+    assert runner.virt_packet_nus.size < expected.virt_packet_nus.size
+    # the weights follow the counts, the virtual luminosity stays the same
+    # within its noise of about 2 percent
+    npt.assert_allclose(model.montecarlo_virtual_luminosity.sum(),
+                        expected_model.montecarlo_virtual_luminosity.sum(),
+                        rtol=0.06)
+
+
+def test_kernel_packet_source():
+    # the kernel draws the packets from the same blackbody as the default
+    # source, so the packets leave the ejecta with the same distribution
+    kernel = run_transport(no_of_packets=20000, packet_source='kernel')
+    numpy = run_transport(no_of_packets=20000, packet_source='random')
+    assert kernel.input_nu is None
+    assert ks_2samp(kernel.output_nu.value,
+                    numpy.output_nu.value).pvalue > 1e-3
+    # the packets share the energy of the iteration, up to Doppler shifts
+    npt.assert_allclose(np.abs(kernel.output_energy.value).sum(), 1,
+                        rtol=0.05)
+    # binomial error of the emitted energy is about 0.004
+    npt.assert_allclose(kernel._luminosity_window_energies,
+                        numpy._luminosity_window_energies, atol=0.02)
+
+
+def test_tabulated_packet_source(tmpdir):
+    wavelength = np.linspace(3000, 6000, 31)
+    fname = str(tmpdir.join('spectrum.dat'))
+    np.savetxt(fname, np.transpose([wavelength, np.ones_like(wavelength)]))
+    runner = run_transport(packet_source='tabulated',
+                           packet_source_spectrum_file=fname)
+    assert isinstance(runner.packet_source,
+                      packet_source.TabulatedSpectrumSource)
+    input_wavelength = (runner.input_nu * u.Hz).to(u.angstrom, u.spectral())
+    assert np.all((input_wavelength.value > 3000) &
+                  (input_wavelength.value < 6000))
+
+
+@pytest.mark.parametrize('line_interaction_type', ['scatter', 'macroatom'])
+def test_weight_window_last_interactions(line_interaction_type):
+    model = make_model(weight_window_importance_ratio=8,
+                       line_interaction_type=line_interaction_type)
+    runner = MontecarloRunner(23111963)
+    runner.run(model, 0)
+    # a packet whose last interaction was a line leaves at the frequency of
+    # its emission line, up to the Doppler shift, unless a split packet
+    # overwrote its last interaction
+    line_interaction = ((runner.last_interaction_type == 2) &
+                        (runner.output_energy.value > 0))
+    assert line_interaction.sum() > 100
+    line_nu = model.atom_data.lines.nu.values[
+        runner.last_line_interaction_out_id[line_interaction]]
+    beta = (runner.r_outer_cgs[-1] /
+            model.tardis_config.supernova.time_explosion.to('s').value /
+            const.c.cgs.value)
+    ratio = runner.output_nu.value[line_interaction] / line_nu
+    assert np.all((ratio >= 1 / (1 + beta)) & (ratio <= 1 / (1 - beta)))
+
+
+def test_weight_window_threads():
+    # every split packet draws from its own stream
+    expected = run_transport(3, weight_window_importance_ratio=8)
+    runner = run_transport(3, nthreads=3, weight_window_importance_ratio=8)
+    assert_same_estimators(runner, expected)
+    npt.assert_array_equal(runner.output_nu, expected.output_nu)
+    npt.assert_array_equal(np.sort(runner.virt_packet_nus),
+                           np.sort(expected.virt_packet_nus))
+
+
+def mean_spectrum_energies(no_of_seeds=4, **model_kwargs):
+    """
+    Emitted and reabsorbed energy averaged over runs with different seeds
+    """
+    energies = []
+    for seed in range(no_of_seeds):
+        runner = run_transport(seed=seed, **model_kwargs)
+        energies.append([runner._emitted_energy_spectrum.sum(),
+                         runner._reabsorbed_energy_spectrum.sum()])
+    return np.mean(energies, axis=0)
+
+
+def test_weight_window_luminosity():
+    # Russian roulette and splitting conserve the expected energy, the packet
+    # noise of the mean emitted energy is about 0.005
+    npt.assert_allclose(
+        mean_spectrum_energies(no_of_packets=4000,
+                               weight_window_importance_ratio=8),
+        mean_spectrum_energies(no_of_packets=4000), atol=0.02)
@@ -1,6 +1,7 @@
 import pytest
 import numpy as np
 import yaml
+import pandas as pd
 import tardis
 from tardis import io, model, simulation
 from tardis.io.config_reader import Configuration
@@ -46,3 +47,44 @@ class TestSimpleRun():
 
         np.testing.assert_allclose(
             self.model.spectrum.luminosity_density_lambda,luminosity_density)
+
+
+@pytest.mark.skipif(not pytest.config.getvalue("atomic-dataset"),
+                    reason='--atomic_database was not specified')
+class TestRunWithoutPacketDiagnostics():
+    """
+    Single iteration without packet diagnostics
+    """
+
+    @classmethod
+    @pytest.fixture(scope="class", autouse=True)
+    def setup(self):
+        self.atom_data_filename = os.path.expanduser(os.path.expandvars(
+            pytest.config.getvalue('atomic-dataset')))
+        self.config_yaml = yaml.load(open(
+            'tardis/io/tests/data/tardis_configv1_verysimple.yml'))
+        self.config_yaml['atom_data'] = self.atom_data_filename
+        self.config_yaml['montecarlo']['iterations'] = 1
+        self.config_yaml['montecarlo']['no_of_packets'] = 2.0e+4
+        self.config_yaml['montecarlo']['last_no_of_packets'] = -1
+        self.config_yaml['montecarlo']['packet_diagnostics'] = 'none'
+
+        self.model = run_tardis(self.config_yaml)
+
+    def test_packets(self):
+        assert self.model.montecarlo_nu.size == 20000
+        assert self.model.last_line_interaction_in_id is None
+        assert self.model.runner.last_interaction_type is None
+
+    def test_spectrum(self):
+        assert np.all(np.isfinite(
+            self.model.spectrum.luminosity_density_lambda))
+        assert np.any(self.model.spectrum.luminosity_density_lambda.value > 0)
+
+    def test_to_hdf5(self, tmpdir):
+        fname = str(tmpdir.join('model.h5'))
+        self.model.to_hdf5(fname)
+        with pd.HDFStore(fname) as hdf_store:
+            assert '/luminosity_density' in hdf_store.keys()
+            assert '/montecarlo_nu' in hdf_store.keys()
+            assert '/last_line_interaction_in_id' not in hdf_store.keys()